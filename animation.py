@@ -0,0 +1,292 @@
+"""
+Водяной знак на анимациях (GIF, WebP) и многостраничных TIFF с сохранением всех кадров.
+
+Кадры читаются по одному (ImageSequence), знак для каждого размера кадра отрисовывается
+один раз. Если область под знаком не изменилась с прошлого кадра (типично для анимаций,
+где двигается только часть картинки), смешивание не повторяется - вставляется уже
+готовая область. Поэтому неизменные места кадров остаются одинаковыми, и кодер
+по-прежнему пишет только изменившиеся прямоугольники.
+
+GIF записывается потоком (заголовок и кадры через GifImagePlugin.getheader/getdata):
+в памяти текущий кадр, предыдущий для поиска изменений и один ещё не записанный - его
+длительность растёт, если следующий кадр с ним совпадает. Кодер GIF в Pillow, наоборот,
+держит до конца записи все кадры. Страницы TIFF дописываются по одной через
+TiffImagePlugin.AppendingTiffWriter. WebP пишет Pillow (save_all), но кадры он получает
+из _WatermarkedFrames: каждый декодируется и получает знак только тогда, когда кодер
+до него дошёл. Длительности кадров и число показов сохраняются.
+"""
+import time
+import logging
+
+import PIL
+from PIL import Image, ImageChops, ImageSequence, GifImagePlugin, TiffImagePlugin
+
+from utils import WatermarkParams, render_watermark_layer, composite_watermark_layer, atomic_output
+from encoding import output_format, get_encoding_options
+
+
+# Форматы исходников, которые могут быть многокадровыми (MPO-снимки с камер сюда не входят)
+ANIMATED_SOURCE_EXTENSIONS = (".gif", ".webp", ".tif", ".tiff", ".png")
+# Форматы результата, которые умеют хранить несколько кадров
+ANIMATED_FORMATS = ("GIF", "WEBP", "TIFF")
+
+# Длительность кадра, если в исходнике её нет (например, страницы TIFF), мс
+DEFAULT_FRAME_DURATION = 100
+
+_DISPOSAL_NONE, _DISPOSAL_BACKGROUND = 1, 2
+_TRANSPARENT_INDEX = 255
+
+# _WatermarkedFrames подставляет кадр через внутренние поля Image (im, _mode, _size); так проверено
+# на Pillow 10.1-12.x. На других версиях кадры WebP собираются списком для append_images -
+# больше памяти, зато без внутренних полей
+_LAZY_FRAMES_SUPPORTED = (10, 1) <= tuple(int(part) for part in PIL.__version__.split(".")[:2]) < (13, 0)
+
+
+def is_animated_file(image_path: str) -> bool:
+    """Больше одного кадра (или страницы); читается только заголовок и начало второго кадра."""
+    if not image_path.lower().endswith(ANIMATED_SOURCE_EXTENSIONS):
+        return False
+    try:
+        with Image.open(image_path) as image:
+            return getattr(image, "is_animated", False)
+    except Exception:
+        return False
+
+
+def use_animation_processing(image_path: str, result_path: str) -> bool:
+    """Нужно ли обрабатывать файл покадрово. Если формат результата кадров не хранит, остаётся первый кадр."""
+    if not is_animated_file(image_path):
+        return False
+    if output_format(result_path) not in ANIMATED_FORMATS:
+        logging.warning(f"{result_path}: {output_format(result_path)} cannot hold several frames, "
+                        f"only the first frame of {image_path} is kept")
+        return False
+    return True
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+class _FrameWatermarker:
+    """
+    Накладывает знак на кадры по очереди. Знак берётся один раз на размер кадра, а если
+    область под знаком совпадает с прошлым кадром, вставляется готовый результат смешивания.
+    """
+
+    def __init__(self, params: WatermarkParams, timings: dict):
+        self.params, self.timings = params, timings
+        self._layers = {}  # размер кадра -> (знак, рамка знака на кадре)
+        self._previous = None  # (размер, область исходника под знаком, та же область со знаком)
+        self.reused = 0
+
+    def _layer(self, size):
+        if size not in self._layers:
+            layer = render_watermark_layer(size, self.params)
+            box = None
+            if layer is not None:
+                box = (max(layer.x, 0), max(layer.y, 0),
+                       min(layer.x + layer.image.width, size[0]), min(layer.y + layer.image.height, size[1]))
+                if box[2] <= box[0] or box[3] <= box[1]:
+                    box = None  # Знак целиком за кадром
+            self._layers[size] = (layer, box)
+        return self._layers[size]
+
+    def apply(self, frame: Image.Image) -> Image.Image:
+        started = time.perf_counter()
+        layer, box = self._layer(frame.size)
+        if box is not None:
+            source = frame.crop(box)
+            previous = self._previous
+            if (previous is not None and previous[0] == frame.size
+                    and ImageChops.difference(source, previous[1]).getbbox() is None):
+                frame.paste(previous[2], box[:2])
+                self.reused += 1
+            else:
+                composite_watermark_layer(frame, layer, in_place=True)
+                self._previous = (frame.size, source, frame.crop(box))
+        self.timings["watermark"] += time.perf_counter() - started
+        return frame
+
+
+def _source_frames(source: Image.Image, mode: str, timings: dict, should_cancel=None):
+    """Кадры исходника по одному: (кадр в режиме mode, длительность в мс)."""
+    for frame in ImageSequence.Iterator(source):
+        if should_cancel is not None and should_cancel():
+            raise InterruptedError(f"Processing cancelled: {source.filename}")
+        started = time.perf_counter()
+        converted = frame.convert(mode)
+        timings["decode"] += time.perf_counter() - started
+        yield converted, frame.info.get("duration") or DEFAULT_FRAME_DURATION
+
+
+def _to_palette(frame: Image.Image) -> Image.Image:
+    """Кадр в палитру GIF; прозрачные пиксели получают отдельный индекс _TRANSPARENT_INDEX."""
+    if frame.mode != "RGBA":
+        return frame.convert("P", palette=Image.Palette.ADAPTIVE, colors=256)
+    paletted = frame.convert("RGB").convert("P", palette=Image.Palette.ADAPTIVE, colors=_TRANSPARENT_INDEX)
+    palette = paletted.getpalette()[:_TRANSPARENT_INDEX * 3]
+    paletted.putpalette(palette + [0] * (768 - len(palette)))
+    paletted.paste(_TRANSPARENT_INDEX, mask=frame.getchannel("A").point(lambda a: 255 if a < 128 else 0))
+    return paletted
+
+
+def _write_gif(frames, fp, loop: int | None, transparent: bool, timings: dict) -> int:
+    """
+    Пишет кадры (кадр, длительность) в GIF потоком. Непрозрачные кадры после первого
+    записываются только прямоугольником изменений; совпадающие кадры склеиваются
+    в один с общей длительностью. Возвращает число записанных кадров.
+    """
+    previous = None  # Предыдущий кадр целиком - для поиска изменений
+    pending = None  # Кадр, который ждёт записи: (палитровый кадр, смещение, параметры)
+    written = 0
+
+    def flush():
+        paletted, offset, frame_params = pending
+        for chunk in GifImagePlugin.getdata(paletted, offset, **frame_params):
+            fp.write(chunk)
+
+    for frame, duration in frames:
+        started = time.perf_counter()
+        if previous is None:
+            paletted = _to_palette(frame)
+            header_info = {} if loop is None else {"loop": loop}
+            header, _ = GifImagePlugin.getheader(paletted, info=header_info)
+            for chunk in header:
+                fp.write(chunk)
+            box = (0, 0) + frame.size
+        else:
+            box = (0, 0) + frame.size if transparent else ImageChops.difference(frame, previous).getbbox()
+            if box is None:
+                pending[2]["duration"] += duration  # Кадр не изменился - продлеваем предыдущий
+                timings["encode"] += time.perf_counter() - started
+                continue
+            flush()
+            written += 1
+            paletted = _to_palette(frame.crop(box))
+        frame_params = {"duration": duration, "disposal": _DISPOSAL_BACKGROUND if transparent else _DISPOSAL_NONE,
+                        "include_color_table": previous is not None}
+        if transparent:
+            frame_params["transparency"] = _TRANSPARENT_INDEX
+        pending = (paletted, box[:2], frame_params)
+        previous = frame
+        timings["encode"] += time.perf_counter() - started
+
+    if pending is not None:
+        started = time.perf_counter()
+        flush()
+        written += 1
+        fp.write(b";")  # Конец файла GIF
+        timings["encode"] += time.perf_counter() - started
+    return written
+
+
+class _WatermarkedFrames(Image.Image):
+    """
+    Многокадровое изображение для Image.save(save_all=True): кодер WebP переходит
+    по кадрам через seek(), а кадр декодируется и получает знак только в этот момент.
+    Опирается на внутренние поля Image - см. _LAZY_FRAMES_SUPPORTED.
+    """
+
+    def __init__(self, source: Image.Image, mode: str, watermarker: _FrameWatermarker, timings: dict,
+                 should_cancel=None):
+        super().__init__()
+        self._source, self._target_mode, self._watermarker = source, mode, watermarker
+        self._timings, self._should_cancel = timings, should_cancel
+        self.n_frames = source.n_frames
+        self.is_animated = True
+        self._index = -1
+        self.seek(0)
+
+    def seek(self, frame: int):
+        if frame == self._index:
+            return
+        if self._should_cancel is not None and self._should_cancel():
+            raise InterruptedError(f"Processing cancelled: {self._source.filename}")
+        started = time.perf_counter()
+        self._source.seek(frame)
+        image = self._source.convert(self._target_mode)
+        self._timings["decode"] += time.perf_counter() - started
+        image = self._watermarker.apply(image)
+        self.im, self._mode, self._size = image.im, image.mode, image.size
+        self.info = {"duration": self._source.info.get("duration") or DEFAULT_FRAME_DURATION}
+        self._index = frame
+
+    def tell(self) -> int:
+        return self._index
+
+
+def _play_count(source: Image.Image) -> int:
+    """
+    Сколько раз показать анимацию всего, как loop в WebP (0 - бесконечно). В GIF loop - число
+    повторов после первого показа, а без расширения NETSCAPE анимация играет один раз;
+    у страниц TIFF повторов нет.
+    """
+    loop = source.info.get("loop")
+    if loop is None:
+        return 1
+    if source.format == "GIF" and loop:
+        return loop + 1
+    return loop
+
+
+def _frame_durations(source: Image.Image) -> list[int]:
+    # Переход по кадрам без load() читает только их заголовки; WebP узнаёт длительность лишь при декодировании
+    durations = []
+    for index in range(source.n_frames):
+        source.seek(index)
+        if source.format == "WEBP":
+            source.load()
+        durations.append(source.info.get("duration") or DEFAULT_FRAME_DURATION)
+    source.seek(0)
+    return durations
+
+
+def watermark_animation(image_path: str, result_path: str, params: WatermarkParams, should_cancel=None) -> dict:
+    """
+    Накладывает знак на каждый кадр анимации или страницу TIFF. Формат результата -
+    по расширению result_path (GIF, WebP или TIFF). Возвращает время этапов в секундах
+    (как utils.process_image_file) и число кадров в "frames".
+    """
+    timings = {"decode": 0.0, "watermark": 0.0, "encode": 0.0}
+    fmt = output_format(result_path)
+    options = get_encoding_options()
+    watermarker = _FrameWatermarker(params, timings)
+    with Image.open(image_path) as source, atomic_output(result_path) as tmp_path:
+        transparent = _has_alpha(source)
+        mode = "RGBA" if transparent else "RGB"
+        plays = _play_count(source)
+        if fmt == "GIF":
+            frames = ((watermarker.apply(frame), duration)
+                      for frame, duration in _source_frames(source, mode, timings, should_cancel))
+            # Один показ - без расширения NETSCAPE, иначе в нём число повторов после первого показа
+            loop = None if plays == 1 else max(plays - 1, 0)
+            with open(tmp_path, "wb") as fp:
+                written = _write_gif(frames, fp, loop, transparent, timings)
+        elif fmt == "TIFF":
+            written = 0
+            started = time.perf_counter()
+            with open(tmp_path, "w+b") as fp, TiffImagePlugin.AppendingTiffWriter(fp) as tiff:
+                for frame, _ in _source_frames(source, mode, timings, should_cancel):
+                    watermarker.apply(frame).save(tiff, "TIFF")
+                    tiff.newFrame()
+                    written += 1
+            timings["encode"] = time.perf_counter() - started - timings["decode"] - timings["watermark"]
+        else:
+            written = source.n_frames
+            arguments = {"duration": _frame_durations(source), "loop": plays, "quality": options.webp_quality,
+                         "lossless": options.webp_lossless, "method": options.webp_method}
+            started = time.perf_counter()
+            if _LAZY_FRAMES_SUPPORTED:
+                frames = _WatermarkedFrames(source, mode, watermarker, timings, should_cancel)
+                frames.save(tmp_path, fmt, save_all=True, **arguments)
+            else:
+                first, *rest = [watermarker.apply(frame)
+                                for frame, _ in _source_frames(source, mode, timings, should_cancel)]
+                first.save(tmp_path, fmt, save_all=True, append_images=rest, **arguments)
+            # Время кодера - всё время записи, кроме декодирования и знака
+            timings["encode"] = time.perf_counter() - started - timings["decode"] - timings["watermark"]
+    timings["frames"] = written
+    logging.info(f"Watermark added to animation: {result_path} ({written} frames, "
+                 f"{watermarker.reused} watermark regions reused)")
+    return timings
@@ -0,0 +1,264 @@
+"""
+Пакетная обработка изображений в пуле процессов.
+
+Модуль не зависит от PyQt6: его использует и интерфейс (через поток-обёртку
+в image_tab.py), и консольный режим.
+
+Новые файлы отдаются пулу с учётом бюджета памяти: для каждого по заголовку
+оценивается размер декодированного кадра, и задачи ждут, пока суммарная оценка
+выполняющихся не позволит взять следующую. Отмена (create_cancel_event) доходит
+до рабочих процессов и срабатывает между этапами обработки. Замеры по этапам
+и профилирование (instrumentation.py) включаются в рабочих процессах через run_batch.
+"""
+import os
+import time
+import queue
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import process_image_file, set_compositing_backend, open_image_lazy, FILE_MAX_IMAGE_PIXELS
+from encoding import EncodingOptions, set_encoding_options
+from video import is_video_file, read_video_size, watermark_video
+from tiled import read_tiff_layout, use_tiled_processing, watermark_tiff_tiled
+from animation import use_animation_processing, watermark_animation
+from variants import VariantTask, process_image_variants
+from instrumentation import InstrumentationConfig, configure_logging, set_instrumentation, track
+
+
+BatchTask = namedtuple("BatchTask", ["image_path", "result_path", "params"])
+# Вместо BatchTask можно передавать variants.VariantTask - один исходник с несколькими результатами.
+# error - текст ошибки или None, если файл обработан успешно;
+# timings - время этапов обработки (см. utils.process_image_file), при ошибке пустой словарь;
+# если включены замеры, в timings["details"] - подэтапы и профиль (см. instrumentation.track)
+BatchResult = namedtuple("BatchResult", ["task", "error", "timings"])
+
+# Как часто генератор проверяет флаг отмены, пока ждёт результатов, в секундах
+CANCEL_POLL_INTERVAL = 0.05
+
+# Как часто рабочий процесс сообщает о готовых кадрах видео (см. run_batch), в секундах
+PROGRESS_INTERVAL = 0.2
+
+# Событие отмены текущего пакета и очередь сообщений о кадрах видео в рабочем процессе (см. _init_worker)
+_cancel_event = None
+_progress_queue = None
+
+
+def default_worker_count() -> int:
+    """Число рабочих процессов по умолчанию - по количеству ядер."""
+    return os.cpu_count() or 1
+
+
+def default_memory_budget() -> int | None:
+    """Бюджет памяти по умолчанию - половина физической памяти (None, если её не узнать)."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def create_cancel_event():
+    """Событие для отмены run_batch; его видят и рабочие процессы."""
+    return multiprocessing.get_context("spawn").Event()
+
+
+def estimate_task_memory(task: BatchTask | VariantTask) -> int:
+    """
+    Оценка памяти под задачу: ширина * высота * 4 по заголовку файла (сами пиксели не читаются).
+    Для видео в памяти одновременно один кадр, для большого TIFF - одна полоса, для задачи
+    с вариантами - исходник и по копии на каждый вариант. Если заголовок не прочитать,
+    возвращает 0 - ошибку покажет сама обработка.
+    """
+    copies = 1 + len(task.outputs) if isinstance(task, VariantTask) else 1
+    try:
+        if is_video_file(task.image_path):
+            width, height = read_video_size(task.image_path)
+            copies = 1  # Варианты видео делаются по очереди
+        elif copies == 1 and use_tiled_processing(task.image_path, task.result_path):
+            width, height = read_tiff_layout(task.image_path).block_size
+        else:
+            with open_image_lazy(task.image_path, FILE_MAX_IMAGE_PIXELS) as image:
+                width, height = image.size
+    except Exception:
+        return 0
+    return width * height * 4 * copies
+
+
+def _init_worker(log_level: int | None, backend: str | None, cancel_event=None, encoding: EncodingOptions | None = None,
+                 instrumentation: InstrumentationConfig | None = None, progress_queue=None):
+    global _cancel_event, _progress_queue
+    if log_level is not None:
+        configure_logging(log_level)
+    if backend is not None:
+        set_compositing_backend(backend)
+    if encoding is not None:
+        set_encoding_options(encoding)
+    set_instrumentation(instrumentation)
+    _cancel_event = cancel_event
+    _progress_queue = progress_queue
+
+
+def _video_progress(image_path: str):
+    """progress для watermark_video: (исходник, готово кадров, всего) в очередь run_batch не чаще PROGRESS_INTERVAL."""
+    if _progress_queue is None:
+        return None
+    last_sent = 0.0
+
+    def progress(done: int, total: int):
+        nonlocal last_sent
+        now = time.monotonic()
+        if now - last_sent >= PROGRESS_INTERVAL or done == total:
+            last_sent = now
+            _progress_queue.put((image_path, done, total))
+
+    return progress
+
+
+def _add_timings(timings: dict, stage_timings: dict):
+    # Время складывается, списки ("encoded") склеиваются
+    for stage, value in stage_timings.items():
+        timings[stage] = timings[stage] + value if stage in timings else value
+
+
+def _run_variant_task(task: VariantTask, should_cancel) -> dict:
+    timings = {}
+    if is_video_file(task.image_path):
+        # Кадры видео в памяти не держим, поэтому каждый вариант декодирует ролик заново (max_size не применяется)
+        for output in task.outputs:
+            _add_timings(timings, watermark_video(task.image_path, output.result_path, output.params,
+                                                  progress=_video_progress(task.image_path), should_cancel=should_cancel))
+        return timings
+    # Анимации так же: варианты в GIF/WebP/TIFF проходят по кадрам исходника заново (max_size не применяется)
+    animated = [output for output in task.outputs if use_animation_processing(task.image_path, output.result_path)]
+    for output in animated:
+        _add_timings(timings, watermark_animation(task.image_path, output.result_path, output.params,
+                                                  should_cancel=should_cancel))
+    outputs = [output for output in task.outputs if output not in animated]
+    if outputs:
+        _add_timings(timings, process_image_variants(task.image_path, outputs, should_cancel=should_cancel))
+    return timings
+
+
+def _run_task(task: BatchTask | VariantTask) -> dict:
+    """Выполняется в рабочем процессе."""
+    should_cancel = _cancel_event.is_set if _cancel_event is not None else None
+    with track(task.image_path) as details:
+        timings = _process_task(task, should_cancel)
+    if details is not None:
+        timings["details"] = details
+    return timings
+
+
+def _process_task(task: BatchTask | VariantTask, should_cancel) -> dict:
+    if isinstance(task, VariantTask):
+        return _run_variant_task(task, should_cancel)
+    if is_video_file(task.image_path):
+        return watermark_video(task.image_path, task.result_path, task.params, progress=_video_progress(task.image_path),
+                               should_cancel=should_cancel)
+    if use_tiled_processing(task.image_path, task.result_path):
+        return watermark_tiff_tiled(task.image_path, task.result_path, task.params, should_cancel=should_cancel)
+    if use_animation_processing(task.image_path, task.result_path):
+        return watermark_animation(task.image_path, task.result_path, task.params, should_cancel=should_cancel)
+    return process_image_file(task.image_path, task.result_path, task.params, should_cancel=should_cancel)
+
+
+def create_worker_pool(max_workers: int | None = None, log_level: int | None = None, backend: str | None = None,
+                       cancel_event=None, encoding: EncodingOptions | None = None,
+                       instrumentation: InstrumentationConfig | None = None, progress_queue=None) -> ProcessPoolExecutor:
+    """
+    Пул рабочих процессов с теми же настройками, что у run_batch. Для долгоживущих
+    сервисов (watch.py), которые отдают задачи по одной через submit_task.
+    В progress_queue (multiprocessing.Queue), если она задана, рабочие процессы кладут
+    (исходник, готово кадров, всего кадров) по ходу обработки видео.
+    """
+    # spawn вместо fork: родительский процесс может быть Qt-приложением с потоками
+    return ProcessPoolExecutor(max_workers=max(1, max_workers or default_worker_count()),
+                               mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                               initargs=(log_level, backend, cancel_event, encoding, instrumentation, progress_queue))
+
+
+def submit_task(executor: ProcessPoolExecutor, task: BatchTask | VariantTask):
+    """Отдаёт задачу пулу из create_worker_pool; future.result() - время этапов, как в BatchResult."""
+    return executor.submit(_run_task, task)
+
+
+def run_batch(tasks, max_workers: int | None = None, log_level: int | None = None, backend: str | None = None,
+              cancel_event=None, memory_budget: int | None = None, encoding: EncodingOptions | None = None,
+              instrumentation: InstrumentationConfig | None = None, progress=None):
+    """
+    Обрабатывает задачи в пуле процессов и отдаёт BatchResult по мере готовности.
+
+    Одновременно в пуле находится не больше 2 * max_workers задач, поэтому
+    очередь из тысяч файлов не разворачивается в памяти целиком. Если генератор
+    закрыть раньше времени (break / close()), ещё не начатые задачи отменяются.
+    log_level, если задан, выставляется корневому логгеру в рабочих процессах,
+    backend - способ смешивания ("pillow" / "numpy", см. utils.set_compositing_backend),
+    encoding - настройки кодирования результатов (см. encoding.EncodingOptions),
+    instrumentation - замеры подэтапов и профилирование (см. instrumentation.py).
+
+    cancel_event (create_cancel_event) - после set() генератор завершается в течение
+    CANCEL_POLL_INTERVAL, задачи из очереди отменяются, а выполняющиеся прерываются
+    на ближайшей границе этапов без записи результата.
+    memory_budget - сколько байт могут занимать декодированные кадры всех выполняющихся
+    задач (см. estimate_task_memory); None - без ограничения. Задачи берутся по порядку;
+    файл больше всего бюджета запускается, только когда пул пуст, - один.
+    progress(исходник, готово кадров, всего кадров) вызывается в потоке, который читает генератор,
+    по ходу обработки видео (не чаще PROGRESS_INTERVAL на файл; всего может быть 0, если
+    длительность неизвестна) - до BatchResult этого файла.
+    """
+    max_workers = max(1, max_workers or default_worker_count())
+    progress_queue = multiprocessing.get_context("spawn").Queue() if progress is not None else None
+    executor = create_worker_pool(max_workers, log_level, backend, cancel_event, encoding, instrumentation,
+                                  progress_queue)
+    pending = {}  # future -> (задача, оценка памяти)
+    reserved = 0  # Сумма оценок памяти выполняющихся задач
+    waiting = None  # Задача, которая ждёт освобождения памяти
+    task_iter = iter(tasks)
+    try:
+        while True:
+            while len(pending) < 2 * max_workers:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                if waiting is None:
+                    task = next(task_iter, None)
+                    if task is None:
+                        break
+                    waiting = (task, estimate_task_memory(task) if memory_budget is not None else 0)
+                task, footprint = waiting
+                if memory_budget is not None and pending and reserved + footprint > memory_budget:
+                    break  # Ждём, пока завершится что-то из выполняющегося
+                pending[submit_task(executor, task)] = waiting
+                reserved += footprint
+                waiting = None
+            if not pending:
+                return
+            timeout = CANCEL_POLL_INTERVAL if cancel_event is not None or progress is not None else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if progress is not None:
+                _drain_progress(progress_queue, progress)
+            for future in done:
+                task, footprint = pending.pop(future)
+                reserved -= footprint
+                exc = future.exception()
+                if exc is None:
+                    yield BatchResult(task, None, future.result())
+                else:
+                    yield BatchResult(task, str(exc), {})
+    finally:
+        # Если всё обработано, рабочие процессы свободны - дожидаемся их выхода. Иначе при выходе
+        # из дочернего процесса (например, сценария benchmark.py) multiprocessing закрывает очередь
+        # задач раньше, чем пул успевает разослать сигнал остановки, и процесс зависает
+        executor.shutdown(wait=not pending, cancel_futures=True)
+        if progress_queue is not None:
+            progress_queue.close()
+
+
+def _drain_progress(progress_queue, progress):
+    while True:
+        try:
+            image_path, done, total = progress_queue.get_nowait()
+        except queue.Empty:
+            return
+        progress(image_path, done, total)
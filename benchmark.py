@@ -0,0 +1,356 @@
+"""
+Набор замеров производительности для горячих путей наложения знака.
+
+Запуск:
+    python -m benchmark -o bench.json
+    python -m benchmark --quick -o new.json --baseline bench.json --fail-on-regression
+
+Входные изображения генерируются локально (несколько разрешений, JPEG и PNG, баннер RGBA),
+поэтому результаты разных машин и версий сравнимы между собой. Меряются:
+    apply/...   - apply_watermark_to_pillow_image для текста и баннера во всех позициях,
+                  "cold" - с пустым кэшем знаков (шрифт, замер текста, ресайз баннера), "warm" - с кэшем;
+    font/...    - построение индекса шрифтов и получение шрифта (utils._get_font);
+    banner/...  - ресайз баннера под разрешение (render_watermark_layer без кэша);
+    file/...    - задержка process_image_file на один файл (декодирование, знак, кодирование);
+    batch/...   - пропускная способность run_batch на 1..N процессах.
+Каждый сценарий (группа замеров на одном разрешении или числе процессов) идёт в отдельном
+свежем процессе, и для него записывается пиковая память (у пакета - ещё и самого «тяжёлого»
+рабочего процесса). Текст рисуется первым найденным шрифтом из DEFAULT_WATERMARK_PARAMS.font_name
+и utils.FALLBACK_FONTS, чтобы замер не шёл по пути фолбэка с предупреждением на каждый вызов.
+Результаты пишутся в JSON; с --baseline печатается сравнение времени и памяти и отмечаются регрессии.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from utils import (DEFAULT_WATERMARK_PARAMS, apply_watermark_to_pillow_image, clear_watermark_cache,
+                   render_watermark_layer, process_image_file, _get_font, FALLBACK_FONTS)
+from fonts import get_font_index, resolve_font_path, load_font
+from batch import BatchTask, run_batch, default_worker_count
+from cli import POSITION_ALIASES
+from instrumentation import configure_logging
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+RESOLUTIONS = ((640, 480), (1920, 1080), (4000, 3000))
+QUICK_RESOLUTIONS = RESOLUTIONS[:2]
+FORMATS = (".jpg", ".png")
+POSITIONS = tuple(POSITION_ALIASES.values())
+
+# Метрика, по которой сравниваем с базой, и в какую сторону лучше
+_LOWER_IS_BETTER = "median_ms"
+_HIGHER_IS_BETTER = "images_per_s"
+# Метрики памяти сценария (меньше - лучше)
+_MEMORY_METRICS = ("peak_rss_mb", "peak_rss_workers_mb")
+
+SECTIONS = ("apply", "font", "banner", "file", "batch")
+
+
+def generate_inputs(directory: str, resolutions, batch_size: int) -> dict:
+    """Синтетические изображения: градиент с шумом (похоже на фото по сжимаемости) и баннер RGBA."""
+    rng = np.random.default_rng(0)
+    inputs = {}
+    for width, height in resolutions:
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * np.ones((height, 1, 3), np.float32)
+        noise = rng.normal(0, 12, (height, width, 3))
+        image = Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8), "RGB")
+        for ext in FORMATS:
+            path = os.path.join(directory, f"{width}x{height}{ext}")
+            image.save(path)
+            inputs[(width, height, ext)] = path
+
+    banner = np.zeros((300, 900, 4), np.uint8)
+    banner[..., 0], banner[..., 3] = 255, rng.integers(64, 256, (300, 900), dtype=np.uint8)
+    inputs["banner"] = os.path.join(directory, "banner.png")
+    Image.fromarray(banner, "RGBA").save(inputs["banner"])
+
+    # Пакет для замера пропускной способности: копии среднего JPEG
+    width, height = resolutions[min(1, len(resolutions) - 1)]
+    inputs["batch"] = []
+    for index in range(batch_size):
+        path = os.path.join(directory, f"batch_{index:03d}.jpg")
+        shutil.copyfile(inputs[(width, height, ".jpg")], path)
+        inputs["batch"].append(path)
+    return inputs
+
+
+def measure(func, repeat: int) -> dict:
+    """Время вызовов func в миллисекундах: медиана, p95, минимум."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "median_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "min_ms": round(samples[0], 3),
+        "runs": repeat,
+    }
+
+
+def peak_rss_mb() -> dict:
+    """
+    Пиковая память этого процесса и самого «тяжёлого» из завершившихся дочерних (рабочих
+    процессов, если они были). Осмысленна в свежем процессе сценария (см. run_benchmarks).
+    """
+    if resource is None:
+        return {}
+    # ru_maxrss - килобайты на Linux и байты на macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    try:
+        # На Linux ru_maxrss наследует память родителя в момент fork, а VmHWM считается с exec
+        with open("/proc/self/status", encoding="ascii") as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration, ValueError):
+        pass
+    memory = {"peak_rss_mb": round(peak / 2 ** 20, 1)}
+    # У рабочих процессов пик не меньше памяти этого процесса в момент их запуска (в начале сценария)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if children:
+        memory["peak_rss_workers_mb"] = round(children * unit / 2 ** 20, 1)
+    return memory
+
+
+def benchmark_params():
+    """Параметры знака для замеров: первый установленный шрифт, без фолбэка (и его предупреждений)."""
+    for font_name in (DEFAULT_WATERMARK_PARAMS.font_name, *FALLBACK_FONTS):
+        if resolve_font_path(font_name):
+            return DEFAULT_WATERMARK_PARAMS._replace(font_name=font_name)
+    return DEFAULT_WATERMARK_PARAMS
+
+
+def bench_apply(inputs: dict, resolutions, repeat: int, results: dict, base_params=DEFAULT_WATERMARK_PARAMS):
+    text_params = base_params
+    banner_params = base_params._replace(watermark_type="image", image_path=inputs["banner"])
+    for width, height in resolutions:
+        with Image.open(inputs[(width, height, ".jpg")]) as image:
+            image.load()
+            for mode, params in (("text", text_params), ("image", banner_params)):
+                for position in POSITIONS:
+                    params = params._replace(position=position)
+                    key = f"apply/{mode}/{width}x{height}/{position}"
+
+                    def cold():
+                        clear_watermark_cache()
+                        apply_watermark_to_pillow_image(image, params)
+
+                    results[key + "/cold"] = measure(cold, repeat)
+                    results[key + "/warm"] = measure(lambda: apply_watermark_to_pillow_image(image, params), repeat)
+
+
+def bench_fonts(repeat: int, results: dict, base_params=DEFAULT_WATERMARK_PARAMS):
+    def index_cold():
+        get_font_index.cache_clear()
+        resolve_font_path.cache_clear()
+        get_font_index()
+
+    results["font/index/cold"] = measure(index_cold, max(1, repeat // 4))
+
+    def font_cold():
+        resolve_font_path.cache_clear()
+        load_font.cache_clear()
+        _get_font(base_params.font_name, 48)
+
+    results["font/get/cold"] = measure(font_cold, repeat)
+    results["font/get/warm"] = measure(lambda: _get_font(base_params.font_name, 48), repeat)
+
+
+def bench_banner(inputs: dict, resolutions, repeat: int, results: dict, base_params=DEFAULT_WATERMARK_PARAMS):
+    params = base_params._replace(watermark_type="image", image_path=inputs["banner"])
+    for width, height in resolutions:
+        def resize():
+            clear_watermark_cache()
+            render_watermark_layer((width, height), params)
+
+        results[f"banner/resize/{width}x{height}"] = measure(resize, repeat)
+
+
+def bench_files(inputs: dict, resolutions, repeat: int, directory: str, results: dict,
+                base_params=DEFAULT_WATERMARK_PARAMS):
+    for width, height in resolutions:
+        for ext in FORMATS:
+            source = inputs[(width, height, ext)]
+            target = os.path.join(directory, f"out_{width}x{height}{ext}")
+            results[f"file/{ext[1:]}/{width}x{height}"] = measure(
+                lambda: process_image_file(source, target, base_params), repeat)
+
+
+def bench_batch(inputs: dict, workers: int, directory: str, results: dict, base_params=DEFAULT_WATERMARK_PARAMS):
+    output_dir = os.path.join(directory, f"batch_out_{workers}")
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [BatchTask(path, os.path.join(output_dir, os.path.basename(path)), base_params)
+             for path in inputs["batch"]]
+    started = time.perf_counter()
+    failed = sum(1 for result in run_batch(tasks, workers, log_level=logging.WARNING) if result.error is not None)
+    elapsed = time.perf_counter() - started
+    results[f"batch/workers={workers}"] = {
+        "images_per_s": round(len(tasks) / elapsed, 2), "seconds": round(elapsed, 3),
+        "images": len(tasks), "failed": failed,
+    }
+
+
+def _scenarios(sections, resolutions, max_workers: int) -> list[tuple[str, str, object]]:
+    """Сценарии в порядке запуска: (имя, группа замеров, разрешение или число процессов)."""
+    scenarios = [("font", "font", None)] if "font" in sections else []
+    for section in ("banner", "apply", "file"):
+        if section in sections:
+            scenarios += [(f"{section}/{width}x{height}", section, (width, height)) for width, height in resolutions]
+    if "batch" in sections:
+        workers = 1
+        while True:
+            scenarios.append((f"batch/workers={workers}", "batch", workers))
+            if workers >= max_workers:
+                break
+            workers = min(workers * 2, max_workers)
+    return scenarios
+
+
+def _run_scenario(section: str, argument, inputs: dict, repeat: int, directory: str, params) -> tuple[dict, dict]:
+    """Выполняется в свежем процессе: замеры одного сценария и пиковая память процесса."""
+    configure_logging(logging.WARNING)  # Лог обработки искажает замеры
+    results = {}
+    if section == "font":
+        bench_fonts(repeat, results, params)
+    elif section == "banner":
+        bench_banner(inputs, [argument], repeat, results, params)
+    elif section == "apply":
+        bench_apply(inputs, [argument], repeat, results, params)
+    elif section == "file":
+        bench_files(inputs, [argument], repeat, directory, results, params)
+    elif section == "batch":
+        bench_batch(inputs, argument, directory, results, params)
+    return results, peak_rss_mb()
+
+
+def run_benchmarks(quick: bool = False, max_workers: int | None = None, repeat: int | None = None,
+                   sections=SECTIONS) -> dict:
+    resolutions = QUICK_RESOLUTIONS if quick else RESOLUTIONS
+    repeat = repeat or (5 if quick else 15)
+    max_workers = max_workers or default_worker_count()
+    params = benchmark_params()
+    results, memory = {}, {}
+    directory = tempfile.mkdtemp(prefix="watermarks-bench-")
+    try:
+        inputs = generate_inputs(directory, resolutions, batch_size=16 if quick else 64)
+        for name, section, argument in _scenarios(sections, resolutions, max_workers):
+            # Свой процесс на сценарий: пиковая память не копится от прошлых замеров и кэшей
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                scenario_results, memory[name] = executor.submit(
+                    _run_scenario, section, argument, inputs, repeat, directory, params).result()
+            results.update(scenario_results)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "pillow": PIL.__version__, "numpy": np.__version__, "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "quick": quick, "repeat": repeat, "font_name": params.font_name,
+        },
+        "results": results,
+        "memory": memory,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_delta_ms: float = 0.5,
+            min_delta_mb: float = 5.0) -> list[str]:
+    """
+    Печатает сравнение с базой и возвращает ключи замеров, ставших хуже больше чем на threshold.
+    Замеры времени, выросшие меньше чем на min_delta_ms, и памяти, выросшие меньше чем
+    на min_delta_mb, регрессией не считаются - это шум. Память сравнивается по сценариям
+    (ключи memory/<сценарий>/<метрика>).
+    """
+    regressions = []
+    print(f"{'замер':<60}{'база':>12}{'сейчас':>12}{'изменение':>12}")
+    for key, metrics in current["results"].items():
+        old = baseline.get("results", {}).get(key)
+        if not old:
+            continue
+        if _LOWER_IS_BETTER in metrics and _LOWER_IS_BETTER in old:
+            before, after = old[_LOWER_IS_BETTER], metrics[_LOWER_IS_BETTER]
+            change = (after - before) / before if before else 0.0
+            significant = after - before >= min_delta_ms
+        elif _HIGHER_IS_BETTER in metrics and _HIGHER_IS_BETTER in old:
+            before, after = old[_HIGHER_IS_BETTER], metrics[_HIGHER_IS_BETTER]
+            change = (before - after) / before if before else 0.0  # Положительное - хуже
+            significant = True
+        else:
+            continue
+        flag = "  РЕГРЕССИЯ" if change > threshold and significant else ""
+        if flag:
+            regressions.append(key)
+        print(f"{key:<60}{before:>12.2f}{after:>12.2f}{change * 100:>+11.1f}%{flag}")
+
+    for scenario, metrics in current.get("memory", {}).items():
+        old = baseline.get("memory", {}).get(scenario)
+        if not isinstance(old, dict):
+            continue  # В старых отчётах память одна на весь прогон - сравнивать не с чем
+        for metric in _MEMORY_METRICS:
+            if metric not in metrics or not old.get(metric):
+                continue
+            before, after = old[metric], metrics[metric]
+            change = (after - before) / before
+            key = f"memory/{scenario}/{metric}"
+            flag = "  РЕГРЕССИЯ" if change > threshold and after - before >= min_delta_mb else ""
+            if flag:
+                regressions.append(key)
+            print(f"{key:<60}{before:>12.2f}{after:>12.2f}{change * 100:>+11.1f}%{flag}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Замеры производительности наложения знака.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="куда записать результаты (JSON)")
+    parser.add_argument("--baseline", help="JSON с результатами прошлой версии для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="насколько замер может стать хуже без отметки о регрессии (0.10 = 10%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                        help="меньший рост времени в миллисекундах не считается регрессией")
+    parser.add_argument("--min-delta-mb", type=float, default=5.0,
+                        help="меньший рост пиковой памяти в мегабайтах не считается регрессией")
+    parser.add_argument("--fail-on-regression", action="store_true", help="код возврата 1, если есть регрессии")
+    parser.add_argument("--quick", action="store_true", help="меньше разрешений и повторов (для CI)")
+    parser.add_argument("--repeat", type=int, help="повторов каждого замера")
+    parser.add_argument("--max-workers", type=int, help="до скольких процессов мерить пакетную обработку")
+    parser.add_argument("--only", nargs="+", choices=SECTIONS,
+                        help="запустить только эти группы замеров")
+    args = parser.parse_args(argv)
+
+    configure_logging(logging.WARNING)  # Лог обработки искажает замеры
+
+    report = run_benchmarks(args.quick, args.max_workers, args.repeat, args.only or SECTIONS)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output} ({len(report['results'])} замеров)")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold, args.min_delta_ms, args.min_delta_mb)
+        print(f"\nРегрессий: {len(regressions)}")
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
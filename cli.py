@@ -0,0 +1,396 @@
+"""
+Консольный (безоконный) режим пакетной обработки.
+
+Запуск:
+    python -m cli photos/ "shots/*.jpg" -o out/ --text "© Studio" --position "Нижний правый угол"
+    python -m cli photos/ -o out/ --preset web.json --workers 8
+    python -m cli photos/ -o out/ --variants variants.json
+    python -m cli photos/ -o out/ --stats stats.csv --profile-every 50 --profile-dir profiles/
+
+Модуль намеренно не импортирует PyQt6, чтобы быстро стартовать на серверах без дисплея.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+from utils import (WatermarkParams, DEFAULT_WATERMARK_PARAMS, COMPOSITING_BACKENDS, WATERMARK_POSITIONS,
+                   params_from_dict, set_compositing_backend)
+from batch import BatchTask, run_batch, default_worker_count, default_memory_budget
+from video import VIDEO_EXTENSIONS, is_video_file
+from pipeline import ImagePipeline, PipelineConfig
+from manifest import BatchManifest
+from variants import VariantTask, load_variants, make_variant_tasks
+from encoding import (EncodingOptions, EXTENSION_BY_FORMAT, JPEG_SUBSAMPLING, is_format_available,
+                      set_encoding_options)
+from instrumentation import InstrumentationConfig, RunStats, configure_logging
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp", ".avif")
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS + VIDEO_EXTENSIONS
+
+# Латинские синонимы для позиций, чтобы не набирать кириллицу в скриптах
+POSITION_ALIASES = {
+    "center": "Центр",
+    "top-left": "Верхний левый угол",
+    "top-right": "Верхний правый угол",
+    "bottom-left": "Нижний левый угол",
+    "bottom-right": "Нижний правый угол",
+    "tile": "Замостить",
+}
+
+# Параметр командной строки -> поле WatermarkParams
+PARAM_OPTIONS = {
+    "type": "watermark_type",
+    "text": "text",
+    "font": "font_name",
+    "font_size": "font_size_relative",
+    "position": "position",
+    "opacity": "opacity",
+    "offset_x": "offset_x",
+    "offset_y": "offset_y",
+    "image": "image_path",
+    "image_scale": "image_scale",
+    "tile_spacing": "tile_spacing",
+    "tile_angle": "tile_angle",
+    "tile_stagger": "tile_stagger",
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m cli", description="Пакетное наложение водяных знаков без GUI.")
+    parser.add_argument("inputs", nargs="+", help="файлы, маски (*.jpg, **/*.png) или папки с изображениями и видео")
+    parser.add_argument("-o", "--output-dir", required=True, help="папка для результатов")
+    parser.add_argument("-r", "--recursive", action="store_true", help="обходить папки рекурсивно")
+    parser.add_argument("-w", "--workers", type=int, default=default_worker_count(),
+                        help="число рабочих процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--memory-budget", type=int,
+                        help="сколько МБ могут занимать декодированные изображения в работе одновременно "
+                             "(по умолчанию - половина оперативной памяти, 0 - без ограничения)")
+    parser.add_argument("--prefix", default="watermarked_", help="префикс имён выходных файлов")
+    parser.add_argument("--preset", help="JSON-файл с параметрами водяного знака (поля WatermarkParams)")
+    parser.add_argument("--save-preset", help="сохранить итоговые параметры в JSON-файл")
+    parser.add_argument("--variants",
+                        help="JSON-файл с вариантами результата (пресет, шаблон имени, размер, см. variants.py): "
+                             "каждый исходник декодируется один раз, варианты кодируются параллельно")
+    parser.add_argument("--backend", choices=COMPOSITING_BACKENDS, default="pillow",
+                        help="чем смешивать знак: Pillow или NumPy (результат одинаковый, для сравнения скорости)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="конвейер в одном процессе: чтение, декодирование, знак, кодирование и запись параллельно")
+    parser.add_argument("--queue-depth", type=int, default=PipelineConfig().queue_depth,
+                        help="длина очередей между этапами конвейера")
+    parser.add_argument("--io-threads", type=int, default=PipelineConfig().readers,
+                        help="потоков чтения (и половина от этого - записи) в конвейере")
+    parser.add_argument("--read-mode", choices=["read", "mmap"], default="read",
+                        help="чтение файлов в конвейере: целиком (сетевые папки) или через mmap (локальный диск)")
+    parser.add_argument("--force", action="store_true",
+                        help="обработать все файлы заново, даже если результат по манифесту актуален")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="сравнивать исходники по хэшу содержимого, а не по размеру и времени изменения")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог рабочих процессов")
+    add_encoding_arguments(parser)
+
+    prof = parser.add_argument_group("замеры и профилирование")
+    prof.add_argument("--stats", metavar="FILE",
+                      help="сохранить время этапов и объём данных по каждому файлу (.csv или .json) "
+                           "и напечатать гистограммы этапов")
+    prof.add_argument("--profile-every", type=int, default=0, metavar="N",
+                      help="профилировать cProfile каждый N-й файл в каждом рабочем процессе (без --pipeline)")
+    prof.add_argument("--profile-dir", help="папка для файлов .prof профилируемых файлов")
+    prof.add_argument("--trace-memory", action="store_true",
+                      help="у профилируемых файлов замерять пик памяти Python-объектов (tracemalloc)")
+
+    add_watermark_arguments(parser)
+    return parser
+
+
+def add_encoding_arguments(parser: argparse.ArgumentParser):
+    """Флаги кодирования результата (общие для пакетного режима и watch.py), см. encoding_options."""
+    defaults = EncodingOptions()
+    enc = parser.add_argument_group("кодирование результата")
+    enc.add_argument("--format", choices=sorted(EXTENSION_BY_FORMAT),
+                     help="формат результатов (по умолчанию - как у исходника)")
+    enc.add_argument("--jpeg-quality", type=int, default=defaults.jpeg_quality, help="качество JPEG 1..95")
+    enc.add_argument("--jpeg-subsampling", choices=JPEG_SUBSAMPLING, default=defaults.jpeg_subsampling,
+                     help="субдискретизация цвета JPEG")
+    enc.add_argument("--progressive", action="store_true", help="прогрессивный JPEG")
+    enc.add_argument("--optimize", action="store_true",
+                     help="дополнительный проход оптимизации JPEG/PNG (меньше файл, дольше кодирование)")
+    enc.add_argument("--png-compress-level", type=int, choices=range(10), default=defaults.png_compress_level,
+                     metavar="0..9", help="уровень сжатия PNG (0 - быстрее всего, 9 - меньше всего)")
+    enc.add_argument("--webp-quality", type=int, default=defaults.webp_quality, help="качество WebP 0..100")
+    enc.add_argument("--webp-lossless", action="store_true", help="WebP без потерь")
+    enc.add_argument("--avif-quality", type=int, default=defaults.avif_quality, help="качество AVIF 0..100")
+    enc.add_argument("--strip-metadata", action="store_true", help="не переносить EXIF и ICC-профиль исходника")
+
+
+def add_watermark_arguments(parser: argparse.ArgumentParser):
+    """Флаги параметров водяного знака (общие для пакетного режима и watch.py), см. resolve_params."""
+    wm = parser.add_argument_group("параметры водяного знака (переопределяют пресет)")
+    wm.add_argument("--type", choices=["text", "image"])
+    wm.add_argument("--text")
+    wm.add_argument("--font", help="имя шрифта, например Arial")
+    wm.add_argument("--font-size", type=int, help="размер шрифта в процентах от высоты изображения")
+    wm.add_argument("--position", help="позиция: " + ", ".join(POSITION_ALIASES) + " или название из интерфейса")
+    wm.add_argument("--opacity", type=int, help="непрозрачность 0..255")
+    wm.add_argument("--offset-x", type=int)
+    wm.add_argument("--offset-y", type=int)
+    wm.add_argument("--image", help="файл баннера (для --type image)")
+    wm.add_argument("--image-scale", type=int, help="ширина баннера в процентах от ширины изображения")
+    wm.add_argument("--tile-spacing", type=int, help="для --position tile: промежуток между повторами в процентах "
+                                                     "от размера знака")
+    wm.add_argument("--tile-angle", type=int, help="для --position tile: поворот знака в градусах")
+    wm.add_argument("--tile-stagger", action=argparse.BooleanOptionalAction,
+                    help="для --position tile: сдвигать каждый второй ряд на полшага")
+
+
+def resolve_params(args) -> WatermarkParams:
+    params = DEFAULT_WATERMARK_PARAMS
+    if args.preset:
+        with open(args.preset, "r", encoding="utf-8") as f:
+            params = params_from_dict(json.load(f))
+    overrides = {field: getattr(args, option) for option, field in PARAM_OPTIONS.items()
+                 if getattr(args, option) is not None}
+    if "position" in overrides:
+        position = POSITION_ALIASES.get(overrides["position"].lower(), overrides["position"])
+        if position not in WATERMARK_POSITIONS:
+            raise ValueError(f"unknown position {overrides['position']!r} "
+                             f"(expected {', '.join(POSITION_ALIASES)} or {', '.join(WATERMARK_POSITIONS)})")
+        overrides["position"] = position
+    # Флаги проверяются так же, как пресет: ошибка видна при запуске, а не на каждом файле
+    return params_from_dict(overrides, base=params)
+
+
+def collect_inputs(patterns, recursive: bool = False) -> list[str]:
+    """Разворачивает маски и папки в список файлов без повторов, сохраняя порядок."""
+    seen, files = set(), []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            if recursive:
+                candidates = (os.path.join(root, name) for root, _, names in os.walk(pattern) for name in sorted(names))
+            else:
+                candidates = (os.path.join(pattern, name) for name in sorted(os.listdir(pattern)))
+        else:
+            candidates = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in candidates:
+            if not path.lower().endswith(MEDIA_EXTENSIONS) or not os.path.isfile(path):
+                continue
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                files.append(path)
+    return files
+
+
+def encoding_options(args) -> EncodingOptions:
+    return EncodingOptions(
+        jpeg_quality=args.jpeg_quality, jpeg_subsampling=args.jpeg_subsampling, jpeg_progressive=args.progressive,
+        optimize=args.optimize, png_compress_level=args.png_compress_level, webp_quality=args.webp_quality,
+        webp_lossless=args.webp_lossless, avif_quality=args.avif_quality, keep_metadata=not args.strip_metadata,
+    )
+
+
+def check_params(params: WatermarkParams) -> str | None:
+    """Текст ошибки, если с такими параметрами рисовать нечего."""
+    if params.watermark_type == "text" and not params.text:
+        return "Не задан текст водяного знака (--text)."
+    if params.watermark_type == "image" and not (params.image_path and os.path.exists(params.image_path)):
+        return "Не найден файл баннера (--image)."
+    return None
+
+
+def describe_outputs(task) -> str:
+    if isinstance(task, VariantTask):
+        return ", ".join(output.result_path for output in task.outputs)
+    return task.result_path
+
+
+def common_input_dir(files) -> str | None:
+    """Общая папка исходников; None - общей нет (разные диски в Windows)."""
+    try:
+        return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in files]) if files else None
+    except ValueError:
+        return None
+
+
+def make_tasks(files, output_dir: str, params: WatermarkParams, prefix: str,
+               extension: str | None = None, root: str | None = None) -> list[BatchTask]:
+    """
+    extension - расширение результатов (например, ".webp"); None - как у исходника.
+    Подпапки исходников относительно root (по умолчанию - их общей папки) повторяются
+    в output_dir, поэтому одноимённые файлы из разных папок (-r) не затирают друг друга.
+    Файлы из одной папки, как и раньше, попадают прямо в output_dir.
+    """
+    root = os.path.abspath(root) if root else common_input_dir(files)
+    tasks = []
+    for image_file in files:
+        base_name, ext = os.path.splitext(os.path.basename(image_file))
+        if extension and not is_video_file(image_file):
+            ext = extension
+        subdir = os.path.relpath(os.path.dirname(os.path.abspath(image_file)), root) if root else ""
+        if subdir == os.curdir or subdir.startswith(os.pardir):
+            subdir = ""  # Файл в самой root или вне её
+        tasks.append(BatchTask(image_file, os.path.join(output_dir, subdir, f"{prefix}{base_name}{ext}"), params))
+    return tasks
+
+
+def check_output_collisions(tasks) -> str | None:
+    """
+    Текст ошибки, если у двух исходников один и тот же результат (например, photo.jpg
+    и photo.png при --format webp): второй молча затёр бы первый и его запись в манифесте.
+    """
+    sources = {}
+    for task in tasks:
+        outputs = [output.result_path for output in task.outputs] if isinstance(task, VariantTask) else [task.result_path]
+        for result_path in outputs:
+            key = os.path.normcase(os.path.abspath(result_path))
+            if key in sources and sources[key] != task.image_path:
+                return f"Одинаковое имя результата {result_path} у файлов {sources[key]} и {task.image_path}."
+            sources[key] = task.image_path
+    return None
+
+
+def instrumentation_config(args) -> InstrumentationConfig | None:
+    """Замеры включаются, только если о них попросили: без них обработка не платит ни за что."""
+    if not (args.stats or args.profile_every or args.trace_memory):
+        return None
+    profile_every = args.profile_every or (1 if args.trace_memory else 0)
+    return InstrumentationConfig(profile_every, args.profile_dir, args.trace_memory)
+
+
+def print_summary(stage_times: dict, processed: int, failed: int, elapsed: float, encoded: dict | None = None):
+    print(f"\nГотово: {processed - failed} успешно, {failed} с ошибками, {elapsed:.2f} с "
+          f"({processed / elapsed if elapsed > 0 else 0:.1f} файлов/с)")
+    if not stage_times:
+        return
+    print(f"{'этап':<12}{'всего, с':>12}{'среднее, мс':>14}{'макс, мс':>12}")
+    for stage, values in stage_times.items():
+        print(f"{stage:<12}{sum(values):>12.2f}{sum(values) / len(values) * 1000:>14.1f}{max(values) * 1000:>12.1f}")
+    if encoded:
+        # Сколько стоит кодирование в каждом формате - чтобы выбрать самые дешёвые настройки
+        print(f"\n{'формат':<8}{'файлов':>8}{'МБ':>10}{'средний, КБ':>13}{'кодирование, мс':>17}{'МБ/с':>8}")
+        for fmt, entries in encoded.items():
+            seconds = sum(entry[0] for entry in entries)
+            nbytes = sum(entry[1] for entry in entries)
+            print(f"{fmt:<8}{len(entries):>8}{nbytes / 2 ** 20:>10.2f}{nbytes / len(entries) / 1024:>13.1f}"
+                  f"{seconds / len(entries) * 1000:>17.1f}{nbytes / 2 ** 20 / seconds if seconds > 0 else 0:>8.1f}")
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    configure_logging(logging.DEBUG if args.verbose else logging.WARNING)
+
+    try:
+        params = resolve_params(args)
+        variants = load_variants(args.variants, params) if args.variants else None
+    except (OSError, ValueError) as e:
+        print(f"Ошибка в параметрах: {e}", file=sys.stderr)
+        return 2
+    if args.format and not is_format_available(args.format):
+        print(f"Установленный Pillow не умеет сохранять {args.format.upper()}.", file=sys.stderr)
+        return 2
+    if variants and args.pipeline:
+        print("--variants пока не поддерживается вместе с --pipeline.", file=sys.stderr)
+        return 2
+    for variant_params in [variant.params for variant in variants] if variants else [params]:
+        error = check_params(variant_params)
+        if error:
+            print(error, file=sys.stderr)
+            return 2
+    if args.save_preset:
+        with open(args.save_preset, "w", encoding="utf-8") as f:
+            json.dump(params._asdict(), f, ensure_ascii=False, indent=2)
+
+    files = collect_inputs(args.inputs, args.recursive)
+    if not files:
+        print("Не найдено ни одного изображения.", file=sys.stderr)
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+    if variants:
+        tasks = make_variant_tasks(files, args.output_dir, variants)
+    else:
+        tasks = make_tasks(files, args.output_dir, params, args.prefix, EXTENSION_BY_FORMAT.get(args.format))
+    error = check_output_collisions(tasks)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+
+    # Уже обработанные файлы с теми же параметрами пропускаем (если не задан --force)
+    encoding = encoding_options(args)
+    manifest = BatchManifest(args.output_dir, content_hash=args.content_hash, encoding=encoding)
+    if not args.force:
+        tasks, skipped = manifest.pending_tasks(tasks)
+        if skipped:
+            print(f"Пропущено без изменений: {skipped}")
+        if not tasks:
+            print("Все результаты актуальны, обрабатывать нечего.")
+            return 0
+    else:
+        # В манифест попадёт состояние исходников на момент запуска, а не после обработки
+        for task in tasks:
+            manifest.capture(task)
+
+    total, processed, failed = len(tasks), 0, 0
+    stage_times, encoded = {}, {}
+    instrumentation = instrumentation_config(args)
+    stats = RunStats() if instrumentation is not None else None
+    started = time.perf_counter()
+    pipeline = None
+    if args.memory_budget is None:
+        memory_budget = default_memory_budget()
+    else:
+        memory_budget = args.memory_budget * 2 ** 20 or None
+    if args.pipeline:
+        set_compositing_backend(args.backend)
+        set_encoding_options(encoding)
+        pipeline = ImagePipeline(PipelineConfig(
+            readers=args.io_threads, decoders=args.workers, compositors=args.workers, encoders=args.workers,
+            writers=max(1, args.io_threads // 2), queue_depth=args.queue_depth, read_mode=args.read_mode),
+            memory_budget=memory_budget)
+        results = pipeline.run(tasks)
+    else:
+        results = run_batch(tasks, args.workers, log_level=logging.getLogger().level, backend=args.backend,
+                            memory_budget=memory_budget, encoding=encoding, instrumentation=instrumentation)
+    try:
+        for result in results:
+            processed += 1
+            if stats is not None:
+                stats.add(result)
+            if result.error is None:
+                manifest.record(result.task)
+                timings = dict(result.timings)
+                frames = timings.pop("frames", None)
+                timings.pop("details", None)
+                for fmt, seconds, nbytes in timings.pop("encoded", []):
+                    encoded.setdefault(fmt, []).append((seconds, nbytes))
+                # Для видео дополнительно печатаем скорость в кадрах в секунду
+                speed = f" ({frames / sum(timings.values()):.1f} fps)" if frames and sum(timings.values()) > 0 else ""
+                print(f"[{processed}/{total}] OK    {result.task.image_path} -> {describe_outputs(result.task)}{speed}",
+                      flush=True)
+                for stage, seconds in timings.items():
+                    stage_times.setdefault(stage, []).append(seconds)
+            else:
+                failed += 1
+                manifest.forget(result.task)
+                print(f"[{processed}/{total}] ERROR {result.task.image_path}: {result.error}", flush=True)
+    finally:
+        # Манифест сохраняется и при Ctrl+C, чтобы следующий запуск продолжил с того же места
+        manifest.save()
+    print_summary(stage_times, processed, failed, time.perf_counter() - started, encoded)
+    if pipeline is not None:
+        print("\nЗагрузка этапов конвейера:")
+        print(pipeline.report())
+    if stats is not None and stats.records:
+        print("\nГистограммы этапов:")
+        print(stats.format_histograms())
+        if args.stats:
+            stats.export(args.stats)
+            print(f"\nЗамеры записаны в {args.stats}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+Смешивание водяного знака с кадрами на NumPy.
+
+Повторяет целочисленную арифметику Image.alpha_composite из Pillow, поэтому
+результат совпадает с Pillow бит в бит. Знак домножается на свою альфу один раз,
+после чего на каждый кадр остаётся одно умножение, сложение и деление на 255
+сдвигами. Можно обрабатывать сразу стопку кадров одного размера (N, H, W, C) -
+например, серию снимков с одной камеры.
+
+Замощение (NumpyTileWatermark) хранит подготовленным только сам знак (или небольшой
+блок мелкого узора) и накладывает его по сетке, поэтому память не зависит от размера кадра.
+"""
+import numpy as np
+from PIL import Image
+
+
+COMPOSITING_BACKENDS = ("pillow", "numpy")
+
+# Точность фиксированной запятой в AlphaComposite.c (Pillow)
+_PRECISION_BITS = 7
+
+# Сколько пикселей кадра переносить в NumPy за раз: временные массивы uint32 занимают
+# по 12 байт на пиксель, поэтому большой знак (замощение) смешивается полосами
+COMPOSITE_STRIP_PIXELS = 2 ** 20
+
+
+def _div255(values: np.ndarray) -> np.ndarray:
+    """Деление на 255 с округлением так же, как SHIFTFORDIV255 в Pillow."""
+    return ((values >> 8) + values) >> 8
+
+
+class NumpyWatermark:
+    """
+    Знак, подготовленный для кадров размером frame_size.
+
+    tile - RGBA-плитка знака, (x, y) - её левый верхний угол на кадре. Плитка сразу
+    обрезается по границам кадра; box - итоговая рамка или None, если знак целиком за кадром.
+    """
+
+    def __init__(self, tile: Image.Image, x: int, y: int, frame_size: tuple[int, int]):
+        width, height = frame_size
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + tile.width, width), min(y + tile.height, height)
+        self.box = (left, top, right, bottom) if right > left and bottom > top else None
+        if self.box is None:
+            return
+
+        rgba = np.asarray(tile.crop((left - x, top - y, right - x, bottom - y)).convert("RGBA"), dtype=np.uint32)
+        self._src = rgba[..., :3]
+        self._src_alpha = rgba[..., 3:4]
+        # Для непрозрачного фона coef1 = a * 128 и coef2 = (255 - a) * 128 - считаем их один раз
+        self._premultiplied = self._src * self._src_alpha * (1 << _PRECISION_BITS) + (0x80 << _PRECISION_BITS)
+        self._inverse_alpha = (255 - self._src_alpha) * (1 << _PRECISION_BITS)
+
+    def apply_region(self, region: np.ndarray, offset: tuple[int, int] = (0, 0)) -> np.ndarray:
+        """
+        Смешивает знак с массивом (..., h, w, 3|4) uint8 - на месте. region - часть box,
+        начинающаяся в offset (dy, dx) от его левого верхнего угла; по умолчанию - весь box.
+        Для 4 каналов альфа фона учитывается так же, как в Image.alpha_composite.
+        """
+        dy, dx = offset
+        window = (slice(dy, dy + region.shape[-3]), slice(dx, dx + region.shape[-2]))
+        src, src_alpha = self._src[window], self._src_alpha[window]
+        if region.shape[-1] == 3 or np.all(region[..., 3] == 255):
+            # То же, что _div255(...) >> _PRECISION_BITS, но без лишних временных массивов
+            blended = region[..., :3] * self._inverse_alpha[window]
+            blended += self._premultiplied[window]
+            blended += blended >> 8
+            blended >>= 8 + _PRECISION_BITS
+            region[..., :3] = blended
+            return region
+
+        dst_alpha = region[..., 3:4].astype(np.uint32)
+        out_alpha255 = src_alpha * 255 + dst_alpha * (255 - src_alpha)
+        coef1 = (src_alpha * (255 * 255 << _PRECISION_BITS)) // np.maximum(out_alpha255, 1)
+        coef2 = (255 << _PRECISION_BITS) - coef1
+        blended = src * coef1 + region[..., :3] * coef2 + (0x80 << _PRECISION_BITS)
+        color = _div255(blended) >> _PRECISION_BITS
+        alpha = _div255(out_alpha255 + 0x80)
+        # Там, где знак полностью прозрачен, Pillow оставляет пиксель фона как есть
+        transparent = src_alpha == 0
+        region[..., :3] = np.where(transparent, region[..., :3], color)
+        region[..., 3:4] = np.where(transparent, dst_alpha, alpha)
+        return region
+
+    def apply(self, frames: np.ndarray) -> np.ndarray:
+        """Смешивает знак с кадром (H, W, C) или стопкой кадров (N, H, W, C) - на месте."""
+        if self.box is not None:
+            left, top, right, bottom = self.box
+            self.apply_region(frames[..., top:bottom, left:right, :])
+        return frames
+
+
+class NumpyTileWatermark:
+    """
+    Замощение кадров размером frame_size. tile - RGBA-плитка, которая ставится в точки
+    places (dx, dy) каждого периода period (width, height); origin (x, y) - угол одного
+    из периодов на кадре. Повторы не должны перекрываться. Подготовлена (как NumpyWatermark)
+    только сама плитка, по кадру она накладывается по сетке - без слоя и временных массивов
+    размером с кадр. box - весь кадр.
+    """
+
+    def __init__(self, tile: Image.Image, places, period: tuple[int, int], origin: tuple[int, int],
+                 frame_size: tuple[int, int]):
+        self._tile = NumpyWatermark(tile, 0, 0, tile.size)
+        self._places = [(origin[0] + dx, origin[1] + dy) for dx, dy in places]
+        self._period = period
+        self.box = (0, 0) + tuple(frame_size) if self._tile.box is not None and all(frame_size) else None
+
+    def apply_region(self, region: np.ndarray, offset: tuple[int, int] = (0, 0)) -> np.ndarray:
+        """Смешивает узор с частью кадра (..., h, w, 3|4), начинающейся в offset (dy, dx) - на месте."""
+        top, left = offset
+        bottom, right = top + region.shape[-3], left + region.shape[-2]
+        tile_w, tile_h = self._tile.box[2], self._tile.box[3]
+        period_x, period_y = self._period
+        for place_x, place_y in self._places:
+            # Первые повторы, которые ещё задевают область слева и сверху
+            start_x = left - (left - place_x) % period_x
+            start_y = top - (top - place_y) % period_y
+            start_x -= (tile_w - 1) // period_x * period_x
+            start_y -= (tile_h - 1) // period_y * period_y
+            for y in range(start_y, bottom, period_y):
+                y0, y1 = max(y, top), min(y + tile_h, bottom)
+                if y1 <= y0:
+                    continue
+                for x in range(start_x, right, period_x):
+                    x0, x1 = max(x, left), min(x + tile_w, right)
+                    if x1 > x0:
+                        self._tile.apply_region(region[..., y0 - top:y1 - top, x0 - left:x1 - left, :],
+                                                (y0 - y, x0 - x))
+        return region
+
+    def apply(self, frames: np.ndarray) -> np.ndarray:
+        """Смешивает узор с кадром (H, W, C) или стопкой кадров (N, H, W, C) - на месте."""
+        if self.box is not None:
+            self.apply_region(frames)
+        return frames
+
+
+def composite_image_numpy(base_image: Image.Image, watermark: NumpyWatermark | NumpyTileWatermark) -> Image.Image:
+    """
+    Смешивает знак с RGB/RGBA-изображением на месте: в NumPy переносится только рамка знака,
+    большая рамка - полосами по COMPOSITE_STRIP_PIXELS.
+    """
+    if watermark.box is None:
+        return base_image
+    left, top, right, bottom = watermark.box
+    rows = max(1, COMPOSITE_STRIP_PIXELS // (right - left))
+    for y in range(top, bottom, rows):
+        strip = (left, y, right, min(y + rows, bottom))
+        region = np.array(base_image.crop(strip))
+        watermark.apply_region(region, (y - top, 0))
+        base_image.paste(Image.fromarray(region, base_image.mode), strip[:2])
+    return base_image
+
+
+def composite_stack_numpy(images: list[Image.Image],
+                          watermark: NumpyWatermark | NumpyTileWatermark) -> list[Image.Image]:
+    """
+    Смешивает знак с несколькими RGB/RGBA-изображениями одного размера и режима за один проход:
+    рамки всех кадров собираются в один массив (N, h, w, C).
+    """
+    if watermark.box is None or not images:
+        return images
+    regions = np.stack([np.asarray(image.crop(watermark.box)) for image in images])
+    watermark.apply_region(regions)
+    for image, region in zip(images, regions):
+        image.paste(Image.fromarray(region, image.mode), watermark.box[:2])
+    return images
@@ -0,0 +1,674 @@
+"""
+Пакетная обработка на нескольких машинах через общую папку-очередь (NFS, SMB и т.п.).
+Кроме общей файловой системы узлам ничего не нужно: ни брокера, ни сети между ними.
+
+Запуск:
+    python -m distributed submit /mnt/queue/night /mnt/archive/ -r -o /mnt/out --preset web.json
+    python -m distributed work /mnt/queue/night -w 16      # на каждой машине, сколько угодно раз
+    python -m distributed status /mnt/queue/night --wait
+
+submit раскладывает файлы по шардам (--shards) по хэшу пути: состав шардов зависит
+только от списка файлов, поэтому повторный submit того же задания ничего не меняет.
+Пути сохраняются абсолютными - общая папка должна быть смонтирована на всех узлах
+по одному и тому же пути.
+
+work берёт шард в аренду: файл аренды создаётся атомарно (os.link готового файла,
+где ссылок нет - O_EXCL), и второй узел получает FileExistsError. Аренда действует
+--lease секунд от времени изменения файла; пока шард в работе, владелец каждую треть
+--lease сдвигает это время через свой открытый дескриптор, а сам файл не переписывает.
+Узел, который упал или потерял сеть, перестаёт продлевать аренду, и через --lease
+секунд шард забирает другой узел. Просроченная аренда сначала переименовывается (это
+атомарно, и забрать её может только один узел), а потом заменяется своей. Старый
+владелец видит по номеру inode, что файл аренды уже не его, и прекращает работу, не
+трогая чужую аренду и progress/. Сделанные файлы шарда отмечаются в progress/ (не реже
+CHECKPOINT_INTERVAL), так что новый владелец продолжает с места остановки. Результаты
+пишутся атомарно (utils.atomic_output), поэтому файл, обработанный дважды после
+перехвата аренды, просто перезаписывается тем же самым. Временные файлы результатов
+уникальны для узла и процесса, а недописанные файлы упавшего владельца новый владелец
+удаляет (utils.remove_partial_outputs). Часы узлов должны расходиться
+намного меньше, чем на --lease.
+
+status сводит состояние всех шардов и узлов: сколько файлов готово, сколько с ошибками,
+скорость каждого узла и общая, оценка оставшегося времени.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import socket
+import signal
+import hashlib
+import logging
+import argparse
+import threading
+
+from utils import params_from_dict, remove_partial_outputs
+from batch import BatchTask, run_batch, create_cancel_event, default_worker_count, default_memory_budget
+from encoding import EncodingOptions, EXTENSION_BY_FORMAT, is_format_available
+from instrumentation import configure_logging
+from cli import (add_encoding_arguments, add_watermark_arguments, check_output_collisions, check_params,
+                 collect_inputs, encoding_options, make_tasks, resolve_params)
+
+
+DEFAULT_SHARDS = 64
+# Срок аренды шарда, с: столько ждут, прежде чем забрать шард у упавшего узла
+DEFAULT_LEASE_SECONDS = 60.0
+# Как часто сохранять сделанные файлы шарда и счётчики узла, с
+CHECKPOINT_INTERVAL = 5.0
+# После стольких перехватов просроченной аренды оставшиеся файлы шарда считаются ошибкой (файл, на котором падает узел)
+DEFAULT_MAX_ATTEMPTS = 3
+# Сколько ошибок показывать в status
+MAX_REPORTED_ERRORS = 20
+
+
+def _read_json(path: str) -> dict | None:
+    """Содержимое JSON-файла; None, если файла нет или он недописан."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_json(path: str, data: dict):
+    # Временное имя уникально для узла и процесса: в общую папку пишут сразу несколько машин
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def shard_of(image_path: str, shards: int) -> int:
+    """Номер шарда файла. crc32, а не hash(): результат одинаков на всех узлах и при любом PYTHONHASHSEED."""
+    return zlib.crc32(image_path.encode("utf-8")) % shards
+
+
+class Lease:
+    """
+    Аренда шарда узлом. fd - открытый файл аренды: продление меняет время изменения
+    именно этого файла, поэтому файл, который уже заменил другой узел, не затрагивается.
+    takeover - шард достался после перехвата просроченной аренды.
+    """
+
+    def __init__(self, queue: "WorkQueue", shard: str, node: str, fd: int, lease_seconds: float,
+                 takeover: bool = False):
+        self.queue, self.shard, self.node, self.fd = queue, shard, node, fd
+        self.lease_seconds, self.takeover = lease_seconds, takeover
+        self.path = queue.path("leases", f"{shard}.lease")
+        self._identity = self._touch()
+
+    def _touch(self) -> tuple:
+        # Время ставим своими часами, а не часами файлового сервера: так же считают и остальные узлы
+        now = time.time()
+        if os.utime in os.supports_fd:
+            os.utime(self.fd, (now, now))
+        else:
+            os.utime(self.path, (now, now))
+        stat = os.fstat(self.fd)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _current_identity(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def held(self) -> bool:
+        """Файл аренды всё ещё наш (его не переименовал и не заменил другой узел)."""
+        identity = self._current_identity()
+        return identity is not None and identity[0] == self._identity[0]
+
+    def renew(self) -> bool:
+        """
+        Продлевает аренду. False - файл аренды заменён или тронут другим узлом (другой inode
+        или время изменения), работу по шарду надо прекращать.
+        """
+        if self._current_identity() != self._identity:
+            return False
+        self._identity = self._touch()
+        return self.held()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def release(self):
+        """Снимает аренду, если она всё ещё наша."""
+        try:
+            if self.held():
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        finally:
+            self.close()
+
+
+class WorkQueue:
+    """
+    Папка-очередь задания:
+        job.json            - параметры знака и кодирования, папка результатов, список шардов
+        shards/<шард>.json  - файлы шарда: [[исходник, результат], ...]
+        leases/<шард>.lease - аренда: узел; действует --lease секунд от времени изменения файла
+        progress/<шард>.json - сделанные и ошибочные файлы шарда, число перехватов аренды
+        done/<шард>.json    - итог готового шарда
+        nodes/<узел>.json   - счётчики и состояние узла для status
+    """
+
+    SUBDIRECTORIES = ("shards", "leases", "progress", "done", "nodes")
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, *parts) -> str:
+        return os.path.join(self.root, *parts)
+
+    def job(self) -> dict | None:
+        return _read_json(self.path("job.json"))
+
+    def submit(self, tasks, shards: int, job: dict) -> bool:
+        """
+        Раскладывает задачи по шардам и записывает задание. job.json пишется последним,
+        поэтому узлы не увидят задание без шардов. False - то же задание уже в очереди;
+        другое задание в той же папке - ValueError.
+        """
+        grouped = {}
+        for task in tasks:
+            grouped.setdefault(f"shard-{shard_of(task.image_path, shards):05d}", []).append(
+                [task.image_path, task.result_path])
+        job = dict(job, shards=sorted(grouped), total_files=sum(len(files) for files in grouped.values()))
+        job["fingerprint"] = hashlib.sha1(json.dumps([job, grouped], sort_keys=True).encode("utf-8")).hexdigest()
+        existing = self.job()
+        if existing is not None:
+            if existing.get("fingerprint") == job["fingerprint"]:
+                return False
+            raise ValueError(f"{self.root} already holds another job")
+        for name in self.SUBDIRECTORIES:
+            os.makedirs(self.path(name), exist_ok=True)
+        for shard, files in grouped.items():
+            _write_json(self.path("shards", f"{shard}.json"), {"files": files})
+        _write_json(self.path("job.json"), job)
+        return True
+
+    def files(self, shard: str) -> list:
+        data = _read_json(self.path("shards", f"{shard}.json"))
+        if data is None:
+            raise OSError(f"Cannot read shard {shard} in {self.root}")
+        return data["files"]
+
+    def is_done(self, shard: str) -> bool:
+        return os.path.exists(self.path("done", f"{shard}.json"))
+
+    @staticmethod
+    def _lease_expires(path: str, lease_seconds: float) -> float:
+        """Когда истекает аренда: время изменения файла плюс срок аренды."""
+        return os.stat(path).st_mtime + lease_seconds
+
+    @staticmethod
+    def _break_expired(path: str, lease_seconds: float) -> bool:
+        """
+        Убирает просроченную аренду. Переименование атомарно, поэтому из нескольких узлов
+        аренду забирает только один. Переименование сохраняет время изменения: если владелец
+        успел продлить аренду, она возвращается на место.
+        """
+        stale_path = f"{path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True  # Аренду уже сняли
+        try:
+            if WorkQueue._lease_expires(stale_path, lease_seconds) > time.time():
+                try:
+                    os.link(stale_path, path)
+                except FileExistsError:
+                    pass
+                return False
+            return True
+        finally:
+            os.remove(stale_path)
+
+    @staticmethod
+    def _create_lease_file(path: str, record: dict) -> int | None:
+        """Атомарно создаёт файл аренды и возвращает открытый дескриптор; None - файл уже есть."""
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL)
+        try:
+            os.write(fd, json.dumps(record).encode("utf-8"))
+            os.link(tmp_path, path)
+            return fd
+        except FileExistsError:
+            os.close(fd)
+            return None
+        except OSError:
+            os.close(fd)  # Файловая система без жёстких ссылок
+        finally:
+            os.remove(tmp_path)
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return None
+        os.write(fd, json.dumps(record).encode("utf-8"))
+        return fd
+
+    def claim(self, shard: str, node: str, lease_seconds: float) -> Lease | None:
+        """
+        Берёт шард в аренду. None - шард занят другим узлом (аренда не просрочена) или перехвачен.
+        Перехват просроченной аренды засчитывается шарду в progress/ (takeovers).
+        """
+        path = self.path("leases", f"{shard}.lease")
+        previous = None
+        try:
+            if self._lease_expires(path, lease_seconds) > time.time():
+                return None
+            previous = _read_json(path) or {}
+            if not self._break_expired(path, lease_seconds):
+                return None
+        except FileNotFoundError:
+            pass  # Аренды нет или её сняли, пока мы её читали
+        fd = self._create_lease_file(path, {"node": node, "started": time.time()})
+        if fd is None:
+            return None
+        lease = Lease(self, shard, node, fd, lease_seconds, takeover=previous is not None)
+        if lease.takeover:
+            logging.warning(f"Lease on {shard} held by {previous.get('node', '?')} expired, taking over")
+            progress = self.read_progress(shard)
+            progress["takeovers"] += 1
+            self.write_progress(shard, progress)
+        return lease
+
+    def read_progress(self, shard: str) -> dict:
+        progress = _read_json(self.path("progress", f"{shard}.json")) or {}
+        return {"takeovers": progress.get("takeovers", 0), "done": progress.get("done", []),
+                "failed": progress.get("failed", {})}
+
+    def write_progress(self, shard: str, progress: dict):
+        _write_json(self.path("progress", f"{shard}.json"), progress)
+
+    def finish(self, lease: Lease, summary: dict):
+        """Отмечает шард готовым. Итог пишется до снятия аренды, чтобы шард не взяли повторно."""
+        if not lease.held():
+            lease.close()
+            return  # Шард уже у другого узла, итог запишет он
+        _write_json(self.path("done", f"{lease.shard}.json"), summary)
+        try:
+            os.remove(self.path("progress", f"{lease.shard}.json"))
+        except FileNotFoundError:
+            pass
+        lease.release()
+
+    def write_node(self, node: str, stats: dict):
+        _write_json(self.path("nodes", node.replace(os.sep, "_") + ".json"), stats)
+
+    def status(self) -> dict:
+        """Сводка по всем шардам и узлам (см. print_status)."""
+        job = self.job()
+        now = time.time()
+        shards = {"total": len(job["shards"]), "done": 0, "leased": 0, "expired": 0, "pending": 0}
+        processed = failed = 0
+        errors = []
+        for shard in job["shards"]:
+            summary = _read_json(self.path("done", f"{shard}.json"))
+            if summary is not None:
+                shards["done"] += 1
+                processed += summary["processed"]
+                failed += len(summary["failed"])
+                errors.extend(summary["failed"])
+                continue
+            progress = self.read_progress(shard)
+            processed += len(progress["done"])
+            failed += len(progress["failed"])
+            lease_path = self.path("leases", f"{shard}.lease")
+            try:
+                expires = self._lease_expires(lease_path, job["lease_seconds"])
+                shards["leased" if expires > now else "expired"] += 1
+            except FileNotFoundError:
+                shards["pending"] += 1
+
+        nodes = []
+        for name in sorted(os.listdir(self.path("nodes"))):
+            stats = _read_json(self.path("nodes", name)) if name.endswith(".json") else None
+            if stats is None:
+                continue
+            elapsed = max(stats["updated"] - stats["started"], 1e-9)
+            # Работающий узел, который давно не отчитывался, скорее всего упал
+            lost = stats["state"] not in ("finished", "stopped") and now - stats["updated"] > job["lease_seconds"]
+            nodes.append(dict(stats, per_minute=round(stats["processed"] * 60.0 / elapsed, 1),
+                              state="lost" if lost else stats["state"]))
+
+        per_minute = 0.0
+        if nodes:
+            elapsed = max(max(n["updated"] for n in nodes) - min(n["started"] for n in nodes), 1e-9)
+            per_minute = sum(n["processed"] for n in nodes) * 60.0 / elapsed
+        remaining = job["total_files"] - processed - failed
+        return {
+            "total_files": job["total_files"], "processed": processed, "failed": failed, "remaining": remaining,
+            "shards": shards, "nodes": nodes, "per_minute": round(per_minute, 1),
+            "eta_seconds": round(remaining * 60.0 / per_minute) if per_minute > 0 and remaining else None,
+            "errors": errors, "complete": shards["done"] == shards["total"],
+        }
+
+
+class DistributedWorker:
+    """Узел: берёт шарды в аренду по одному и обрабатывает их в пуле процессов (batch.run_batch)."""
+
+    def __init__(self, queue: WorkQueue, node: str, max_workers: int | None = None, poll_interval: float = 5.0,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, log_level: int | None = None):
+        self.queue, self.node = queue, node
+        self.max_workers, self.poll_interval, self.max_attempts = max_workers, poll_interval, max_attempts
+        self.log_level = log_level
+        self.job = queue.job()
+        self.params = params_from_dict(self.job["params"])
+        self.encoding = EncodingOptions(**self.job["encoding"])
+        self.cancel_event = create_cancel_event()
+        self._stop = threading.Event()
+        self.stats = {"node": node, "host": socket.gethostname(), "pid": os.getpid(), "started": time.time(),
+                      "updated": time.time(), "state": "starting", "shard": None,
+                      "processed": 0, "failed": 0, "shards_done": 0}
+
+    def stop(self):
+        """Прерывает файлы в работе; сделанное сохраняется, аренда снимается, чтобы шард сразу взял другой узел."""
+        self._stop.set()
+        self.cancel_event.set()
+
+    def _report(self, state: str, shard: str | None = None):
+        self.stats.update(state=state, shard=shard, updated=time.time())
+        self.queue.write_node(self.node, self.stats)
+
+    def _shard_order(self) -> list[str]:
+        # Узлы начинают с разных шардов, чтобы реже сталкиваться при захвате
+        shards = self.job["shards"]
+        start = zlib.crc32(self.node.encode("utf-8")) % len(shards) if shards else 0
+        return shards[start:] + shards[:start]
+
+    def _next_lease(self) -> Lease | None:
+        """Следующий шард в аренду; None - свободных нет (все готовы или заняты)."""
+        for shard in self._shard_order():
+            if self._stop.is_set():
+                return None
+            if self.queue.is_done(shard):
+                continue
+            lease = self.queue.claim(shard, self.node, self.job["lease_seconds"])
+            if lease is None:
+                continue
+            if self.queue.is_done(shard):
+                lease.release()  # Шард закончили, пока мы его захватывали
+                continue
+            return lease
+        return None
+
+    def run(self) -> int:
+        """Работает, пока в очереди есть шарды. Возвращает число файлов с ошибками на этом узле."""
+        try:
+            while not self._stop.is_set():
+                lease = self._next_lease()
+                if lease is not None:
+                    self._process(lease)
+                    continue
+                if all(self.queue.is_done(shard) for shard in self.job["shards"]):
+                    break
+                # Остальные шарды заняты другими узлами: ждём, не просрочится ли чья-то аренда
+                self._report("waiting")
+                self._stop.wait(self.poll_interval)
+        finally:
+            self._report("finished" if not self._stop.is_set() else "stopped")
+        return self.stats["failed"]
+
+    def _heartbeat(self, lease: Lease, finished: threading.Event, lost: threading.Event):
+        while not finished.wait(lease.lease_seconds / 3):
+            try:
+                renewed = lease.renew()
+            except OSError as e:
+                logging.warning(f"Cannot renew lease on {lease.shard}: {e}")
+                continue  # Сеть могла моргнуть; аренда ещё действует до expires
+            if not renewed:
+                lost.set()
+                logging.warning(f"Lease on {lease.shard} was taken over by another node, stopping")
+                self.cancel_event.set()
+                return
+
+    def _checkpoint(self, lease: Lease, progress: dict, done: set) -> bool:
+        """Сохраняет сделанное по шарду, если аренда всё ещё наша. False - шард перехвачен."""
+        if not lease.held():
+            return False
+        self.queue.write_progress(lease.shard, dict(progress, done=sorted(done)))
+        return True
+
+    def _process(self, lease: Lease):
+        shard = lease.shard
+        started = time.time()
+        files = self.queue.files(shard)
+        # Попытки считает claim() при перехвате аренды; обычная остановка и снятие аренды их не тратят
+        progress = self.queue.read_progress(shard)
+        progress["node"] = self.node
+        done, failed = set(progress["done"]), progress["failed"]
+        index_by_source = {image_path: index for index, (image_path, _) in enumerate(files)}
+        pending = [index for index in range(len(files)) if index not in done and str(index) not in failed]
+        if progress["takeovers"] >= self.max_attempts:
+            # Шард снова и снова теряет владельца - скорее всего, узел падает на одном из файлов
+            logging.error(f"{shard}: giving up on {len(pending)} files after {progress['takeovers']} lease takeovers")
+            for index in pending:
+                failed[str(index)] = f"Gave up after {progress['takeovers']} lease takeovers"
+            self.stats["failed"] += len(pending)
+            pending = []
+        if not self._checkpoint(lease, progress, done):
+            lease.close()
+            return
+        if lease.takeover:
+            # Прежний владелец мог погибнуть посреди записи - его временные файлы лежат рядом с результатами
+            removed = remove_partial_outputs(files[index][1] for index in pending)
+            if removed:
+                logging.info(f"{shard}: removed {removed} partial results left by the previous owner")
+        logging.info(f"{shard}: claimed ({progress['takeovers']} takeovers), {len(pending)} of {len(files)} files left")
+        self._report("working", shard)
+
+        finished, lost = threading.Event(), threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(lease, finished, lost), daemon=True)
+        heartbeat.start()
+        self.cancel_event.clear()
+        if self._stop.is_set():
+            self.cancel_event.set()  # stop() пришёл до начала шарда
+        tasks = [BatchTask(files[index][0], files[index][1], self.params) for index in pending]
+        results = run_batch(tasks, self.max_workers, log_level=self.log_level, backend=self.job["backend"],
+                            cancel_event=self.cancel_event, memory_budget=default_memory_budget(),
+                            encoding=self.encoding)
+        next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+        try:
+            for result in results:
+                index = index_by_source[result.task.image_path]
+                if result.error is None:
+                    done.add(index)
+                    self.stats["processed"] += 1
+                else:
+                    failed[str(index)] = result.error
+                    self.stats["failed"] += 1
+                    logging.warning(f"{shard}: {result.task.image_path}: {result.error}")
+                if time.monotonic() >= next_checkpoint and not lost.is_set():
+                    self._checkpoint(lease, progress, done)
+                    self._report("working", shard)
+                    next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+        finally:
+            results.close()
+            finished.set()
+            heartbeat.join()
+
+        if lost.is_set():
+            lease.close()
+            return  # Шард продолжает новый владелец; наши сделанные файлы он тоже сделает (результат тот же)
+        if self._stop.is_set() and len(done) + len(failed) < len(files):
+            self._checkpoint(lease, progress, done)
+            lease.release()
+            logging.info(f"{shard}: stopped, {len(done)} of {len(files)} files done")
+            return
+        self.queue.finish(lease, {
+            "node": self.node, "processed": len(done), "takeovers": progress["takeovers"],
+            "failed": [{"file": files[int(index)][0], "error": error} for index, error in sorted(failed.items())],
+            "elapsed_seconds": round(time.time() - started, 3),
+        })
+        self.stats["shards_done"] += 1
+        logging.info(f"{shard}: done, {len(done)} files, {len(failed)} failed, {time.time() - started:.1f} s")
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f} ч"
+    if seconds >= 60:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds:.0f} с"
+
+
+NODE_STATES = {"starting": "запускается", "working": "работает", "waiting": "ждёт шардов",
+               "finished": "завершён", "stopped": "остановлен", "lost": "не отвечает"}
+
+
+def print_status(status: dict):
+    shards = status["shards"]
+    print(f"Шарды: {shards['done']} из {shards['total']} готово, {shards['leased']} в работе, "
+          f"{shards['expired']} с просроченной арендой, {shards['pending']} ждут")
+    print(f"Файлы: {status['processed']} из {status['total_files']} обработано, {status['failed']} с ошибками, "
+          f"осталось {status['remaining']}")
+    now = time.time()
+    for node in status["nodes"]:
+        shard = f", {node['shard']}" if node["state"] == "working" and node["shard"] else ""
+        print(f"  {node['node']:<32} {NODE_STATES.get(node['state'], node['state']):<12} "
+              f"{node['processed']} файлов ({node['failed']} с ошибками), {node['per_minute']:.1f} в минуту"
+              f"{shard}, отчёт {_format_duration(now - node['updated'])} назад")
+    eta = f", осталось около {_format_duration(status['eta_seconds'])}" if status["eta_seconds"] else ""
+    print(f"Всего: {status['per_minute']:.1f} файлов в минуту{eta}")
+    for error in status["errors"][:MAX_REPORTED_ERRORS]:
+        print(f"ERROR {error['file']}: {error['error']}")
+    if len(status["errors"]) > MAX_REPORTED_ERRORS:
+        print(f"... и ещё {len(status['errors']) - MAX_REPORTED_ERRORS} ошибок")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m distributed",
+                                     description="Пакетная обработка на нескольких машинах через общую папку-очередь.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit", help="разложить файлы по шардам и поставить задание в очередь")
+    submit.add_argument("queue", help="папка-очередь на общем диске")
+    submit.add_argument("inputs", nargs="+", help="файлы, маски (\"*.jpg\") или папки")
+    submit.add_argument("-o", "--output-dir", required=True, help="папка для результатов (на общем диске)")
+    submit.add_argument("-r", "--recursive", action="store_true", help="обходить вложенные папки")
+    submit.add_argument("--prefix", default="watermarked_", help="префикс имён выходных файлов")
+    submit.add_argument("--preset", help="JSON-файл с параметрами водяного знака (поля WatermarkParams)")
+    submit.add_argument("--shards", type=int, default=DEFAULT_SHARDS,
+                        help="на сколько шардов делить файлы (больше шардов - ровнее загрузка узлов)")
+    submit.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                        help="срок аренды шарда, с: через столько шард упавшего узла заберёт другой")
+    submit.add_argument("--backend", choices=["pillow", "numpy"], default="pillow", help="чем смешивать знак")
+    add_encoding_arguments(submit)
+    add_watermark_arguments(submit)
+
+    work = commands.add_parser("work", help="обрабатывать шарды из очереди, пока они не кончатся")
+    work.add_argument("queue", help="папка-очередь на общем диске")
+    work.add_argument("-w", "--workers", type=int, default=default_worker_count(),
+                      help="число рабочих процессов на этом узле (по умолчанию - по числу ядер)")
+    work.add_argument("--node-id", help="имя узла в отчётах (по умолчанию - имя машины и PID)")
+    work.add_argument("--poll", type=float, default=5.0,
+                      help="как часто проверять чужие аренды, когда свободных шардов нет, с")
+    work.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                      help="после стольких перехватов просроченной аренды шарда его необработанные файлы"
+                           " считаются ошибкой")
+    work.add_argument("-q", "--quiet", action="store_true", help="писать в лог только предупреждения и ошибки")
+    work.add_argument("-v", "--verbose", action="store_true", help="подробный лог рабочих процессов")
+
+    status = commands.add_parser("status", help="сводка по всем узлам: готово, ошибки, скорость")
+    status.add_argument("queue", help="папка-очередь на общем диске")
+    status.add_argument("--json", action="store_true", help="вывести сводку в JSON")
+    status.add_argument("--wait", action="store_true",
+                        help="повторять сводку, пока все шарды не будут готовы; код возврата 1, если есть ошибки")
+    status.add_argument("--interval", type=float, default=30.0, help="период сводки для --wait, с")
+    return parser
+
+
+def _submit(args) -> int:
+    try:
+        params = resolve_params(args)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка в параметрах: {e}", file=sys.stderr)
+        return 2
+    error = check_params(params)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    if args.format and not is_format_available(args.format):
+        print(f"Установленный Pillow не умеет сохранять {args.format.upper()}.", file=sys.stderr)
+        return 2
+    if args.shards < 1 or args.lease <= 0:
+        print("--shards и --lease должны быть положительными.", file=sys.stderr)
+        return 2
+    if params.image_path:
+        params = params._replace(image_path=os.path.abspath(params.image_path))
+
+    files = [os.path.abspath(path) for path in collect_inputs(args.inputs, args.recursive)]
+    if not files:
+        print("Не найдено ни одного изображения.", file=sys.stderr)
+        return 2
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = make_tasks(files, output_dir, params, args.prefix, EXTENSION_BY_FORMAT.get(args.format))
+    error = check_output_collisions(tasks)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    job = {"params": params._asdict(), "encoding": encoding_options(args)._asdict(), "output_dir": output_dir,
+           "backend": args.backend, "lease_seconds": args.lease}
+    queue = WorkQueue(args.queue)
+    try:
+        created = queue.submit(tasks, args.shards, job)
+    except ValueError:
+        print(f"В {args.queue} уже другое задание; для нового нужна новая папка-очередь.", file=sys.stderr)
+        return 2
+    if created:
+        print(f"Поставлено в очередь: {len(tasks)} файлов в {len(queue.job()['shards'])} шардах.")
+    else:
+        print("Это задание уже в очереди.")
+    return 0
+
+
+def _work(args) -> int:
+    configure_logging(logging.WARNING if args.quiet else logging.INFO)
+    queue = WorkQueue(args.queue)
+    if queue.job() is None:
+        print(f"В {args.queue} нет задания (сначала python -m distributed submit).", file=sys.stderr)
+        return 2
+    worker = DistributedWorker(queue, args.node_id or f"{socket.gethostname()}-{os.getpid()}",
+                               max_workers=args.workers, poll_interval=args.poll, max_attempts=args.max_attempts,
+                               log_level=logging.DEBUG if args.verbose else logging.WARNING)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: worker.stop())
+    failed = worker.run()
+    return 1 if failed else 0
+
+
+def _status(args) -> int:
+    queue = WorkQueue(args.queue)
+    if queue.job() is None:
+        print(f"В {args.queue} нет задания.", file=sys.stderr)
+        return 2
+    while True:
+        status = queue.status()
+        if args.json:
+            print(json.dumps(status, ensure_ascii=False, indent=2), flush=True)
+        else:
+            print_status(status)
+            print(flush=True)
+        if not args.wait:
+            return 0
+        if status["complete"]:
+            return 1 if status["failed"] else 0
+        time.sleep(args.interval)
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    commands = {"submit": _submit, "work": _work, "status": _status}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
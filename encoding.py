@@ -0,0 +1,117 @@
+"""
+Кодирование результатов: формат по расширению файла и настройки каждого формата.
+
+JPEG - качество, субдискретизация цвета, прогрессивная развёртка и оптимизация таблиц
+Хаффмана; PNG - уровень сжатия zlib; WebP и AVIF - если их поддерживает установленный
+Pillow (AVIF - встроенный или через плагин pillow-avif-plugin). EXIF и ICC-профиль
+исходника переносятся в результат, альфа-канал сохраняется там, где формат его
+поддерживает. Настройки задаются на процесс (set_encoding_options), как и способ
+смешивания в utils.set_compositing_backend.
+"""
+import io
+import os
+from collections import namedtuple
+
+from PIL import Image
+
+try:
+    import pillow_avif  # noqa: F401 - регистрирует AVIF в старых версиях Pillow
+except ImportError:
+    pass
+
+
+EncodingOptions = namedtuple("EncodingOptions", [
+    "jpeg_quality", "jpeg_subsampling", "jpeg_progressive", "optimize",
+    "png_compress_level", "webp_quality", "webp_lossless", "webp_method",
+    "avif_quality", "avif_speed", "keep_metadata",
+], defaults=[75, "4:2:0", False, False, 6, 80, False, 4, 75, 6, True])  # По умолчанию - как у Pillow
+
+DEFAULT_ENCODING_OPTIONS = EncodingOptions()
+
+FORMAT_BY_EXTENSION = {
+    ".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".webp": "WEBP", ".avif": "AVIF",
+    ".tif": "TIFF", ".tiff": "TIFF", ".bmp": "BMP", ".gif": "GIF",
+}
+# Расширение для --format в консольном режиме
+EXTENSION_BY_FORMAT = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "avif": ".avif", "tiff": ".tif"}
+
+JPEG_SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+_ALPHA_FORMATS = {"PNG", "WEBP", "AVIF", "TIFF", "GIF"}
+_METADATA_FORMATS = {"JPEG", "PNG", "WEBP", "AVIF", "TIFF"}
+
+_encoding_options = DEFAULT_ENCODING_OPTIONS
+
+
+def set_encoding_options(options: EncodingOptions | None):
+    """Настройки кодирования по умолчанию для этого процесса (None - как у Pillow)."""
+    global _encoding_options
+    _encoding_options = options or DEFAULT_ENCODING_OPTIONS
+
+
+def get_encoding_options() -> EncodingOptions:
+    return _encoding_options
+
+
+def output_format(result_path: str) -> str:
+    """Формат Pillow по расширению; для незнакомых расширений - PNG."""
+    return FORMAT_BY_EXTENSION.get(os.path.splitext(result_path)[1].lower(), "PNG")
+
+
+def is_format_available(fmt: str) -> bool:
+    """Умеет ли установленный Pillow сохранять в этот формат (WebP и AVIF регистрируются, только если собраны)."""
+    Image.init()
+    return fmt.upper() in Image.SAVE
+
+
+def _prepare_mode(image: Image.Image, fmt: str) -> Image.Image:
+    if fmt not in _ALPHA_FORMATS:
+        return image if image.mode == "RGB" else image.convert("RGB")
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    has_alpha = image.mode in ("LA", "PA") or "transparency" in image.info
+    return image.convert("RGBA" if has_alpha else "RGB")
+
+
+def _save_arguments(image: Image.Image, fmt: str, options: EncodingOptions) -> dict:
+    if fmt == "JPEG":
+        arguments = {"quality": options.jpeg_quality, "subsampling": options.jpeg_subsampling,
+                     "progressive": options.jpeg_progressive, "optimize": options.optimize}
+    elif fmt == "PNG":
+        arguments = {"compress_level": options.png_compress_level, "optimize": options.optimize}
+    elif fmt == "WEBP":
+        arguments = {"quality": options.webp_quality, "lossless": options.webp_lossless,
+                     "method": options.webp_method}
+    elif fmt == "AVIF":
+        arguments = {"quality": options.avif_quality, "speed": options.avif_speed}
+    else:
+        arguments = {}
+    if options.keep_metadata and fmt in _METADATA_FORMATS:
+        if image.info.get("exif"):
+            arguments["exif"] = image.info["exif"]
+        if image.info.get("icc_profile"):
+            arguments["icc_profile"] = image.info["icc_profile"]
+    return arguments
+
+
+def save_image(image: Image.Image, fp, result_path: str | None = None,
+               options: EncodingOptions | None = None) -> tuple[str, int]:
+    """
+    Сохраняет изображение в формате, который выбирается по расширению result_path.
+    fp - путь или файловый объект (например, BytesIO); если это путь, result_path можно не передавать.
+    Возвращает (формат, размер в байтах).
+    """
+    result_path = result_path or fp
+    options = options or _encoding_options
+    fmt = output_format(result_path)
+    if not is_format_available(fmt):
+        raise ValueError(f"Format {fmt} is not supported by the installed Pillow")
+    prepared = _prepare_mode(image, fmt)
+    # Данные EXIF/ICC берём у исходного изображения: convert их не всегда переносит
+    arguments = _save_arguments(image, fmt, options)
+    if isinstance(fp, (str, os.PathLike)):
+        prepared.save(fp, fmt, **arguments)
+        return fmt, os.path.getsize(fp)
+    start = fp.tell() if isinstance(fp, io.IOBase) and fp.seekable() else 0
+    prepared.save(fp, fmt, **arguments)
+    return fmt, fp.tell() - start
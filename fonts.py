@@ -0,0 +1,151 @@
+"""
+Поиск файлов шрифтов по имени семейства.
+
+Индекс шрифтов строится один раз на процесс: на Windows - по реестру,
+на Linux - через fc-list (fontconfig), а также обходом стандартных папок со шрифтами.
+Загруженные FreeTypeFont кэшируются по (путь, размер).
+"""
+import os
+import logging
+import platform
+import functools
+import subprocess
+import shutil
+
+# ИСПРАВЛЕНИЕ: Добавляем winreg для доступа к реестру Windows
+if platform.system() == "Windows":
+    import winreg
+
+from PIL import ImageFont
+
+
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+# Начертания, которые считаем "обычными" при выборе файла для семейства
+REGULAR_STYLES = ("regular", "book", "normal", "roman", "medium")
+FONT_CACHE_SIZE = 64
+
+_WINDOWS_FONTS_KEY = r"SOFTWARE\Microsoft\Windows NT\CurrentVersion\Fonts"
+
+
+def _font_dirs() -> list[str]:
+    home = os.path.expanduser("~")
+    if platform.system() == "Windows":
+        return [os.path.join(os.environ.get("SystemRoot", r"C:\Windows"), "Fonts"),
+                os.path.join(os.environ.get("LOCALAPPDATA", ""), "Microsoft", "Windows", "Fonts")]
+    if platform.system() == "Darwin":
+        return ["/System/Library/Fonts", "/Library/Fonts", os.path.join(home, "Library", "Fonts")]
+    data_dirs = os.environ.get("XDG_DATA_DIRS", "/usr/local/share:/usr/share").split(":")
+    return ([os.path.join(d, "fonts") for d in data_dirs]
+            + [os.path.join(home, ".fonts"), os.path.join(home, ".local", "share", "fonts")])
+
+
+def _windows_registry_fonts():
+    """Пары (имя из реестра без суффикса "(TrueType)", путь к файлу)."""
+    fonts_folder = os.path.join(os.environ.get("SystemRoot", r"C:\Windows"), "Fonts")
+    for hive in (winreg.HKEY_LOCAL_MACHINE, winreg.HKEY_CURRENT_USER):
+        try:
+            with winreg.OpenKey(hive, _WINDOWS_FONTS_KEY) as key:
+                for i in range(winreg.QueryInfoKey(key)[1]):
+                    value_name, file_name, _ = winreg.EnumValue(key, i)
+                    name = value_name.split(" (")[0]
+                    # Для шрифтов пользователя в реестре хранится полный путь
+                    yield name, os.path.join(fonts_folder, file_name)
+        except OSError as e:
+            logging.debug(f"Error accessing registry for fonts: {e}")
+
+
+def _fontconfig_fonts():
+    """Пары (семейство [+ начертание], путь) из fc-list."""
+    if shutil.which("fc-list") is None:
+        return
+    try:
+        output = subprocess.run(["fc-list", "--format", "%{family}\t%{style}\t%{file}\n"],
+                                capture_output=True, text=True, timeout=10, check=True).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.debug(f"fc-list failed: {e}")
+        return
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 3:
+            continue
+        families, styles, path = parts
+        style = styles.split(",")[0].strip()
+        for family in families.split(","):
+            family = family.strip()
+            if not family:
+                continue
+            if style.lower() in REGULAR_STYLES:
+                yield family, path
+            yield f"{family} {style}", path
+
+
+def _scanned_fonts():
+    """Пары (имя файла без расширения, путь) из стандартных папок со шрифтами."""
+    for font_dir in _font_dirs():
+        for root, _, names in os.walk(font_dir):
+            for name in names:
+                if name.lower().endswith(FONT_EXTENSIONS):
+                    stem = os.path.splitext(name)[0]
+                    yield stem, os.path.join(root, name)
+                    if stem.lower().endswith("-regular"):
+                        yield stem[:-len("-regular")], os.path.join(root, name)
+
+
+def _compact(name: str) -> str:
+    """"DejaVu Sans Bold" и "DejaVuSans-Bold" приводятся к одному ключу."""
+    return "".join(ch for ch in name.lower() if ch not in " -_")
+
+
+@functools.lru_cache(maxsize=None)
+def get_font_index() -> dict[str, str]:
+    """Словарь "имя в нижнем регистре" (и его форма без пробелов/дефисов) -> путь к файлу. Строится один раз на процесс."""
+    sources = [_scanned_fonts()]
+    if platform.system() == "Windows":
+        sources.insert(0, _windows_registry_fonts())
+    else:
+        sources.insert(0, _fontconfig_fonts())
+
+    index = {}
+    for source in sources:
+        for name, path in source:
+            # Первый найденный вариант выигрывает: реестр и fontconfig точнее обхода папок
+            index.setdefault(name.lower(), path)
+            index.setdefault(_compact(name), path)
+    logging.debug(f"Font index built: {len(index)} names.")
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_font_path(font_name: str) -> str | None:
+    """Находит файл шрифта по имени семейства (или возвращает сам путь, если передан путь)."""
+    if not font_name:
+        return None
+    if os.path.isfile(font_name):
+        return font_name
+    index = get_font_index()
+    key = font_name.lower()
+    for candidate in (key, _compact(key)):
+        if candidate in index and os.path.exists(index[candidate]):
+            return index[candidate]
+    # Как и раньше с реестром: ищем имя как подстроку, предпочитая самое короткое совпадение
+    matches = sorted((name for name in index if key in name), key=len)
+    for name in matches:
+        if os.path.exists(index[name]):
+            logging.debug(f"Found font '{font_name}' at '{index[name]}' via font index.")
+            return index[name]
+    return None
+
+
+def find_font_file_on_windows(font_name: str) -> str | None:
+    """
+    Finds the font file path by querying the Windows Registry (через общий индекс шрифтов).
+    """
+    if platform.system() != "Windows":
+        return None
+    return resolve_font_path(font_name)
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    """Загружает шрифт с диска; повторные вызовы с тем же (путь, размер) берутся из кэша."""
+    return ImageFont.truetype(font_path, font_size)
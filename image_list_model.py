@@ -0,0 +1,175 @@
+"""
+Модель списка файлов для QListView.
+
+Хранит только список путей; миниатюры запрашиваются лениво, когда представление
+спрашивает иконку видимой строки, и держатся в ограниченном LRU-кэше. Поэтому
+список из 100 тысяч файлов занимает память порядка самих строк с путями. Задачи
+для строк, которые успели прокрутить, снимаются из очереди (cancel_thumbnails).
+"""
+import os
+import logging
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, QRunnable, QThreadPool, pyqtSignal, pyqtSlot
+from PyQt6.QtGui import QPixmap, QImage, QIcon, QColor
+
+from PIL.ImageQt import ImageQt
+
+from thumbnails import THUMBNAIL_SIZE, get_thumbnail
+
+
+# --- Фоновая загрузка миниатюр ---
+# QRunnable не умеет отправлять сигналы сам, поэтому сигналы живут в отдельном QObject.
+class ThumbnailSignals(QObject):
+    ready = pyqtSignal(str, QImage)  # (путь к файлу, миниатюра)
+    failed = pyqtSignal(str)
+
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, image_path: str, signals: ThumbnailSignals):
+        super().__init__()
+        self.image_path, self.signals = image_path, signals
+        # Задачей владеет модель: так её можно снять из очереди через tryTake, не рискуя удалённым объектом
+        self.setAutoDelete(False)
+
+    def run(self):
+        try:
+            thumbnail = get_thumbnail(self.image_path, THUMBNAIL_SIZE)
+        except Exception as e:
+            logging.debug(f"Thumbnail failed for {self.image_path}: {e}")
+            self.signals.failed.emit(self.image_path)  # Элемент так и останется с заглушкой
+            return
+        self.signals.ready.emit(self.image_path, ImageQt(thumbnail).copy())
+
+
+class ImageListModel(QAbstractListModel):
+    # Сколько готовых иконок держать в памяти - с запасом на несколько экранов списка
+    ICON_CACHE_SIZE = 1024
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._paths = []       # Порядок строк
+        self._rows = {}        # Путь -> номер строки; заодно проверка на дубликаты
+        self._icons = OrderedDict()
+        self._pending = {}     # Путь -> ThumbnailTask для миниатюр в очереди или в работе
+        self._failed = set()
+        self._priority = 0
+
+        self.thumbnail_pool = QThreadPool(self)
+        self.thumbnail_pool.setMaxThreadCount(max(2, (os.cpu_count() or 2) // 2))
+        self.thumbnail_signals = ThumbnailSignals(self)
+        self.thumbnail_signals.ready.connect(self._on_thumbnail_ready)
+        self.thumbnail_signals.failed.connect(self._on_thumbnail_failed)
+        placeholder = QPixmap(*THUMBNAIL_SIZE)
+        placeholder.fill(QColor("#34495e"))
+        self.placeholder_icon = QIcon(placeholder)
+
+    # --- Интерфейс QAbstractListModel ---
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._paths)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._paths):
+            return None
+        path = self._paths[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self._icon_for(path)
+        if role in (Qt.ItemDataRole.UserRole, Qt.ItemDataRole.ToolTipRole):
+            return path
+        return None
+
+    # --- Работа со списком ---
+
+    def add_paths(self, paths) -> int:
+        """Добавляет новые пути в конец списка, пропуская повторы. Возвращает число добавленных."""
+        new_paths = []
+        for path in paths:
+            if path not in self._rows:
+                self._rows[path] = -1
+                new_paths.append(path)
+        if not new_paths:
+            return 0
+        first = len(self._paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(new_paths) - 1)
+        for offset, path in enumerate(new_paths):
+            self._rows[path] = first + offset
+        self._paths.extend(new_paths)
+        self.endInsertRows()
+        return len(new_paths)
+
+    def remove_row(self, row: int):
+        if not 0 <= row < len(self._paths):
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        path = self._paths.pop(row)
+        del self._rows[path]
+        for shifted_row in range(row, len(self._paths)):
+            self._rows[self._paths[shifted_row]] = shifted_row
+        self._icons.pop(path, None)
+        self._cancel_thumbnail(path)
+        self.endRemoveRows()
+
+    def path_at(self, row: int) -> str:
+        return self._paths[row]
+
+    def paths(self) -> list[str]:
+        """Копия списка путей - для обработки, без обращения к виджетам."""
+        return list(self._paths)
+
+    def cancel_thumbnails(self, keep_row) -> int:
+        """
+        Снимает из очереди миниатюры строк, для которых keep_row(номер строки) ложно, -
+        например, прокрученных за пределы экрана. Такие строки запросят миниатюру заново,
+        когда снова станут видны. Уже начатые задачи доделываются. Возвращает число снятых.
+        """
+        cancelled = 0
+        for path in list(self._pending):
+            row = self._rows.get(path)  # None - строку уже удалили, а задача ещё выполняется
+            if (row is None or not keep_row(row)) and self._cancel_thumbnail(path):
+                cancelled += 1
+        return cancelled
+
+    def _cancel_thumbnail(self, path: str) -> bool:
+        task = self._pending.get(path)
+        if task is None or not self.thumbnail_pool.tryTake(task):
+            return False
+        del self._pending[path]
+        return True
+
+    def shutdown(self):
+        self.thumbnail_pool.clear()
+        self.thumbnail_pool.waitForDone()
+
+    # --- Миниатюры ---
+
+    def _icon_for(self, path: str) -> QIcon:
+        icon = self._icons.get(path)
+        if icon is not None:
+            self._icons.move_to_end(path)
+            return icon
+        if path not in self._pending and path not in self._failed:
+            task = self._pending[path] = ThumbnailTask(path, self.thumbnail_signals)
+            # Более поздние запросы важнее: это строки, которые видны сейчас
+            self._priority += 1
+            self.thumbnail_pool.start(task, min(self._priority, 2 ** 30))
+        return self.placeholder_icon
+
+    @pyqtSlot(str, QImage)
+    def _on_thumbnail_ready(self, path, thumbnail):
+        self._pending.pop(path, None)
+        row = self._rows.get(path)
+        if row is None:
+            return  # Файл успели удалить из списка
+        self._icons[path] = QIcon(QPixmap.fromImage(thumbnail))
+        if len(self._icons) > self.ICON_CACHE_SIZE:
+            self._icons.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+    @pyqtSlot(str)
+    def _on_thumbnail_failed(self, path):
+        self._pending.pop(path, None)
+        self._failed.add(path)  # Больше не пытаемся - у строки останется заглушка
@@ -2,78 +2,208 @@
 # Стандартные модули Python
 import os  # Для работы с путями к файлам (например, чтобы получить имя файла)
 import logging  # Для вывода информации о работе программы (не используется активно, но полезно иметь)
+import threading  # Для синхронизации с потоком предпросмотра
 
 # Модули из библиотеки PyQt6 для создания интерфейса
-from PyQt6.QtCore import Qt, pyqtSignal, QThread, pyqtSlot, QSize
-from PyQt6.QtGui import QPixmap, QFontDatabase, QImage, QIcon
+from PyQt6.QtCore import Qt, pyqtSignal, QThread, pyqtSlot, QSize, QTimer
+from PyQt6.QtGui import QPixmap, QFontDatabase, QImage
 from PyQt6.QtWidgets import (
     QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QMessageBox,
-    QHBoxLayout, QComboBox, QSlider, QProgressBar, QListWidget, QListWidgetItem, QMenu,
-    QSpinBox, QFrame, QStackedWidget, QRadioButton, QGridLayout
+    QHBoxLayout, QComboBox, QSlider, QProgressBar, QListView, QMenu,
+    QSpinBox, QFrame, QStackedWidget, QRadioButton, QGridLayout, QCheckBox
 )
 
 # Модули из библиотеки Pillow (PIL) для работы с изображениями
-from PIL import Image
 from PIL.ImageQt import ImageQt
 
 # Импортируем наши собственные функции и классы из файла utils.py
-from utils import WatermarkParams, apply_watermark_to_pillow_image
+from utils import (WatermarkParams, DEFAULT_WATERMARK_PARAMS, TILE_POSITION, WATERMARK_POSITIONS,
+                   apply_watermark_to_pillow_image, load_preview_proxy, scale_params_for_preview, open_image_lazy,
+                   FILE_MAX_IMAGE_PIXELS)
+from fonts import get_font_index
+from batch import BatchTask, run_batch, default_worker_count, default_memory_budget, create_cancel_event
+from image_list_model import ImageListModel
+from video import VIDEO_EXTENSIONS, is_video_file, load_video_preview_proxy
+from manifest import BatchManifest
+from encoding import EncodingOptions
+
+# Шагов полосы прогресса на один файл: видео продвигает её по кадрам
+PROGRESS_STEPS = 100
 
 
 # --- Поток для обработки изображений ---
 # Чтобы интерфейс не "зависал" во время обработки множества файлов,
-# мы выносим эту задачу в отдельный поток (QThread).
+# мы выносим эту задачу в отдельный поток (QThread). Сам поток только
+# раздаёт файлы пулу процессов фиксированного размера (см. batch.py),
+# а Pillow работает параллельно в рабочих процессах.
 class ImageProcessingThread(QThread):
     # Сигналы - это способ, которым поток сообщает главному окну о событиях.
     finished_one = pyqtSignal(str)  # Сигнал об успешном завершении одного файла
     error = pyqtSignal(str)         # Сигнал в случае ошибки
+    partial_progress = pyqtSignal(float)  # Сколько файлов (в долях) готово среди тех, что в работе (кадры видео)
 
-    def __init__(self, image_file: str, result_file: str, params: WatermarkParams):
-        super().__init__()
+    def __init__(self, tasks: list[BatchTask], max_workers: int, manifest: BatchManifest | None = None,
+                 encoding: EncodingOptions | None = None, parent=None):
+        super().__init__(parent)
         # Сохраняем переданные параметры в переменных класса
-        self.image_file, self.result_file, self.params = image_file, result_file, params
-        self._is_running = True  # Флаг, который показывает, должен ли поток продолжать работать
+        self.tasks, self.max_workers, self.encoding = tasks, max_workers, encoding
+        self.manifest = manifest  # Манифест папки результатов: готовые файлы отмечаются в нём по ходу работы
+        # Событие отмены видят и рабочие процессы: файлы в работе прерываются между этапами
+        self._cancel_event = create_cancel_event()
+        self._partial = {}  # Исходник в работе -> доля готовых кадров
+        self._finished_paths = set()  # Сообщения о кадрах могут прийти позже результата файла
+
+    def _on_frames(self, image_path: str, done: int, total: int):
+        if total and image_path not in self._finished_paths:
+            self._partial[image_path] = min(done / total, 1.0)
+            self.partial_progress.emit(sum(self._partial.values()))
 
-    
     def run(self):
-        if not self._is_running:
-            return  # Если пришел сигнал остановиться, выходим
-
-        # Пытаемся обработать изображение
+        results = run_batch(self.tasks, self.max_workers, log_level=logging.getLogger().level,
+                            cancel_event=self._cancel_event,
+                            memory_budget=default_memory_budget(), encoding=self.encoding, progress=self._on_frames)
         try:
-            base_image = Image.open(self.image_file)
-            watermarked_image = apply_watermark_to_pillow_image(base_image, self.params)
-            watermarked_image.convert("RGB").save(self.result_file, "JPEG" if self.result_file.lower().endswith((".jpg", ".jpeg")) else "PNG")
-
-            if self._is_running:
-                # Если все прошло хорошо и нас не остановили, отправляем сигнал "готово"
-                self.finished_one.emit(self.result_file)
-        except Exception as e:
-            # Если произошла ошибка
-            if self._is_running:
-                # Отправляем сигнал "ошибка" с текстом исключения
-                self.error.emit(f"Ошибка с файлом {os.path.basename(self.image_file)}: {e}")
+            for result in results:
+                if self._cancel_event.is_set():
+                    break  # Если пришел сигнал остановиться, выходим (оставшиеся задачи отменятся)
+                self._finished_paths.add(result.task.image_path)
+                if self._partial.pop(result.task.image_path, None) is not None:
+                    self.partial_progress.emit(sum(self._partial.values()))
+                if result.error is None:
+                    if self.manifest is not None:
+                        self.manifest.record(result.task)
+                    # Если все прошло хорошо, отправляем сигнал "готово"
+                    self.finished_one.emit(result.task.result_path)
+                else:
+                    # Отправляем сигнал "ошибка" с текстом исключения
+                    self.error.emit(f"Ошибка с файлом {os.path.basename(result.task.image_path)}: {result.error}")
+        finally:
+            results.close()
+            if self.manifest is not None:
+                # Сохраняем и при отмене: следующий запуск продолжит с того же места
+                self.manifest.save()
 
     # Метод для остановки потока извне
     def stop(self):
-        self._is_running = False
+        self._cancel_event.set()
+
+
+# --- Поток для предпросмотра ---
+# Предпросмотр рисуется не по оригиналу, а по уменьшенной до размера окна копии,
+# и не в главном потоке. Поток помнит только последний запрос: промежуточные
+# (например, при перетаскивании ползунка) пропускаются, а результат запроса,
+# который успел устареть, не отправляется.
+class PreviewThread(QThread):
+    ready = pyqtSignal(int, QImage)  # (номер запроса, готовая картинка)
+    failed = pyqtSignal(int, str)    # (номер запроса, текст ошибки)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._condition = threading.Condition()
+        self._request = None  # (номер, путь, параметры, максимальный размер)
+        self._generation = 0
+        self._is_running = True
+        # Уменьшенная копия текущего файла, чтобы не декодировать его при каждом изменении настроек
+        self._proxy_key, self._proxy, self._proxy_scale = None, None, 1.0
+
+    def request(self, path: str, params: WatermarkParams, max_size: tuple[int, int]) -> int:
+        """Ставит новый запрос вместо ожидающего и возвращает его номер."""
+        with self._condition:
+            self._generation += 1
+            self._request = (self._generation, path, params, max_size)
+            self._condition.notify()
+            return self._generation
+
+    def run(self):
+        # Индекс шрифтов (fc-list или реестр) строится заранее, чтобы его не ждал первый предпросмотр
+        get_font_index()
+        while True:
+            with self._condition:
+                while self._request is None and self._is_running:
+                    self._condition.wait()
+                if not self._is_running:
+                    return
+                generation, path, params, max_size = self._request
+                self._request = None
+            try:
+                image = self._render(generation, path, params, max_size)
+            except Exception as e:
+                self.failed.emit(generation, str(e))
+                continue
+            if image is not None and generation == self._generation:
+                self.ready.emit(generation, image)
+
+    def _render(self, generation, path, params, max_size):
+        if (path, max_size) != self._proxy_key:
+            load_proxy = load_video_preview_proxy if is_video_file(path) else load_preview_proxy
+            self._proxy, self._proxy_scale = load_proxy(path, max_size)
+            self._proxy_key = (path, max_size)
+        if generation != self._generation:
+            return None  # Пока открывали файл, пришёл новый запрос
+        watermarked = apply_watermark_to_pillow_image(self._proxy, scale_params_for_preview(params, self._proxy_scale))
+        # copy() отвязывает QImage от буфера PIL, который живёт только в этом потоке
+        return ImageQt(watermarked.convert('RGBA')).copy()
+
+    def stop(self):
+        with self._condition:
+            self._is_running = False
+            self._condition.notify()
+        self.wait()
+
+
+# --- Поток для списка шрифтов ---
+# С тысячами установленных шрифтов QFontDatabase.families() занимает заметное время,
+# поэтому окно показывается сразу, а список шрифтов подставляется, когда будет готов.
+class FontListThread(QThread):
+    ready = pyqtSignal(list)
+
+    def run(self):
+        self.ready.emit(QFontDatabase.families())
 
 
 # --- Основной виджет вкладки "Изображения" ---
 class ImageTab(QWidget):
+    PREVIEW_DEBOUNCE_MS = 15
+    # Через сколько после остановки прокрутки снимать из очереди миниатюры невидимых строк
+    THUMBNAIL_CANCEL_DEBOUNCE_MS = 150
+
+    fonts_loaded = pyqtSignal()  # Полный список шрифтов подставлен в выпадающий список
+
     def __init__(self, settings):
         super().__init__()
         self.settings = settings  # Сохраняем настройки
-        self.image_threads = []  # Список для хранения потоков обработки
+        self.processing_thread = None  # Поток, раздающий файлы пулу процессов
         self.processed_count = 0  # Счетчик обработанных файлов
+        self.partial_count = 0.0  # Доли файлов в работе (кадры видео), см. on_partial_progress
+        self.total_count = 0  # Сколько файлов в текущем запуске
         self.current_preview_path = None  # Путь к файлу, который сейчас в предпросмотре
-        self.current_base_pillow_image = None  # PIL-объект этого файла
+        self.preview_generation = 0  # Номер последнего запроса предпросмотра
         self.banner_path = "" # Добавляем для сохранения пути к баннеру
+        # Очередь файлов: только пути, миниатюры грузятся лениво для видимых строк
+        self.image_model = ImageListModel(self)
         
+        # Предпросмотр: изменения настроек копятся PREVIEW_DEBOUNCE_MS и рисуются в отдельном потоке
+        self.preview_thread = PreviewThread(self)
+        self.preview_thread.ready.connect(self.on_preview_ready)
+        self.preview_thread.failed.connect(self.on_preview_failed)
+        self.preview_thread.start()
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(self.PREVIEW_DEBOUNCE_MS)
+        self.preview_timer.timeout.connect(self._request_preview)
+        self.thumbnail_cancel_timer = QTimer(self)
+        self.thumbnail_cancel_timer.setSingleShot(True)
+        self.thumbnail_cancel_timer.setInterval(self.THUMBNAIL_CANCEL_DEBOUNCE_MS)
+        self.thumbnail_cancel_timer.timeout.connect(self._cancel_hidden_thumbnails)
+
         self.init_ui()
         self.connect_signals()
         self.load_settings()
 
+        self.font_list_thread = FontListThread(self)
+        self.font_list_thread.ready.connect(self.on_fonts_loaded)
+        self.font_list_thread.start()
+
     # --- Главный метод создания интерфейса ---
     def init_ui(self):
         main_layout = QHBoxLayout(self)
@@ -102,8 +232,7 @@ class ImageTab(QWidget):
         self.input_watermark_img = QLineEdit()
         self.input_watermark_img.setPlaceholderText("Ваш текст...")
         text_grid = QGridLayout()
-        self.combo_font_img = QComboBox()
-        self.combo_font_img.addItems(QFontDatabase.families())
+        self.combo_font_img = QComboBox()  # Заполняется в фоне (FontListThread), до этого - только сохранённый шрифт
         self.spin_font_size_img = QSpinBox()
         self.spin_font_size_img.setRange(1, 50)
         self.spin_font_size_img.setValue(10)
@@ -144,7 +273,7 @@ class ImageTab(QWidget):
         common_controls_frame = QFrame()
         common_layout = QGridLayout(common_controls_frame)
         self.combo_position_img = QComboBox()
-        self.combo_position_img.addItems(["Центр", "Верхний левый угол", "Верхний правый угол", "Нижний левый угол", "Нижний правый угол"])
+        self.combo_position_img.addItems(WATERMARK_POSITIONS)
         self.spin_offset_x = QSpinBox(); self.spin_offset_x.setRange(-2000, 2000)
         self.spin_offset_y = QSpinBox(); self.spin_offset_y.setRange(-2000, 2000)
         opacity_layout = QHBoxLayout()
@@ -157,19 +286,34 @@ class ImageTab(QWidget):
         common_layout.addWidget(QLabel("Смещение X:"), 1, 0); common_layout.addWidget(self.spin_offset_x, 1, 1)
         common_layout.addWidget(QLabel("Смещение Y:"), 1, 2); common_layout.addWidget(self.spin_offset_y, 1, 3)
         common_layout.addLayout(opacity_layout, 2, 0, 1, 4)
+        # Настройки замощения (доступны только для позиции TILE_POSITION)
+        self.spin_tile_spacing = QSpinBox(); self.spin_tile_spacing.setRange(0, 500); self.spin_tile_spacing.setSuffix(" %")
+        self.spin_tile_spacing.setValue(DEFAULT_WATERMARK_PARAMS.tile_spacing)
+        self.spin_tile_spacing.setToolTip("Промежуток между повторами в процентах от размера знака")
+        self.spin_tile_angle = QSpinBox(); self.spin_tile_angle.setRange(-180, 180); self.spin_tile_angle.setSuffix(" °")
+        self.spin_tile_angle.setValue(DEFAULT_WATERMARK_PARAMS.tile_angle)
+        self.check_tile_stagger = QCheckBox("Сдвигать каждый второй ряд")
+        self.check_tile_stagger.setChecked(DEFAULT_WATERMARK_PARAMS.tile_stagger)
+        common_layout.addWidget(QLabel("Промежуток:"), 3, 0); common_layout.addWidget(self.spin_tile_spacing, 3, 1)
+        common_layout.addWidget(QLabel("Поворот:"), 3, 2); common_layout.addWidget(self.spin_tile_angle, 3, 3)
+        common_layout.addWidget(self.check_tile_stagger, 4, 0, 1, 4)
         left_layout.addWidget(common_controls_frame)
 
         self.image_button_img = QPushButton("📁 Выбрать изображения")
         left_layout.addWidget(self.image_button_img)
         
-        self.image_list_widget = QListWidget()
-        self.image_list_widget.setViewMode(QListWidget.ViewMode.IconMode)
-        self.image_list_widget.setIconSize(QSize(100, 100))
-        self.image_list_widget.setResizeMode(QListWidget.ResizeMode.Adjust)
-        self.image_list_widget.setMovement(QListWidget.Movement.Static)
-        self.image_list_widget.setSpacing(10)
-        self.image_list_widget.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-        left_layout.addWidget(self.image_list_widget)
+        self.image_list_view = QListView()
+        self.image_list_view.setModel(self.image_model)
+        self.image_list_view.setViewMode(QListView.ViewMode.IconMode)
+        self.image_list_view.setIconSize(QSize(100, 100))
+        self.image_list_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.image_list_view.setMovement(QListView.Movement.Static)
+        self.image_list_view.setSpacing(10)
+        # Одинаковый размер строк: представлению не нужно опрашивать все элементы для раскладки
+        self.image_list_view.setUniformItemSizes(True)
+        self.image_list_view.setLayoutMode(QListView.LayoutMode.Batched)
+        self.image_list_view.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        left_layout.addWidget(self.image_list_view)
 
         self.progress_bar_img = QProgressBar()
         self.progress_bar_img.setVisible(False)
@@ -182,6 +326,26 @@ class ImageTab(QWidget):
         action_buttons_layout.addWidget(self.watermark_button_img)
         action_buttons_layout.addWidget(self.cancel_button_img)
         left_layout.addLayout(action_buttons_layout)
+
+        workers_layout = QHBoxLayout()
+        self.spin_workers = QSpinBox()
+        self.spin_workers.setRange(1, 256)
+        self.spin_workers.setValue(default_worker_count())
+        workers_layout.addWidget(QLabel("Процессов обработки:"))
+        workers_layout.addWidget(self.spin_workers)
+        self.spin_jpeg_quality = QSpinBox()
+        self.spin_jpeg_quality.setRange(1, 95)
+        self.spin_jpeg_quality.setValue(EncodingOptions().jpeg_quality)
+        workers_layout.addWidget(QLabel("Качество JPEG:"))
+        workers_layout.addWidget(self.spin_jpeg_quality)
+        workers_layout.addStretch()
+        left_layout.addLayout(workers_layout)
+
+        self.check_skip_unchanged = QCheckBox("Пропускать уже обработанные файлы")
+        self.check_skip_unchanged.setToolTip("Обрабатывать только новые и изменённые файлы, "
+                                             "если параметры знака не менялись с прошлого запуска в эту папку")
+        self.check_skip_unchanged.setChecked(True)
+        left_layout.addWidget(self.check_skip_unchanged)
         
         main_layout.addWidget(left_panel)
 
@@ -216,6 +380,9 @@ class ImageTab(QWidget):
         self.spin_offset_x.valueChanged.connect(self._on_settings_changed)
         self.spin_offset_y.valueChanged.connect(self._on_settings_changed)
         self.slider_opacity_img.valueChanged.connect(self._on_settings_changed)
+        self.spin_tile_spacing.valueChanged.connect(self._on_settings_changed)
+        self.spin_tile_angle.valueChanged.connect(self._on_settings_changed)
+        self.check_tile_stagger.toggled.connect(self._on_settings_changed)
         
         # Buttons
         self.btn_select_banner.clicked.connect(self.select_banner_image)
@@ -224,12 +391,16 @@ class ImageTab(QWidget):
         self.cancel_button_img.clicked.connect(self.cancel_image_processing)
         
         # Image list
-        self.image_list_widget.itemClicked.connect(self.on_thumbnail_click)
-        self.image_list_widget.customContextMenuRequested.connect(self.show_image_context_menu)
+        self.image_list_view.clicked.connect(self.on_thumbnail_click)
+        self.image_list_view.customContextMenuRequested.connect(self.show_image_context_menu)
+        self.image_list_view.verticalScrollBar().valueChanged.connect(lambda _: self.thumbnail_cancel_timer.start())
 
     def _on_settings_changed(self, _=None):
         is_text_mode = self.radio_text_wm.isChecked()
         self.controls_stack.setCurrentWidget(self.text_controls_widget if is_text_mode else self.image_controls_widget)
+        is_tiled = self.combo_position_img.currentText() == TILE_POSITION
+        for widget in (self.spin_tile_spacing, self.spin_tile_angle, self.check_tile_stagger):
+            widget.setEnabled(is_tiled)
         self.update_preview()
 
     # --- Слоты (обработчики событий) ---
@@ -244,52 +415,49 @@ class ImageTab(QWidget):
 
     def select_images(self):
         """Открывает диалог выбора изображений для обработки."""
-        files, _ = QFileDialog.getOpenFileNames(self, "Выберите изображения", "", "Изображения (*.png *.jpg *.jpeg *.bmp *.gif)")
+        video_filter = " ".join(f"*{ext}" for ext in VIDEO_EXTENSIONS)
+        files, _ = QFileDialog.getOpenFileNames(self, "Выберите изображения", "", f"Изображения и видео (*.png *.jpg *.jpeg *.bmp *.gif *.tif *.tiff {video_filter});;Изображения (*.png *.jpg *.jpeg *.bmp *.gif *.tif *.tiff);;Видео ({video_filter})")
         if files: self.add_files_to_list(files)
 
     def add_files_to_list(self, file_list):
-        """Добавляет выбранные файлы в список миниатюр."""
-        for file_path in file_list:
-            if not any(self.image_list_widget.item(i).data(Qt.ItemDataRole.UserRole) == file_path for i in range(self.image_list_widget.count())):
-                item = QListWidgetItem(QIcon(QPixmap(file_path)), os.path.basename(file_path))
-                item.setData(Qt.ItemDataRole.UserRole, file_path)
-                self.image_list_widget.addItem(item)
-        if self.image_list_widget.count() > 0 and self.current_preview_path is None:
-            self.on_thumbnail_click(self.image_list_widget.item(0))
+        """Добавляет выбранные файлы в список миниатюр (сами миниатюры подгружаются в фоне)."""
+        self.image_model.add_paths(file_list)
+        if self.image_model.rowCount() > 0 and self.current_preview_path is None:
+            self.on_thumbnail_click(self.image_model.index(0))
         self._update_apply_button_state()
 
-    def on_thumbnail_click(self, item):
+    def on_thumbnail_click(self, index):
         """Обрабатывает клик по миниатюре в списке."""
-        path = item.data(Qt.ItemDataRole.UserRole)
+        path = self.image_model.path_at(index.row())
         try:
+            # Читаем только заголовок, чтобы сразу сообщить о битом файле; декодирование - в потоке предпросмотра.
+            # Видео открывает ffmpeg уже в потоке предпросмотра
+            if not is_video_file(path):
+                with open_image_lazy(path, FILE_MAX_IMAGE_PIXELS):
+                    pass
             self.current_preview_path = path
-            self.current_base_pillow_image = Image.open(path)
             self.preview_stack.setCurrentWidget(self.preview_label)
             self.update_preview()
         except Exception as e:
-            QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить предпросмотр: {e}")
-            self.current_preview_path = None
-            self.current_base_pillow_image = None
-            self.preview_stack.setCurrentWidget(self.preview_label_placeholder)
+            self._show_preview_error(e)
 
     def show_image_context_menu(self, position):
         """Показывает контекстное меню (правый клик) для элемента списка."""
-        item = self.image_list_widget.itemAt(position)
-        if not item: return
+        index = self.image_list_view.indexAt(position)
+        if not index.isValid(): return
         menu = QMenu()
         delete_action = menu.addAction("🗑️ Удалить")
-        action = menu.exec(self.image_list_widget.mapToGlobal(position))
-        if action == delete_action: self.delete_selected_image(item)
+        action = menu.exec(self.image_list_view.mapToGlobal(position))
+        if action == delete_action: self.delete_selected_image(index)
 
-    def delete_selected_image(self, item_to_delete):
+    def delete_selected_image(self, index):
         """Удаляет выбранную картинку из списка."""
-        path_to_delete = item_to_delete.data(Qt.ItemDataRole.UserRole)
-        self.image_list_widget.takeItem(self.image_list_widget.row(item_to_delete))
+        path_to_delete = self.image_model.path_at(index.row())
+        self.image_model.remove_row(index.row())
         if path_to_delete == self.current_preview_path:
             self.current_preview_path = None
-            self.current_base_pillow_image = None
-            if self.image_list_widget.count() > 0:
-                self.on_thumbnail_click(self.image_list_widget.item(0))
+            if self.image_model.rowCount() > 0:
+                self.on_thumbnail_click(self.image_model.index(0))
             else:
                 self.preview_stack.setCurrentWidget(self.preview_label_placeholder)
         self._update_apply_button_state()
@@ -297,18 +465,72 @@ class ImageTab(QWidget):
     # --- Основная логика ---
 
     def update_preview(self):
-        """Обновляет изображение в окне предпросмотра."""
-        if self.current_base_pillow_image is None: return
-        params = self.get_current_params()
-        watermarked_pillow_image = apply_watermark_to_pillow_image(self.current_base_pillow_image, params)
-        q_image = ImageQt(watermarked_pillow_image.convert('RGBA'))
+        """Запрашивает обновление предпросмотра. Частые вызовы подряд склеиваются в один."""
+        if self.current_preview_path is None: return
+        self.preview_timer.start()
+
+    def _request_preview(self):
+        """Отправляет текущие настройки в поток предпросмотра."""
+        if self.current_preview_path is None: return
+        ratio = self.preview_label.devicePixelRatioF()
+        max_size = (max(1, int(self.preview_label.width() * ratio)), max(1, int(self.preview_label.height() * ratio)))
+        self.preview_generation = self.preview_thread.request(self.current_preview_path, self.get_current_params(), max_size)
+
+    @pyqtSlot(int, QImage)
+    def on_preview_ready(self, generation, q_image):
+        """Показывает готовый предпросмотр, если он соответствует последнему запросу."""
+        if generation != self.preview_generation or self.current_preview_path is None: return
         pixmap = QPixmap.fromImage(q_image)
-        scaled_pixmap = pixmap.scaled(self.preview_label.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-        self.preview_label.setPixmap(scaled_pixmap)
+        pixmap.setDevicePixelRatio(self.preview_label.devicePixelRatioF())
+        self.preview_label.setPixmap(pixmap)
+
+    @pyqtSlot(int, str)
+    def on_preview_failed(self, generation, error_message):
+        if generation != self.preview_generation: return
+        self._show_preview_error(error_message)
+
+    def _show_preview_error(self, error):
+        QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить предпросмотр: {error}")
+        self.current_preview_path = None
+        self.preview_stack.setCurrentWidget(self.preview_label_placeholder)
+
+    @pyqtSlot(list)
+    def on_fonts_loaded(self, families):
+        """Подставляет полный список шрифтов, не сбрасывая выбранный."""
+        current = self.combo_font_img.currentText()
+        self.combo_font_img.blockSignals(True)
+        self.combo_font_img.clear()
+        self.combo_font_img.addItems(families)
+        self.combo_font_img.setCurrentText(current)
+        self.combo_font_img.blockSignals(False)
+        if self.combo_font_img.currentText() != current:
+            self.update_preview()  # Сохранённого шрифта нет в системе - выбран первый из списка
+        self.fonts_loaded.emit()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_preview()
+
+    def _cancel_hidden_thumbnails(self):
+        # Видимая область с запасом в экран сверху и снизу: при небольшой прокрутке назад миниатюры не строятся заново
+        viewport = self.image_list_view.viewport().rect()
+        visible = viewport.adjusted(0, -viewport.height(), 0, viewport.height())
+        cancelled = self.image_model.cancel_thumbnails(
+            lambda row: self.image_list_view.visualRect(self.image_model.index(row)).intersects(visible))
+        if cancelled:
+            logging.debug(f"Cancelled {cancelled} thumbnails scrolled out of view.")
+
+    def shutdown(self):
+        """Останавливает фоновые потоки перед закрытием окна."""
+        self.preview_timer.stop()
+        self.thumbnail_cancel_timer.stop()
+        self.preview_thread.stop()
+        self.font_list_thread.wait()
+        self.image_model.shutdown()
 
     def apply_watermark_to_all(self):
         """Запускает процесс наложения водяных знаков на все изображения в списке."""
-        if self.image_list_widget.count() == 0: return
+        if self.image_model.rowCount() == 0: return
         params = self.get_current_params()
         if params.watermark_type == "text" and not params.text:
             QMessageBox.warning(self, "Внимание", "Введите текст водяного знака."); return
@@ -317,27 +539,53 @@ class ImageTab(QWidget):
         output_dir = QFileDialog.getExistingDirectory(self, "Выберите папку для сохранения")
         if not output_dir: return
 
+        tasks = []
+        for image_file in self.image_model.paths():
+            base_name, ext = os.path.splitext(os.path.basename(image_file))
+            result_file = os.path.join(output_dir, f"watermarked_{base_name}{ext}")
+            tasks.append(BatchTask(image_file, result_file, params))
+
+        encoding = EncodingOptions(jpeg_quality=self.spin_jpeg_quality.value())
+        manifest = BatchManifest(output_dir, encoding=encoding)
+        if self.check_skip_unchanged.isChecked():
+            tasks, skipped = manifest.pending_tasks(tasks)
+            if not tasks:
+                QMessageBox.information(self, "Нечего обрабатывать",
+                                        f"Все {skipped} файлов уже обработаны с текущими параметрами.")
+                return
+        else:
+            for task in tasks:
+                manifest.capture(task)  # В манифест попадёт состояние исходников до обработки
+
         self.processed_count = 0
-        self.progress_bar_img.setMaximum(self.image_list_widget.count())
+        self.partial_count = 0.0
+        self.total_count = len(tasks)
+        self.progress_bar_img.setMaximum(self.total_count * PROGRESS_STEPS)
         self.reset_processing_state(is_processing=True)
-        self.image_threads = []
 
-        for i in range(self.image_list_widget.count()):
-            image_file = self.image_list_widget.item(i).data(Qt.ItemDataRole.UserRole)
-            base_name, ext = os.path.splitext(os.path.basename(image_file))
-            result_file = os.path.join(output_dir, f"watermarked_{base_name}{ext}")
-            thread = ImageProcessingThread(image_file, result_file, params)
-            thread.finished_one.connect(self.on_image_finished)
-            thread.error.connect(self.on_image_error)
-            self.image_threads.append(thread)
-            thread.start()
+        # Один поток на весь пакет; файлы обрабатывает пул из spin_workers процессов
+        self.processing_thread = ImageProcessingThread(tasks, self.spin_workers.value(), manifest, encoding, self)
+        self.processing_thread.finished.connect(self.processing_thread.deleteLater)
+        self.processing_thread.finished_one.connect(self.on_image_finished)
+        self.processing_thread.error.connect(self.on_image_error)
+        self.processing_thread.partial_progress.connect(self.on_partial_progress)
+        self.processing_thread.start()
+
+    @pyqtSlot(float)
+    def on_partial_progress(self, partial_count):
+        """Слот для видео в работе: полоса прогресса движется по кадрам, а не только по готовым файлам."""
+        self.partial_count = partial_count
+        self._update_progress_bar()
+
+    def _update_progress_bar(self):
+        self.progress_bar_img.setValue(round((self.processed_count + self.partial_count) * PROGRESS_STEPS))
 
     @pyqtSlot(str)
     def on_image_finished(self, result_file):
         """Слот, который вызывается, когда один поток успешно завершил работу."""
         self.processed_count += 1
-        self.progress_bar_img.setValue(self.processed_count)
-        if self.processed_count == len(self.image_threads):
+        self._update_progress_bar()
+        if self.processed_count == self.total_count:
             QMessageBox.information(self, "Успех!", "Все изображения успешно обработаны.")
             self.reset_processing_state()
             self.save_settings()
@@ -347,14 +595,19 @@ class ImageTab(QWidget):
         """Слот, который вызывается, если в потоке произошла ошибка."""
         QMessageBox.warning(self, "Ошибка обработки", error_message)
         self.processed_count += 1
-        self.progress_bar_img.setValue(self.processed_count)
-        if self.processed_count == len(self.image_threads):
+        self._update_progress_bar()
+        if self.processed_count == self.total_count:
             QMessageBox.information(self, "Завершено", "Обработка завершена с ошибками.")
             self.reset_processing_state()
     
     def cancel_image_processing(self):
-        """Отменяет все запущенные потоки обработки."""
-        for thread in self.image_threads: thread.stop()
+        """Отменяет запущенную обработку: файлы, ещё не отданные в работу, пропускаются."""
+        if self.processing_thread is not None:
+            # Отключаем сигналы, чтобы запоздавшие результаты не попали в следующий запуск
+            self.processing_thread.finished_one.disconnect()
+            self.processing_thread.error.disconnect()
+            self.processing_thread.partial_progress.disconnect()
+            self.processing_thread.stop()
         self.reset_processing_state()
         QMessageBox.information(self, "Отмена", "Обработка была отменена.")
 
@@ -367,7 +620,9 @@ class ImageTab(QWidget):
             position=self.combo_position_img.currentText(), opacity=self.slider_opacity_img.value(),
             font_name=self.combo_font_img.currentText(), font_size_relative=self.spin_font_size_img.value(),
             offset_x=self.spin_offset_x.value(), offset_y=self.spin_offset_y.value(),
-            image_path=self.banner_path, image_scale=self.spin_banner_scale.value()
+            image_path=self.banner_path, image_scale=self.spin_banner_scale.value(),
+            tile_spacing=self.spin_tile_spacing.value(), tile_angle=self.spin_tile_angle.value(),
+            tile_stagger=self.check_tile_stagger.isChecked()
         )
     
     def reset_processing_state(self, is_processing=False):
@@ -378,19 +633,24 @@ class ImageTab(QWidget):
         if not is_processing:
             self.progress_bar_img.setValue(0)
             self.processed_count = 0
-            self.image_threads = []
+            self.partial_count = 0.0
+            self.total_count = 0
+            self.processing_thread = None
             self._update_apply_button_state()
             
     def _update_apply_button_state(self):
         """Включает или выключает кнопку 'Применить' в зависимости от того, есть ли картинки в списке."""
-        self.watermark_button_img.setEnabled(self.image_list_widget.count() > 0)
+        self.watermark_button_img.setEnabled(self.image_model.rowCount() > 0)
 
     def load_settings(self):
         """Загружает настройки при старте приложения."""
         self.input_watermark_img.setText(self.settings.value("text_watermark", "Watermark"))
         self.combo_position_img.setCurrentText(self.settings.value("position", "Центр"))
         self.slider_opacity_img.setValue(self.settings.value("opacity", 128, type=int))
-        self.combo_font_img.setCurrentText(self.settings.value("font_name", "Arial"))
+        font_name = self.settings.value("font_name", "Arial")
+        if self.combo_font_img.findText(font_name) < 0:
+            self.combo_font_img.addItem(font_name)
+        self.combo_font_img.setCurrentText(font_name)
         self.spin_font_size_img.setValue(self.settings.value("font_size", 10, type=int))
         self.spin_offset_x.setValue(self.settings.value("offset_x", 0, type=int))
         self.spin_offset_y.setValue(self.settings.value("offset_y", 0, type=int))
@@ -400,6 +660,12 @@ class ImageTab(QWidget):
         else:
             self.label_banner_path.setText("Файл не выбран")
         self.spin_banner_scale.setValue(self.settings.value("banner_scale", 25, type=int))
+        self.spin_tile_spacing.setValue(self.settings.value("tile_spacing", DEFAULT_WATERMARK_PARAMS.tile_spacing, type=int))
+        self.spin_tile_angle.setValue(self.settings.value("tile_angle", DEFAULT_WATERMARK_PARAMS.tile_angle, type=int))
+        self.check_tile_stagger.setChecked(self.settings.value("tile_stagger", DEFAULT_WATERMARK_PARAMS.tile_stagger, type=bool))
+        self.spin_workers.setValue(self.settings.value("max_workers", default_worker_count(), type=int))
+        self.check_skip_unchanged.setChecked(self.settings.value("skip_unchanged", True, type=bool))
+        self.spin_jpeg_quality.setValue(self.settings.value("jpeg_quality", EncodingOptions().jpeg_quality, type=int))
         wm_type = self.settings.value("wm_type", "text")
         if wm_type == 'image': self.radio_image_wm.setChecked(True)
         else: self.radio_text_wm.setChecked(True)
@@ -417,3 +683,9 @@ class ImageTab(QWidget):
         self.settings.setValue("offset_y", self.spin_offset_y.value())
         self.settings.setValue("banner_path", self.banner_path)
         self.settings.setValue("banner_scale", self.spin_banner_scale.value())
+        self.settings.setValue("tile_spacing", self.spin_tile_spacing.value())
+        self.settings.setValue("tile_angle", self.spin_tile_angle.value())
+        self.settings.setValue("tile_stagger", self.check_tile_stagger.isChecked())
+        self.settings.setValue("max_workers", self.spin_workers.value())
+        self.settings.setValue("skip_unchanged", self.check_skip_unchanged.isChecked())
+        self.settings.setValue("jpeg_quality", self.spin_jpeg_quality.value())
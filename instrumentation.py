@@ -0,0 +1,251 @@
+"""
+Замеры по этапам обработки и профилирование выборки файлов.
+
+Замеры включаются на процесс (set_instrumentation), как и способ смешивания
+в utils.set_compositing_backend; в рабочие процессы пакета настройки передаёт
+batch.run_batch. Выключенные замеры почти ничего не стоят: stage_timer() проверяет
+одну глобальную переменную и возвращает один и тот же пустой контекстный менеджер.
+
+В рабочем процессе batch оборачивает каждую задачу в track(): подэтапы, отмеченные
+stage_timer() (поиск шрифта, отрисовка текста, загрузка баннера, смешивание), попадают
+в timings["details"] результата. Каждый profile_every-й файл процесса выполняется под
+cProfile, а при trace_memory - ещё и под tracemalloc (он видит только объекты Python,
+буферы пикселей Pillow в пик не входят).
+
+На стороне запуска RunStats собирает по каждому файлу время этапов и объём данных,
+строит гистограммы и сохраняет всё в JSON или CSV.
+"""
+import os
+import csv
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import tracemalloc
+from collections import namedtuple
+
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# profile_every - профилировать каждый N-й файл процесса (0 - не профилировать),
+# profile_dir - куда складывать .prof (None - только список самых дорогих функций в замерах),
+# trace_memory - замерять пик памяти Python-объектов у профилируемых файлов
+InstrumentationConfig = namedtuple("InstrumentationConfig", ["profile_every", "profile_dir", "trace_memory"],
+                                   defaults=[0, None, False])
+
+# Верхние границы корзин гистограмм, мс (последняя корзина - всё, что дольше)
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Сколько самых дорогих функций профиля сохранять в замерах
+PROFILE_TOP_FUNCTIONS = 10
+
+_config = None
+_current = None  # Подэтапы файла, который обрабатывается сейчас (в рабочем процессе он один)
+_current_lock = threading.Lock()  # Варианты одного файла (variants.py) пишут подэтапы из разных потоков
+_tracked = 0
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def configure_logging(level: int):
+    """Настраивает корневой логгер; вызывается только точками входа (интерфейс, консоль, рабочие процессы)."""
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+    logging.getLogger().setLevel(level)  # basicConfig не трогает уже настроенный логгер
+
+
+def set_instrumentation(config: InstrumentationConfig | None):
+    """Включает замеры в этом процессе (None - выключает)."""
+    global _config
+    _config = config
+
+
+def get_instrumentation() -> InstrumentationConfig | None:
+    return _config
+
+
+class _StageTimer:
+    __slots__ = ("name", "details", "started")
+
+    def __init__(self, name: str, details: dict):
+        self.name, self.details = name, details
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.started
+        with _current_lock:
+            stages = self.details["stages"]
+            stages[self.name] = stages.get(self.name, 0.0) + seconds
+
+
+def stage_timer(name: str):
+    """Контекстный менеджер подэтапа: время добавляется к файлу, который сейчас в track()."""
+    details = _current
+    if details is None:
+        return _NULL_STAGE
+    return _StageTimer(name, details)
+
+
+@contextlib.contextmanager
+def track(image_path: str):
+    """
+    Отслеживает обработку одного файла. Даёт словарь подэтапов ({"stages": {...}},
+    у профилируемых файлов ещё "profile_top", "profile" и "python_peak_bytes")
+    или None, если замеры выключены.
+    """
+    global _current, _tracked
+    config = _config
+    if config is None:
+        yield None
+        return
+    details = {"stages": {}}
+    _tracked += 1
+    profiler = None
+    tracing = False
+    if config.profile_every and (_tracked - 1) % config.profile_every == 0:
+        profiler = cProfile.Profile()
+        tracing = config.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+    _current = details
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield details
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        _current = None
+        if tracing:
+            details["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if profiler is not None:
+            _store_profile(profiler, image_path, config, details)
+
+
+def _store_profile(profiler: cProfile.Profile, image_path: str, config: InstrumentationConfig, details: dict):
+    stats = pstats.Stats(profiler)
+    # Ключ - (файл, строка, функция), значение - (вызовы, примитивные вызовы, собственное время, общее, вызывающие)
+    top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    details["profile_top"] = [[f"{os.path.basename(path)}:{line}({func})", round(cumulative, 6)]
+                              for (path, line, func), (_, _, _, cumulative, _) in top]
+    if config.profile_dir:
+        os.makedirs(config.profile_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        profile_path = os.path.join(config.profile_dir, f"{stem}.{os.getpid()}.{_tracked}.prof")
+        stats.dump_stats(profile_path)
+        details["profile"] = profile_path
+
+
+def _file_size(path: str) -> int | None:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RunStats:
+    """
+    Замеры пакета по файлам. add() принимает batch.BatchResult (или результат конвейера):
+    время этапов из timings, подэтапы из timings["details"], объём исходника и результатов.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, result):
+        task, timings = result.task, result.timings
+        details = timings.get("details") or {}
+        stages = {stage: seconds for stage, seconds in timings.items() if isinstance(seconds, float)}
+        stages.update(details.get("stages", {}))
+        encoded = timings.get("encoded")
+        if encoded:
+            output_bytes = sum(entry[2] for entry in encoded)
+        elif result.error is None:
+            # Видео и большие TIFF пишут файл сами - берём размер с диска
+            outputs = getattr(task, "outputs", None)
+            paths = [output.result_path for output in outputs] if outputs else [task.result_path]
+            output_bytes = sum(_file_size(path) or 0 for path in paths)
+        else:
+            output_bytes = 0
+        record = {
+            "input": task.image_path, "ok": result.error is None, "error": result.error,
+            "input_bytes": _file_size(task.image_path), "output_bytes": output_bytes, "stages": stages,
+        }
+        for key in ("python_peak_bytes", "profile", "profile_top"):
+            if key in details:
+                record[key] = details[key]
+        self.records.append(record)
+
+    def stage_names(self) -> list[str]:
+        names = []
+        for record in self.records:
+            names.extend(stage for stage in record["stages"] if stage not in names)
+        return names
+
+    def stage_values(self, stage: str) -> list[float]:
+        return [record["stages"][stage] for record in self.records if stage in record["stages"]]
+
+    def histograms(self) -> dict:
+        """Этап -> число файлов в каждой корзине HISTOGRAM_BOUNDS_MS (и последняя - дольше всех границ)."""
+        histograms = {}
+        for stage in self.stage_names():
+            counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+            for seconds in self.stage_values(stage):
+                ms = seconds * 1000
+                counts[next((i for i, bound in enumerate(HISTOGRAM_BOUNDS_MS) if ms <= bound),
+                            len(HISTOGRAM_BOUNDS_MS))] += 1
+            histograms[stage] = counts
+        return histograms
+
+    def summary(self) -> dict:
+        summary = {}
+        for stage in self.stage_names():
+            values = self.stage_values(stage)
+            summary[stage] = {"count": len(values), "total": sum(values), "p50": _percentile(values, 0.5),
+                              "p95": _percentile(values, 0.95), "max": max(values)}
+        return summary
+
+    def format_histograms(self, width: int = 30) -> str:
+        lines = []
+        summary = self.summary()
+        input_bytes = sum(record["input_bytes"] or 0 for record in self.records)
+        output_bytes = sum(record["output_bytes"] for record in self.records)
+        lines.append(f"Прочитано {input_bytes / 2 ** 20:.1f} МБ, записано {output_bytes / 2 ** 20:.1f} МБ")
+        labels = [f"<= {bound} мс" for bound in HISTOGRAM_BOUNDS_MS] + [f"> {HISTOGRAM_BOUNDS_MS[-1]} мс"]
+        for stage, counts in self.histograms().items():
+            info = summary[stage]
+            lines.append(f"\n{stage} (файлов {info['count']}, медиана {info['p50'] * 1000:.1f} мс, "
+                         f"p95 {info['p95'] * 1000:.1f} мс, макс {info['max'] * 1000:.1f} мс)")
+            peak = max(counts)
+            for label, count in zip(labels, counts):
+                if count:
+                    lines.append(f"  {label:>12} {'#' * max(1, round(count / peak * width)):<{width}} {count}")
+        return "\n".join(lines)
+
+    def export(self, path: str):
+        """Сохраняет замеры: .csv - строка на файл, иначе JSON с записями, сводкой и гистограммами."""
+        if path.lower().endswith(".csv"):
+            stages = self.stage_names()
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["input", "ok", "error", "input_bytes", "output_bytes", "python_peak_bytes",
+                                 "profile"] + [f"{stage}_ms" for stage in stages])
+                for record in self.records:
+                    writer.writerow([record["input"], record["ok"], record["error"] or "", record["input_bytes"],
+                                     record["output_bytes"], record.get("python_peak_bytes", ""),
+                                     record.get("profile", "")]
+                                    + [f"{record['stages'][stage] * 1000:.3f}" if stage in record["stages"] else ""
+                                       for stage in stages])
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"histogram_bounds_ms": list(HISTOGRAM_BOUNDS_MS), "summary": self.summary(),
+                       "histograms": self.histograms(), "records": self.records}, f, ensure_ascii=False, indent=2)
@@ -1,9 +1,52 @@
 import sys
-from PyQt6.QtWidgets import QApplication, QMainWindow
-from PyQt6.QtCore import QSettings
-from image_tab import ImageTab
+import time
+_started = time.perf_counter()  # Начало отсчёта для --startup-timing
+import logging
+import importlib
+from PyQt6.QtWidgets import QApplication, QMainWindow, QLabel, QMessageBox
+from PyQt6.QtCore import Qt, QSettings, QThread, QObject, QEvent, pyqtSignal
+from instrumentation import configure_logging
+
+
+# Вкладка тянет Pillow, NumPy и модули обработки - это самая долгая часть запуска.
+# Поэтому окно сначала рисуется с заглушкой, а image_tab импортируется в фоне.
+class ModuleLoader(QThread):
+    loaded = pyqtSignal()
+    failed = pyqtSignal(str)  # Текст ошибки импорта
+
+    def run(self):
+        try:
+            importlib.import_module("image_tab")
+        except Exception as e:
+            logging.error("Failed to import the interface module", exc_info=True)
+            self.failed.emit(f"{type(e).__name__}: {e}")
+            return
+        self.loaded.emit()
+
+
+class StartupTimer(QObject):
+    """Замеры запуска (--startup-timing): время от начала main.py до каждого этапа."""
+
+    def __init__(self):
+        super().__init__()
+        self.marks = {}
+
+    def mark(self, name: str):
+        self.marks.setdefault(name, time.perf_counter() - _started)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint:
+            self.mark("first_paint")
+        return False
+
+    def report(self):
+        for name, seconds in self.marks.items():
+            print(f"{name:<12} {seconds * 1000:8.1f} мс")
+
 
 class MainWindow(QMainWindow):
+    tab_ready = pyqtSignal()  # Вкладка создана и вставлена в окно
+
     def __init__(self):
        
         super().__init__()
@@ -21,24 +64,69 @@ class MainWindow(QMainWindow):
             print("Файл 'style.qss' не найден. Стили не будут применены.")
 
        
-        self.image_tab = ImageTab(self.settings)
-
-        
-        self.setCentralWidget(self.image_tab)
+        self.image_tab = None
+        loading_label = QLabel("Загрузка...")
+        loading_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.setCentralWidget(loading_label)
 
        
         self.resize(1000, 700)
 
+        self.module_loader = ModuleLoader(self)
+        self.module_loader.loaded.connect(self._create_tabs)
+        self.module_loader.failed.connect(self._show_load_error)
+        self.module_loader.start()
+
+    def _create_tabs(self):
+        from image_tab import ImageTab
+        self.image_tab = ImageTab(self.settings)
+        self.setCentralWidget(self.image_tab)
+        self.tab_ready.emit()
+
+    def _show_load_error(self, message: str):
+        # Без вкладки работать нечем: показываем причину и закрываем окно
+        QMessageBox.critical(self, "Ошибка запуска", f"Не удалось загрузить интерфейс:\n{message}")
+        self.close()
+
+    def closeEvent(self, event):
+        self.module_loader.wait()
+        # Останавливаем фоновые потоки вкладки, иначе Qt завершит их принудительно
+        if self.image_tab is not None:
+            self.image_tab.shutdown()
+        super().closeEvent(event)
+
 
 
 if __name__ == "__main__":
-    
+    configure_logging(logging.INFO)
+    # --startup-timing: напечатать время этапов запуска и выйти, когда загрузится список шрифтов
+    startup_timing = "--startup-timing" in sys.argv
+    if startup_timing:
+        sys.argv.remove("--startup-timing")
+
+    timer = StartupTimer()
+    timer.mark("imports")
+
     app = QApplication(sys.argv)
+    if startup_timing:
+        app.installEventFilter(timer)
 
     
     window = MainWindow()
+    if startup_timing:
+        def on_fonts_loaded():
+            timer.mark("fonts")
+            timer.report()
+            window.close()
+
+        def on_tab_ready():
+            timer.mark("interface")
+            window.image_tab.fonts_loaded.connect(on_fonts_loaded)
+
+        window.tab_ready.connect(on_tab_ready)
 
     
     window.show()
+    timer.mark("window")
 
     sys.exit(app.exec())
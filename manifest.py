@@ -0,0 +1,210 @@
+"""
+Манифест пакетной обработки для повторных (инкрементальных) запусков.
+
+В папке результатов хранится .watermarks_manifest.json: для каждого готового файла -
+какой исходник его дал (размер и время изменения, по желанию - хэш содержимого)
+и хэш параметров водяного знака. При следующем запуске обрабатываются только новые
+и изменившиеся исходники, а при смене параметров - все. Манифест сбрасывается на
+диск по ходу работы, поэтому прерванный или отменённый запуск продолжается с того
+места, где остановился.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+from utils import WatermarkParams, TILE_POSITION
+from variants import VariantTask
+from encoding import EncodingOptions
+
+
+MANIFEST_NAME = ".watermarks_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def params_fingerprint(params: WatermarkParams, max_size: tuple[int, int] | None = None,
+                       encoding: EncodingOptions | None = None) -> str:
+    """
+    Хэш параметров знака; для баннера учитывается и сам файл баннера (размер и время изменения),
+    для вариантов с уменьшением - максимальный размер, а если заданы - и настройки кодирования.
+    """
+    data = params._asdict()
+    if params.position != TILE_POSITION:
+        # Поля замощения на такой знак не влияют - хэш остаётся тем же, что до их появления
+        for field in ("tile_spacing", "tile_angle", "tile_stagger"):
+            del data[field]
+    if max_size is not None:
+        data["max_size"] = list(max_size)
+    if encoding is not None:
+        data["encoding"] = encoding._asdict()
+    if params.watermark_type == "image" and params.image_path and os.path.exists(params.image_path):
+        st = os.stat(params.image_path)
+        data["image_stat"] = [st.st_size, st.st_mtime_ns]
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def file_fingerprint(path: str, content_hash: bool = False) -> dict:
+    st = os.stat(path)
+    fingerprint = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if content_hash:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        fingerprint["sha256"] = digest.hexdigest()
+    return fingerprint
+
+
+def _task_outputs(task) -> list[tuple]:
+    """(путь результата, параметры, максимальный размер) для каждого результата задачи."""
+    if isinstance(task, VariantTask):
+        return [(output.result_path, output.params, output.max_size) for output in task.outputs]
+    return [(task.result_path, task.params, None)]
+
+
+class BatchManifest:
+    """
+    Записи манифеста хранятся по имени выходного файла: так один исходник может давать
+    несколько результатов, и каждый проверяется отдельно.
+    """
+
+    # Как часто сбрасывать манифест на диск во время работы
+    FLUSH_EVERY_FILES = 50
+    FLUSH_EVERY_SECONDS = 2.0
+
+    def __init__(self, output_dir: str, content_hash: bool = False, encoding: EncodingOptions | None = None):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.content_hash = content_hash
+        self.encoding = encoding  # Смена настроек кодирования тоже требует пересоздать результаты
+        self.entries = {}
+        self._dirty = 0
+        self._last_flush = time.monotonic()
+        self._params_cache = {}
+        self._sources = {}  # Абсолютный путь исходника -> отпечаток, снятый до обработки (см. capture)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("entries", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def save(self):
+        """Атомарно записывает манифест (временный файл + os.replace)."""
+        if not os.path.isdir(self.output_dir):
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = 0
+        self._last_flush = time.monotonic()
+
+    def _key(self, result_path: str) -> str:
+        return os.path.relpath(result_path, self.output_dir)
+
+    def _params_hash(self, params: WatermarkParams, max_size) -> str:
+        # Параметры в пакете обычно одни и те же - не пересчитываем хэш на каждый файл
+        key = (params, max_size)
+        if key not in self._params_cache:
+            self._params_cache[key] = params_fingerprint(params, max_size, self.encoding)
+        return self._params_cache[key]
+
+    def _expected_entry(self, image_path: str, params: WatermarkParams, max_size, source: dict) -> dict:
+        return {
+            "input": os.path.abspath(image_path),
+            "source": source,
+            "params": self._params_hash(params, max_size),
+        }
+
+    def capture(self, task) -> dict | None:
+        """
+        Снимает отпечаток исходника задачи до обработки; его и запишет record. Так файл,
+        изменённый во время обработки, при следующем запуске считается изменившимся.
+        None, если файл не прочитать.
+        """
+        try:
+            source = file_fingerprint(task.image_path, self.content_hash)
+        except OSError:
+            self._sources.pop(os.path.abspath(task.image_path), None)
+            return None
+        self._sources[os.path.abspath(task.image_path)] = source
+        return source
+
+    def _output_up_to_date(self, image_path: str, result_path: str, params: WatermarkParams, max_size,
+                           current: dict) -> bool:
+        entry = self.entries.get(self._key(result_path))
+        if entry is None or not os.path.exists(result_path):
+            return False
+        expected = self._expected_entry(image_path, params, max_size, current)
+        if entry.get("input") != expected["input"] or entry.get("params") != expected["params"]:
+            return False
+        source = entry.get("source", {})
+        if self.content_hash and "sha256" in source:
+            # Хэш содержимого надёжнее времени изменения (например, после копирования папки)
+            return source["sha256"] == current["sha256"]
+        return source.get("size") == current["size"] and source.get("mtime_ns") == current["mtime_ns"]
+
+    def is_up_to_date(self, task) -> bool:
+        """Проверяет задачу; отпечаток исходника запоминается для record (см. capture)."""
+        current = self.capture(task)
+        return current is not None and all(self._output_up_to_date(task.image_path, *output, current)
+                                           for output in _task_outputs(task))
+
+    def pending_tasks(self, tasks) -> tuple[list, int]:
+        """
+        Возвращает (задачи, которые нужно выполнить, число пропущенных как актуальные).
+        У задач с вариантами остаются только неактуальные варианты.
+        """
+        pending, skipped = [], 0
+        for task in tasks:
+            # Отпечаток снимается один раз на исходник и остаётся для record
+            current = self.capture(task)
+            if current is None:
+                pending.append(task)
+                continue
+            if isinstance(task, VariantTask):
+                outputs = tuple(output for output in task.outputs
+                                if not self._output_up_to_date(task.image_path, *output, current))
+                stale = task._replace(outputs=outputs) if outputs else None
+            else:
+                stale = None if self._output_up_to_date(task.image_path, task.result_path, task.params, None,
+                                                        current) else task
+            if stale is not None:
+                pending.append(stale)
+            else:
+                skipped += 1
+                self._sources.pop(os.path.abspath(task.image_path), None)  # Отпечаток не понадобится
+        return pending, skipped
+
+    def record(self, task):
+        """
+        Отмечает задачу выполненной; манифест периодически сбрасывается на диск. Записывается
+        отпечаток, снятый до обработки (capture, pending_tasks, is_up_to_date); если его нет,
+        исходник читается сейчас.
+        """
+        source = self._sources.pop(os.path.abspath(task.image_path), None)
+        if source is None:
+            try:
+                source = file_fingerprint(task.image_path, self.content_hash)
+            except OSError as e:
+                logging.warning(f"Could not fingerprint {task.image_path} for manifest: {e}")
+                return
+        for result_path, params, max_size in _task_outputs(task):
+            self.entries[self._key(result_path)] = self._expected_entry(task.image_path, params, max_size, source)
+        self._dirty += 1
+        if self._dirty >= self.FLUSH_EVERY_FILES or time.monotonic() - self._last_flush >= self.FLUSH_EVERY_SECONDS:
+            self.save()
+
+    def forget(self, task):
+        self._sources.pop(os.path.abspath(task.image_path), None)
+        for result_path, _, _ in _task_outputs(task):
+            self.entries.pop(self._key(result_path), None)
@@ -0,0 +1,294 @@
+"""
+Конвейерная обработка: чтение, декодирование, наложение знака, кодирование и запись
+идут одновременно в отдельных потоках, соединённых очередями ограниченной длины.
+
+Пока процессор кодирует один файл, следующий уже читается с диска (или из сетевой
+папки), а готовые байты пишутся асинхронно. Pillow отпускает GIL на декодировании,
+смешивании и кодировании, поэтому потоки действительно работают параллельно.
+Длина очередей и число потоков на каждом этапе настраиваются (PipelineConfig),
+после прогона доступна загрузка каждого этапа (ImagePipeline.report()). Бюджет памяти
+(memory_budget) ограничивает файлы в конвейере так же, как в batch.run_batch.
+"""
+import io
+import os
+import mmap
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+
+from utils import apply_watermark_to_pillow_image, open_image, atomic_output, FILE_MAX_IMAGE_PIXELS
+from encoding import save_image
+from batch import BatchResult, estimate_task_memory
+from video import is_video_file, watermark_video
+from tiled import use_tiled_processing, watermark_tiff_tiled
+from animation import use_animation_processing, watermark_animation
+
+
+# Число потоков на этапах и длина очередей между ними.
+# read_mode: "read" - читать файл целиком (лучше для сетевых папок),
+#            "mmap" - отображать в память с подсказкой ядру о предчтении (локальные диски).
+PipelineConfig = namedtuple(
+    "PipelineConfig",
+    ["readers", "decoders", "compositors", "encoders", "writers", "queue_depth", "read_mode"],
+    defaults=[4, os.cpu_count() or 1, os.cpu_count() or 1, os.cpu_count() or 1, 2, 8, "read"],
+)
+
+STAGES = ("read", "decode", "watermark", "encode", "write")
+
+_STOP = object()  # Маркер конца потока задач
+
+
+class _Item:
+    """Файл, который движется по конвейеру."""
+    __slots__ = ("task", "data", "image", "error", "timings", "tiled", "animated", "footprint")
+
+    def __init__(self, task, footprint: int = 0):
+        self.task, self.data, self.image, self.error, self.timings = task, None, None, None, {}
+        self.footprint = footprint  # Оценка памяти (batch.estimate_task_memory), если задан бюджет
+        self.tiled = False  # Большой TIFF: обрабатывается по полосам целиком на этапе знака
+        self.animated = False  # Анимация или многостраничный TIFF: обрабатывается по кадрам на этапе знака
+
+
+class StageStats:
+    """Суммарное время работы этапа, число файлов и объём данных."""
+
+    def __init__(self, workers: int):
+        self.workers, self.busy, self.items, self.bytes = workers, 0.0, 0, 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, nbytes: int = 0):
+        with self._lock:
+            self.busy += seconds
+            self.items += 1
+            self.bytes += nbytes
+
+    def utilization(self, elapsed: float) -> float:
+        """Доля времени, когда потоки этапа были заняты (1.0 - все потоки работали всё время)."""
+        return self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0
+
+
+class ImagePipeline:
+    def __init__(self, config: PipelineConfig | None = None, memory_budget: int | None = None):
+        """
+        memory_budget - сколько байт могут занимать декодированные кадры всех файлов в конвейере
+        (см. batch.run_batch); None - без ограничения.
+        """
+        self.config = config or PipelineConfig()
+        self.memory_budget = memory_budget
+        self.stats = {}
+        self.elapsed = 0.0
+        self._stop = threading.Event()  # Отмена (cancel), в том числе до запуска run
+        self._stopped = self._stop.is_set  # Остановка текущего прогона: отмена или закрытие генератора
+
+    def cancel(self):
+        """
+        Останавливает текущий прогон из другого потока: файлы бросаются на ближайшей
+        границе этапов, видео - на ближайшем кадре; недописанные результаты не остаются.
+        Если вызвать до run, прогон не начнёт ни одного файла.
+        """
+        self._stop.set()
+
+    # --- Этапы ---
+
+    def _read(self, item):
+        if is_video_file(item.task.image_path):
+            return 0  # Видео читает сам ffmpeg на этапе наложения знака
+        if use_tiled_processing(item.task.image_path, item.task.result_path):
+            item.tiled = True  # Файл целиком в память не читаем (см. tiled.py)
+            return 0
+        if use_animation_processing(item.task.image_path, item.task.result_path):
+            item.animated = True  # Кадры читаются по одному (см. animation.py)
+            return 0
+        with open(item.task.image_path, "rb") as f:
+            if self.config.read_mode == "mmap":
+                item.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(item.data, "madvise"):
+                    item.data.madvise(mmap.MADV_WILLNEED)
+            else:
+                item.data = f.read()
+        return len(item.data)
+
+    def _decode(self, item):
+        if item.data is None:
+            return 0
+        source = item.data if isinstance(item.data, mmap.mmap) else io.BytesIO(item.data)
+        item.image = open_image(source, FILE_MAX_IMAGE_PIXELS)
+        nbytes = len(item.data)
+        if isinstance(item.data, mmap.mmap):
+            item.data.close()
+        item.data = None
+        return nbytes
+
+    def _watermark(self, item):
+        task = item.task
+        if is_video_file(task.image_path):
+            video_timings = watermark_video(task.image_path, task.result_path, task.params,
+                                            should_cancel=self._stopped)
+            item.timings.update(video_timings)
+            return 0
+        if item.tiled:
+            item.timings.update(watermark_tiff_tiled(task.image_path, task.result_path, task.params,
+                                                     should_cancel=self._stopped))
+            return 0
+        if item.animated:
+            item.timings.update(watermark_animation(task.image_path, task.result_path, task.params,
+                                                    should_cancel=self._stopped))
+            return 0
+        item.image = apply_watermark_to_pillow_image(item.image, task.params, in_place=True)
+        return 0
+
+    def _encode(self, item):
+        if item.image is None:
+            return 0
+        buffer = io.BytesIO()
+        started = time.perf_counter()
+        fmt, nbytes = save_image(item.image, buffer, item.task.result_path)
+        item.timings["encoded"] = [(fmt, time.perf_counter() - started, nbytes)]
+        item.image = None
+        item.data = buffer.getvalue()
+        return nbytes
+
+    def _write(self, item):
+        if item.data is None:
+            return 0
+        with atomic_output(item.task.result_path) as tmp_path, open(tmp_path, "wb") as f:
+            f.write(item.data)
+        nbytes = len(item.data)
+        item.data = None
+        return nbytes
+
+    # --- Запуск ---
+
+    def run(self, tasks):
+        """
+        Прогоняет задачи (batch.BatchTask) через конвейер и отдаёт BatchResult по мере готовности.
+        Если генератор закрыть раньше времени, все этапы останавливаются.
+        """
+        config = self.config
+        workers = dict(zip(STAGES, (config.readers, config.decoders, config.compositors,
+                                    config.encoders, config.writers)))
+        workers = {stage: max(1, count) for stage, count in workers.items()}
+        handlers = dict(zip(STAGES, (self._read, self._decode, self._watermark, self._encode, self._write)))
+        self.stats = {stage: StageStats(workers[stage]) for stage in STAGES}
+        queues = [queue.Queue(maxsize=max(1, config.queue_depth)) for _ in range(len(STAGES) + 1)]
+        closed = threading.Event()  # Генератор закрыт или дочитан
+        budget = self.memory_budget
+        admission = threading.Condition()
+        in_flight = {"count": 0, "reserved": 0}  # Файлы в конвейере и сумма их оценок памяти
+
+        def stopped():
+            return closed.is_set() or self._stop.is_set()
+
+        self._stopped = stopped
+
+        def put(q, value):
+            # put с таймаутом, чтобы поток заметил остановку, даже если очередь полна
+            while not stopped():
+                try:
+                    q.put(value, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q):
+            while not stopped():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _STOP
+
+        def admit(item) -> bool:
+            # Как в run_batch: файл ждёт, пока освободится память; больше всего бюджета - только в пустом конвейере
+            with admission:
+                while in_flight["count"] and in_flight["reserved"] + item.footprint > budget:
+                    if stopped():
+                        return False
+                    admission.wait(0.1)
+                in_flight["count"] += 1
+                in_flight["reserved"] += item.footprint
+            return True
+
+        def release(item):
+            with admission:
+                in_flight["count"] -= 1
+                in_flight["reserved"] -= item.footprint
+                admission.notify()
+
+        def feeder():
+            for task in tasks:
+                item = _Item(task, estimate_task_memory(task) if budget is not None else 0)
+                if budget is not None and not admit(item):
+                    return
+                if not put(queues[0], item):
+                    return
+            for _ in range(workers[STAGES[0]]):
+                put(queues[0], _STOP)
+
+        def stage_worker(index, stage, remaining):
+            handler, stats = handlers[stage], self.stats[stage]
+            inbox, outbox = queues[index], queues[index + 1]
+            while True:
+                item = get(inbox)
+                if item is _STOP:
+                    break
+                if item.error is None:
+                    started = time.perf_counter()
+                    try:
+                        nbytes = handler(item)
+                    except Exception as e:
+                        logging.error(f"Error processing image file {item.task.image_path} ({stage}): {e}")
+                        item.error, item.data, item.image = str(e), None, None
+                        nbytes = 0
+                    seconds = time.perf_counter() - started
+                    stats.add(seconds, nbytes)
+                    if stage not in item.timings:
+                        item.timings[stage] = seconds
+                if not put(outbox, item):
+                    return
+            # Последний поток этапа передаёт маркер конца следующему этапу
+            with remaining["lock"]:
+                remaining["count"] -= 1
+                last = remaining["count"] == 0
+            if last:
+                next_workers = workers[STAGES[index + 1]] if index + 1 < len(STAGES) else 1
+                for _ in range(next_workers):
+                    put(outbox, _STOP)
+
+        threads = [threading.Thread(target=feeder, name="pipeline-feeder", daemon=True)]
+        for index, stage in enumerate(STAGES):
+            remaining = {"count": workers[stage], "lock": threading.Lock()}
+            for n in range(workers[stage]):
+                threads.append(threading.Thread(target=stage_worker, args=(index, stage, remaining),
+                                                name=f"pipeline-{stage}-{n}", daemon=True))
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is _STOP:
+                    break
+                if budget is not None:
+                    release(item)
+                yield BatchResult(item.task, item.error, {} if item.error else item.timings)
+        finally:
+            closed.set()
+            self.elapsed = time.perf_counter() - started
+
+    def report(self) -> str:
+        """Таблица загрузки этапов за последний прогон."""
+        lines = [f"{'этап':<12}{'потоков':>9}{'файлов':>9}{'занят, с':>11}{'загрузка':>11}{'МБ':>10}"]
+        for stage, stats in self.stats.items():
+            lines.append(f"{stage:<12}{stats.workers:>9}{stats.items:>9}{stats.busy:>11.2f}"
+                         f"{stats.utilization(self.elapsed) * 100:>10.0f}%{stats.bytes / 2 ** 20:>10.1f}")
+        return "\n".join(lines)
+
+
+def run_pipeline(tasks, config: PipelineConfig | None = None, memory_budget: int | None = None):
+    """Короткая форма: ImagePipeline(config, memory_budget).run(tasks)."""
+    return ImagePipeline(config, memory_budget).run(tasks)
@@ -0,0 +1,396 @@
+"""
+Локальный HTTP-сервис водяных знаков для других программ: байты изображения на вход,
+байты результата на выход, без временных файлов.
+
+Запуск:
+    python -m server --port 8765 --workers 4 --preset web.json
+
+Запрос:
+    POST /watermark?format=webp
+    X-Watermark-Params: {"text": "© Studio", "position": "bottom-right"}
+    <байты изображения>
+
+Параметры знака - JSON с полями WatermarkParams поверх параметров сервера (заголовок
+X-Watermark-Params или параметр params в строке запроса), format - формат результата
+(по умолчанию - как у исходника). GET /health - состояние и загрузка, GET /metrics - счётчики.
+Значения полей проверяются до обработки (400 при неверном типе). Путь к файлу шрифта
+в font_name запрос задать не может, а image_path - только имя файла в --banner-dir.
+
+Сервер написан на asyncio без сторонних пакетов. Декодирование, знак и кодирование
+идут в постоянном пуле процессов (batch.create_worker_pool); отрисованные знаки
+кэшируются в рабочих процессах (utils.render_watermark_layer) и переживают запросы.
+Одновременно обрабатывается не больше --max-in-flight изображений, ещё --max-queue ждут
+своей очереди; остальные запросы сразу получают 503 с Retry-After, а тело больше
+--max-body-mb - 413, не читаясь целиком.
+"""
+import io
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import argparse
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, UnidentifiedImageError
+
+from utils import WatermarkParams, params_from_dict, process_image_bytes
+from batch import create_worker_pool, default_worker_count
+from encoding import EXTENSION_BY_FORMAT, FORMAT_BY_EXTENSION, is_format_available
+from instrumentation import configure_logging
+from cli import (POSITION_ALIASES, add_encoding_arguments, add_watermark_arguments, check_params,
+                 encoding_options, resolve_params)
+
+
+DEFAULT_PORT = 8765
+# Сколько ждать заголовков запроса, прежде чем закрыть соединение, с
+HEADER_TIMEOUT = 30.0
+MAX_HEADER_LINES = 100
+# Сколько дочитывать (и выбрасывать) тело отклонённого запроса перед закрытием соединения, с.
+# Если закрыть сокет с непрочитанными данными, клиент получит RST и может не увидеть ответ 413/503
+LINGER_TIMEOUT = 1.0
+
+# Расширения файлов шрифтов: такой font_name - это путь к файлу, а не имя семейства
+FONT_FILE_EXTENSIONS = (".ttf", ".otf", ".ttc", ".otc", ".pfb", ".woff", ".woff2")
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "AVIF": "image/avif",
+                 "TIFF": "image/tiff", "BMP": "image/bmp", "GIF": "image/gif"}
+
+
+class HTTPError(Exception):
+    """Ответ с ошибкой. close - закрыть соединение (например, непрочитанное тело осталось в сокете)."""
+
+    def __init__(self, status: HTTPStatus, message: str = "", headers: dict | None = None, close: bool = False):
+        super().__init__(message or status.phrase)
+        self.status, self.headers, self.close = status, headers or {}, close
+
+
+def _source_extension(data: bytes) -> str:
+    """Расширение результата по формату исходника (заголовок файла, без декодирования)."""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            fmt = image.format
+    except (UnidentifiedImageError, OSError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Body is not a supported image") from None
+    for extension, known_format in FORMAT_BY_EXTENSION.items():
+        if known_format == fmt:
+            return extension
+    return ".png"
+
+
+class WatermarkServer:
+    """
+    HTTP/1.1 с keep-alive поверх asyncio.start_server. Ограничение одновременной работы -
+    семафор на max_in_flight, ожидающие запросы считаются отдельно: если и очередь полна,
+    запрос отклоняется сразу (503), а не копится в памяти.
+    """
+
+    def __init__(self, params: WatermarkParams, max_workers: int | None = None, max_in_flight: int | None = None,
+                 max_queue: int | None = None, max_body: int = 64 * 2 ** 20, encoding=None,
+                 backend: str | None = None, log_level: int | None = None, banner_dir: str | None = None):
+        self.params = params
+        # Откуда запросы могут брать баннеры (image_path); None - только баннер из параметров сервера
+        self.banner_dir = os.path.realpath(banner_dir) if banner_dir else None
+        self.max_workers = max(1, max_workers or default_worker_count())
+        self.max_in_flight = max_in_flight or self.max_workers
+        self.max_queue = self.max_in_flight * 2 if max_queue is None else max_queue
+        self.max_body = max_body
+        self.encoding, self.backend, self.log_level = encoding, backend, log_level
+        self.executor = None
+        self.in_flight = self.waiting = 0
+        self.counters = {"requests": 0, "ok": 0, "rejected_busy": 0, "rejected_too_large": 0, "errors": 0,
+                         "bytes_in": 0, "bytes_out": 0, "processing_seconds": 0.0, "pool_restarts": 0}
+        self._slots = None
+        self._server = None
+        self._connections = {}  # задача обработчика -> writer открытого соединения
+
+    # --- Запуск ---
+
+    async def start(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.executor = self._create_pool()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    def _create_pool(self):
+        return create_worker_pool(self.max_workers, self.log_level, self.backend, encoding=self.encoding)
+
+    def _restart_pool(self, broken):
+        """Пул с упавшим процессом больше не принимает задачи: заменяем его новым (один раз на поломку)."""
+        if self.executor is not broken:
+            return  # Пул уже заменил другой запрос, упавший на той же поломке
+        logging.error("A worker process died, restarting the worker pool")
+        self.executor = self._create_pool()
+        self.counters["pool_restarts"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        # Простаивающие keep-alive соединения закрываем сами: их обработчики ждут следующего запроса
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    # --- HTTP ---
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_head(reader), HEADER_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if request is None:
+                    return
+                method, target, headers = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    status, body, extra = await self._dispatch(method, target, headers, reader, writer)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except Exception as e:
+                    if not isinstance(e, HTTPError):
+                        logging.error(f"Error handling {method} {target}: {e}", exc_info=True)
+                        e = HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR, close=True)
+                    status, extra = e.status, dict(e.headers, **{"Content-Type": "application/json"})
+                    body = json.dumps({"error": str(e)}).encode("utf-8")
+                    if e.close:
+                        await self._write_response(writer, status, body, extra, keep_alive=False)
+                        await self._linger(reader, writer)
+                        return
+                await self._write_response(writer, status, body, extra, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ConnectionError("Malformed request line") from None
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return method, target, headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise ConnectionError("Too many headers")
+
+    @staticmethod
+    async def _write_response(writer, status: HTTPStatus, body: bytes, headers: dict, keep_alive: bool):
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Length: {len(body)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    @staticmethod
+    async def _linger(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Закрывает отправку и недолго выбрасывает то, что клиент ещё досылает."""
+        try:
+            writer.write_eof()
+            deadline = time.monotonic() + LINGER_TIMEOUT
+            while time.monotonic() < deadline:
+                if not await asyncio.wait_for(reader.read(2 ** 16), deadline - time.monotonic()):
+                    break
+        except (asyncio.TimeoutError, OSError):
+            pass
+
+    async def _dispatch(self, method: str, target: str, headers: dict, reader, writer):
+        url = urlsplit(target)
+        if url.path in ("/health", "/metrics"):
+            if method != "GET":
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, headers={"Allow": "GET"}, close=True)
+            data = self.health() if url.path == "/health" else self.metrics()
+            return HTTPStatus.OK, json.dumps(data).encode("utf-8"), {"Content-Type": "application/json"}
+        if url.path != "/watermark":
+            raise HTTPError(HTTPStatus.NOT_FOUND, close=True)
+        if method != "POST":
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, headers={"Allow": "POST"}, close=True)
+        return await self._watermark(url, headers, reader, writer)
+
+    def _request_params(self, query: dict, headers: dict) -> WatermarkParams:
+        raw = headers.get("x-watermark-params") or (query.get("params") or [None])[0]
+        if not raw:
+            return self.params
+        try:
+            data = json.loads(raw)
+            if not isinstance(data, dict):
+                raise ValueError("params must be a JSON object")
+            if isinstance(data.get("position"), str):
+                data["position"] = POSITION_ALIASES.get(data["position"].lower(), data["position"])
+            params = params_from_dict(data, base=self.params)
+            params = self._check_paths(data, params)
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid watermark params: {e}", close=True) from None
+        error = check_params(params)
+        if error:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, error, close=True)
+        return params
+
+    def _check_paths(self, data: dict, params: WatermarkParams) -> WatermarkParams:
+        """
+        Запрос не должен читать произвольные файлы сервера: font_name - только имя семейства,
+        image_path - имя файла внутри --banner-dir.
+        """
+        font_name = data.get("font_name")
+        if font_name and (os.path.isabs(font_name) or "/" in font_name or "\\" in font_name
+                          or font_name.lower().endswith(FONT_FILE_EXTENSIONS)):
+            raise ValueError("font_name must be a font family name, not a path")
+        if data.get("image_path"):
+            if self.banner_dir is None:
+                raise ValueError("image_path cannot be set per request (the server has no --banner-dir)")
+            path = os.path.realpath(os.path.join(self.banner_dir, data["image_path"]))
+            if os.path.commonpath([path, self.banner_dir]) != self.banner_dir:
+                raise ValueError("image_path must point inside the banner directory")
+            params = params._replace(image_path=path)
+        return params
+
+    async def _watermark(self, url, headers: dict, reader, writer):
+        self.counters["requests"] += 1
+        # Всё, что можно проверить до чтения тела, проверяем до него: тело может быть большим
+        if "chunked" in headers.get("transfer-encoding", "").lower() or "content-length" not in headers:
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED, close=True)
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length", close=True) from None
+        if length > self.max_body:
+            self.counters["rejected_too_large"] += 1
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Body exceeds {self.max_body} bytes", close=True)
+        if self.in_flight >= self.max_in_flight and self.waiting >= self.max_queue:
+            self.counters["rejected_busy"] += 1
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server is busy", {"Retry-After": "1"}, close=True)
+        query = parse_qs(url.query)
+        params = self._request_params(query, headers)
+
+        self.waiting += 1
+        try:
+            if headers.get("expect", "").lower() == "100-continue":
+                # Клиент ждёт разрешения, прежде чем слать тело: отказы выше обошлись без его передачи
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            data = await reader.readexactly(length)
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            fmt = (query.get("format") or [None])[0]
+            if fmt is not None:
+                if fmt.lower() not in EXTENSION_BY_FORMAT or not is_format_available(fmt):
+                    raise HTTPError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, f"Unsupported output format: {fmt}")
+                extension = EXTENSION_BY_FORMAT[fmt.lower()]
+            else:
+                extension = _source_extension(data)
+            loop = asyncio.get_running_loop()
+            executor = self.executor
+            try:
+                result, result_format = await loop.run_in_executor(
+                    executor, process_image_bytes, data, params, "result" + extension)
+            except BrokenProcessPool:
+                self.counters["errors"] += 1
+                self._restart_pool(executor)
+                raise HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR, "Worker process died, please retry",
+                                {"Retry-After": "1"}) from None
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+                self.counters["errors"] += 1
+                raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, f"Cannot process image: {e}") from None
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            self.counters["processing_seconds"] += time.perf_counter() - started
+        self.counters["ok"] += 1
+        self.counters["bytes_in"] += length
+        self.counters["bytes_out"] += len(result)
+        return HTTPStatus.OK, result, {"Content-Type": CONTENT_TYPES.get(result_format, "application/octet-stream")}
+
+    def health(self) -> dict:
+        return {"status": "ok", "workers": self.max_workers, "in_flight": self.in_flight, "waiting": self.waiting,
+                "max_in_flight": self.max_in_flight, "max_queue": self.max_queue}
+
+    def metrics(self) -> dict:
+        return dict(self.counters, **self.health())
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m server", description="Локальный HTTP-сервис водяных знаков.")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес (по умолчанию только локальные подключения)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-w", "--workers", type=int, default=default_worker_count(),
+                        help="число рабочих процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="сколько изображений обрабатывать одновременно (по умолчанию - по числу процессов)")
+    parser.add_argument("--max-queue", type=int,
+                        help="сколько запросов может ждать сверх этого, остальным - 503 (по умолчанию - вдвое больше)")
+    parser.add_argument("--max-body-mb", type=float, default=64, help="наибольший размер тела запроса, МБ")
+    parser.add_argument("--preset", help="JSON-файл с параметрами знака по умолчанию (поля WatermarkParams)")
+    parser.add_argument("--backend", choices=["pillow", "numpy"], default="pillow", help="чем смешивать знак")
+    parser.add_argument("--banner-dir",
+                        help="папка, из которой запросы могут брать баннер (image_path); без неё - только баннер сервера")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог рабочих процессов")
+    add_encoding_arguments(parser)
+    add_watermark_arguments(parser)
+    return parser
+
+
+async def _serve(server: WatermarkServer, host: str, port: int):
+    address = await server.start(host, port)
+    logging.info(f"Listening on http://{address[0]}:{address[1]} ({server.max_workers} workers)")
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, task.cancel)
+        except NotImplementedError:
+            pass  # Windows: остановка по Ctrl+C через KeyboardInterrupt
+    try:
+        await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await server.close()
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    configure_logging(logging.INFO)
+    try:
+        params = resolve_params(args)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка в параметрах: {e}", file=sys.stderr)
+        return 2
+    server = WatermarkServer(params, max_workers=args.workers, max_in_flight=args.max_in_flight,
+                             max_queue=args.max_queue, max_body=int(args.max_body_mb * 2 ** 20),
+                             encoding=encoding_options(args), backend=args.backend,
+                             log_level=logging.DEBUG if args.verbose else logging.WARNING, banner_dir=args.banner_dir)
+    asyncio.run(_serve(server, args.host, args.port))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Миниатюры для списка файлов с постоянным кэшем на диске.
+
+Миниатюра декодируется в уменьшенном размере (для JPEG - через draft) и
+сохраняется в кэш под ключом путь + время изменения + размер файла, так что
+при повторном открытии тех же файлов исходники вообще не читаются. Кэш ограничен
+THUMBNAIL_CACHE_MAX_BYTES: при превышении удаляются давно не использованные миниатюры
+(время использования - время изменения файла кэша, оно обновляется при каждом чтении).
+Модуль не зависит от Qt и безопасен для вызова из рабочих потоков.
+"""
+import os
+import hashlib
+import logging
+import platform
+import contextlib
+import threading
+
+from PIL import Image
+
+from utils import load_preview_proxy
+from video import is_video_file, read_video_frame
+
+
+THUMBNAIL_SIZE = (100, 100)
+# Предел кэша миниатюр на диске
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 2 ** 20
+# Очистка оставляет такую долю предела, чтобы не сканировать кэш после каждой новой миниатюры
+THUMBNAIL_CACHE_PRUNE_TO = 0.8
+
+_cache_lock = threading.Lock()
+_cache_bytes = None  # Размер кэша по подсчёту этого процесса; None - кэш ещё не сканировался
+
+
+def thumbnail_cache_dir() -> str:
+    """Папка кэша миниатюр (можно переопределить переменной окружения WATERMARKS_CACHE_DIR)."""
+    if os.environ.get("WATERMARKS_CACHE_DIR"):
+        base = os.environ["WATERMARKS_CACHE_DIR"]
+    elif platform.system() == "Windows":
+        base = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "WatermarkApp")
+    else:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "watermarkapp")
+    return os.path.join(base, "thumbnails")
+
+
+def thumbnail_cache_path(image_path: str, size: tuple[int, int] = THUMBNAIL_SIZE) -> str:
+    st = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}|{size[0]}x{size[1]}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(thumbnail_cache_dir(), digest[:2], digest + ".png")
+
+
+def _scan_cache(cache_dir: str) -> list[tuple[int, int, str]]:
+    """(время использования, размер, путь) всех миниатюр в кэше."""
+    entries = []
+    try:
+        subdirs = [entry.path for entry in os.scandir(cache_dir) if entry.is_dir()]
+    except OSError:
+        return entries
+    for subdir in subdirs:
+        try:
+            with os.scandir(subdir) as it:
+                for entry in it:
+                    if entry.name.endswith(".png"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        except OSError:
+            continue
+    return entries
+
+
+def prune_thumbnail_cache(max_bytes: int | None = None) -> int:
+    """
+    Если кэш больше max_bytes (по умолчанию THUMBNAIL_CACHE_MAX_BYTES), удаляет давно не использованные миниатюры, пока он не уменьшится
+    до THUMBNAIL_CACHE_PRUNE_TO от предела. Возвращает размер кэша после очистки в байтах.
+    """
+    if max_bytes is None:
+        max_bytes = THUMBNAIL_CACHE_MAX_BYTES
+    entries = _scan_cache(thumbnail_cache_dir())
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        target = max_bytes * THUMBNAIL_CACHE_PRUNE_TO
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # Файл читают или его уже удалил другой процесс
+            total -= size
+        logging.debug(f"Pruned thumbnail cache to {total} bytes.")
+    return total
+
+
+def _account_cache_write(nbytes: int):
+    global _cache_bytes
+    with _cache_lock:
+        if _cache_bytes is None or _cache_bytes + nbytes > THUMBNAIL_CACHE_MAX_BYTES:
+            # Кэш могли пополнить и другие копии приложения, поэтому при превышении размер считается заново
+            _cache_bytes = prune_thumbnail_cache()
+        else:
+            _cache_bytes += nbytes
+
+
+def get_thumbnail(image_path: str, size: tuple[int, int] = THUMBNAIL_SIZE) -> Image.Image:
+    """Возвращает миниатюру RGBA из кэша или строит её и кладёт в кэш."""
+    cache_path = thumbnail_cache_path(image_path, size)
+    if os.path.exists(cache_path):
+        try:
+            with Image.open(cache_path) as cached:
+                thumbnail = cached.convert("RGBA")
+            with contextlib.suppress(OSError):
+                os.utime(cache_path)  # Отметка использования для очистки кэша
+            return thumbnail
+        except OSError:
+            logging.debug(f"Broken thumbnail cache entry {cache_path}, rebuilding.")
+
+    if is_video_file(image_path):
+        image = read_video_frame(image_path)
+        image.thumbnail(size, Image.Resampling.BILINEAR)
+        thumbnail = image.convert("RGBA")
+    else:
+        # Тот же загрузчик, что у предпросмотра: огромный файл, который нельзя прочитать уменьшенным,
+        # не декодируется (ошибка - у строки остаётся заглушка)
+        thumbnail = load_preview_proxy(image_path, size)[0].convert("RGBA")
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        thumbnail.save(tmp_path, "PNG")
+        os.replace(tmp_path, cache_path)  # Атомарно: параллельные загрузчики не увидят полуготовый файл
+        _account_cache_write(os.path.getsize(cache_path))
+    except OSError as e:
+        logging.debug(f"Could not write thumbnail cache {cache_path}: {e}")
+    return thumbnail
@@ -0,0 +1,411 @@
+"""
+Водяной знак на огромных TIFF (сканы, склеенные панорамы) с ограниченным расходом памяти.
+
+Изображение целиком не декодируется. Файл копируется в результат как есть (потоком),
+затем перекодируются только те полосы (strips) или плитки (tiles) TIFF, которые
+задевает знак. Несжатые данные переписываются на своём месте, причём длинные полосы
+(и единственная полоса на весь кадр) читаются частями по TILED_BAND_BYTES. Сжатые полосы
+дописываются в конец файла, а в таблицах StripOffsets/StripByteCounts
+(TileOffsets/TileByteCounts) меняются ссылки на них. В памяти одновременно находятся
+одна полоса и плитка знака, каким бы большим ни было изображение. Замощение
+(utils.TILE_POSITION) задевает все полосы, и узор строится для каждой полосы отдельно.
+
+Поддерживаются 8-битные RGB/RGBA без сжатия, с Deflate или LZW, с горизонтальным
+предиктором или без него (классический TIFF и BigTIFF). Сжатые полосы (де)кодирует libtiff
+из Pillow. Тег Orientation учитывается: знак ставится туда, где его увидит зритель, а сам
+тег остаётся в файле (обычный путь вместо этого поворачивает пиксели). Знак ставится только
+на первую страницу (IFD), остальные страницы копируются без изменений.
+
+Если большой TIFF не подходит (другая глубина цвета, CMYK, JPEG-сжатие, сжатая полоса
+больше TILED_MAX_BLOCK_PIXELS), use_tiled_processing пишет в лог предупреждение с причиной
+и возвращает False: файл декодируется целиком обычным путём.
+
+Тем же чтением по полосам load_tiff_reduced строит уменьшенную копию для предпросмотра
+и миниатюр, не декодируя кадр целиком.
+"""
+import io
+import os
+import time
+import shutil
+import struct
+import logging
+from collections import namedtuple
+
+from PIL import Image, features
+
+from utils import (WatermarkParams, WatermarkLayer, TILE_POSITION, render_watermark_layer, render_tile_pattern,
+                   fill_tile_pattern, composite_watermark_layer, atomic_output)
+
+
+# Начиная с этого числа пикселей TIFF обрабатывается по полосам
+TILED_PIXEL_THRESHOLD = 100_000_000
+
+# Несжатая полоса читается частями не больше этого размера
+TILED_BAND_BYTES = 64 * 2 ** 20
+
+# Сжатую полосу/плитку приходится декодировать целиком; если она больше, файл идёт обычным путём
+TILED_MAX_BLOCK_PIXELS = 16_000_000
+
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+# Теги TIFF, которые нужны для разбора
+_TAG_WIDTH, _TAG_HEIGHT, _TAG_BITS, _TAG_COMPRESSION, _TAG_PHOTOMETRIC = 256, 257, 258, 259, 262
+_TAG_STRIP_OFFSETS, _TAG_ORIENTATION, _TAG_SAMPLES, _TAG_ROWS_PER_STRIP, _TAG_STRIP_COUNTS = 273, 274, 277, 278, 279
+_TAG_PLANAR, _TAG_PREDICTOR, _TAG_EXTRA_SAMPLES = 284, 317, 338
+_TAG_TILE_WIDTH, _TAG_TILE_LENGTH, _TAG_TILE_OFFSETS, _TAG_TILE_COUNTS = 322, 323, 324, 325
+
+# Тип поля TIFF -> (формат struct, размер): BYTE, SHORT, LONG, LONG8
+_FIELD_TYPES = {1: ("B", 1), 3: ("H", 2), 4: ("I", 4), 16: ("Q", 8)}
+
+_COMPRESSION_NONE = 1
+# Сжатие -> имя кодека Pillow (libtiff) для перекодирования полос
+_COMPRESSION_CODECS = {5: "tiff_lzw", 8: "tiff_adobe_deflate", 32946: "tiff_deflate"}
+_PREDICTOR_NONE, _PREDICTOR_HORIZONTAL = 1, 2
+
+# Orientation -> преобразование, которое показывает кадр правильно (как в ImageOps.exif_transpose)
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180, 4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE, 6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+_INVERSE_TRANSPOSE = {Image.Transpose.ROTATE_90: Image.Transpose.ROTATE_270,
+                      Image.Transpose.ROTATE_270: Image.Transpose.ROTATE_90}
+
+# Где в файле лежит массив значений тега: тип поля, число значений, смещение
+_FieldRef = namedtuple("_FieldRef", ["field_type", "count", "position"])
+
+# Разметка первой страницы TIFF. blocks - (x, y, высота) каждой полосы/плитки или части
+# несжатой полосы, block_size - наибольший размер блока в пикселях, offsets/byte_counts -
+# где лежат данные блоков. unsupported - причина, по которой файл нельзя обработать
+# по полосам (None, если можно)
+TiffLayout = namedtuple("TiffLayout", [
+    "byte_order", "width", "height", "mode", "compression", "predictor", "orientation", "tiled", "block_size",
+    "blocks", "offsets", "byte_counts", "offsets_ref", "byte_counts_ref", "unsupported",
+])
+
+
+def _read_ifd(f, byte_order: str, bigtiff: bool) -> dict:
+    """Читает первый IFD: тег -> _FieldRef (только теги с поддерживаемыми типами)."""
+    if bigtiff:
+        f.seek(8)
+        ifd_offset, = struct.unpack(byte_order + "Q", f.read(8))
+        f.seek(ifd_offset)
+        count, = struct.unpack(byte_order + "Q", f.read(8))
+        entry_format, entry_size, inline_size = byte_order + "HHQ8s", 20, 8
+    else:
+        f.seek(4)
+        ifd_offset, = struct.unpack(byte_order + "I", f.read(4))
+        f.seek(ifd_offset)
+        count, = struct.unpack(byte_order + "H", f.read(2))
+        entry_format, entry_size, inline_size = byte_order + "HHI4s", 12, 4
+
+    entries_start = f.tell()
+    raw_entries = f.read(count * entry_size)
+    fields = {}
+    for index in range(count):
+        tag, field_type, value_count, value = struct.unpack_from(entry_format, raw_entries, index * entry_size)
+        if field_type not in _FIELD_TYPES:
+            continue
+        value_position = entries_start + index * entry_size + entry_size - inline_size
+        if value_count * _FIELD_TYPES[field_type][1] > inline_size:
+            # Значения не поместились в запись - в ней лежит смещение массива
+            value_position, = struct.unpack(byte_order + ("Q" if bigtiff else "I"), value[:inline_size])
+        fields[tag] = _FieldRef(field_type, value_count, value_position)
+    return fields
+
+
+def _read_values(f, byte_order: str, ref: _FieldRef) -> list[int]:
+    fmt, size = _FIELD_TYPES[ref.field_type]
+    f.seek(ref.position)
+    return list(struct.unpack(f"{byte_order}{ref.count}{fmt}", f.read(ref.count * size)))
+
+
+def _unsupported_reason(photometric, bits, planar, compression, predictor, samples, extra_samples) -> str | None:
+    if photometric != 2 or set(bits) != {8}:
+        return "only 8-bit RGB/RGBA is supported"
+    if planar != 1:
+        return "planar configuration is not supported"
+    if samples == 3 and extra_samples:
+        return "unexpected extra samples"
+    if samples == 4 and extra_samples != [2]:
+        return "only unassociated alpha is supported"
+    if samples not in (3, 4):
+        return f"{samples} samples per pixel are not supported"
+    if compression != _COMPRESSION_NONE and compression not in _COMPRESSION_CODECS:
+        return f"compression {compression} is not supported (only none, Deflate and LZW)"
+    if compression != _COMPRESSION_NONE and not features.check_codec("libtiff"):
+        return "Pillow is built without libtiff"
+    if compression != _COMPRESSION_NONE and predictor not in (_PREDICTOR_NONE, _PREDICTOR_HORIZONTAL):
+        return f"predictor {predictor} is not supported"
+    return None
+
+
+def read_tiff_layout(path: str) -> TiffLayout | None:
+    """
+    Разбирает заголовок TIFF; None, если файл не TIFF или его не прочитать. Если файл
+    нельзя обработать по полосам, причина записывается в поле unsupported.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(4)
+            if header[:2] not in (b"II", b"MM"):
+                return None
+            byte_order = "<" if header[:2] == b"II" else ">"
+            magic, = struct.unpack(byte_order + "H", header[2:4])
+            if magic not in (42, 43):
+                return None
+            fields = _read_ifd(f, byte_order, bigtiff=magic == 43)
+
+            def value(tag, default=None):
+                return _read_values(f, byte_order, fields[tag])[0] if tag in fields else default
+
+            width, height = value(_TAG_WIDTH), value(_TAG_HEIGHT)
+            if not width or not height:
+                return None
+            samples = value(_TAG_SAMPLES, 1)
+            bits = _read_values(f, byte_order, fields[_TAG_BITS]) if _TAG_BITS in fields else [1]
+            extra_samples = _read_values(f, byte_order, fields[_TAG_EXTRA_SAMPLES]) if _TAG_EXTRA_SAMPLES in fields else []
+            compression = value(_TAG_COMPRESSION, _COMPRESSION_NONE)
+            # Предиктор относится только к сжатым данным
+            predictor = value(_TAG_PREDICTOR, _PREDICTOR_NONE) if compression != _COMPRESSION_NONE else _PREDICTOR_NONE
+            orientation = value(_TAG_ORIENTATION, 1)
+            unsupported = _unsupported_reason(value(_TAG_PHOTOMETRIC), bits, value(_TAG_PLANAR, 1), compression,
+                                              predictor, samples, extra_samples)
+            mode = "RGBA" if samples == 4 else "RGB"
+
+            tiled = _TAG_TILE_OFFSETS in fields
+            if tiled:
+                block_size = (value(_TAG_TILE_WIDTH), value(_TAG_TILE_LENGTH))
+                offsets_ref, counts_ref = fields.get(_TAG_TILE_OFFSETS), fields.get(_TAG_TILE_COUNTS)
+                columns = -(-width // block_size[0])
+                rows = -(-height // block_size[1])
+                # Плитки хранятся целиком, с полями за краем изображения
+                blocks = [(column * block_size[0], row * block_size[1], block_size[1])
+                          for row in range(rows) for column in range(columns)]
+            else:
+                rows_per_strip = min(value(_TAG_ROWS_PER_STRIP, height), height)
+                block_size = (width, rows_per_strip)
+                offsets_ref, counts_ref = fields.get(_TAG_STRIP_OFFSETS), fields.get(_TAG_STRIP_COUNTS)
+                blocks = [(0, y, min(rows_per_strip, height - y)) for y in range(0, height, rows_per_strip)]
+            if offsets_ref is None or counts_ref is None or not offsets_ref.count == counts_ref.count == len(blocks):
+                return None
+            offsets = _read_values(f, byte_order, offsets_ref)
+            byte_counts = _read_values(f, byte_order, counts_ref)
+    except (OSError, KeyError, IndexError, struct.error):
+        return None
+
+    if unsupported is None and compression == _COMPRESSION_NONE and not tiled:
+        # Несжатую полосу можно читать и переписывать по частям - делим её на полосы поменьше
+        stride = width * len(mode)
+        band_rows = max(1, min(block_size[1], TILED_BAND_BYTES // stride))
+        band_blocks, band_offsets = [], []
+        for (x, y, rows), offset in zip(blocks, offsets):
+            for row in range(0, rows, band_rows):
+                band_blocks.append((x, y + row, min(band_rows, rows - row)))
+                band_offsets.append(offset + row * stride)
+        blocks, offsets, block_size = band_blocks, band_offsets, (width, band_rows)
+        byte_counts = [stride * rows for _, _, rows in blocks]
+    elif unsupported is None and compression != _COMPRESSION_NONE and block_size[0] * block_size[1] > TILED_MAX_BLOCK_PIXELS:
+        unsupported = (f"compressed {'tiles' if tiled else 'strips'} of {block_size[0]}x{block_size[1]} pixels "
+                       f"are too large (re-save with smaller strips, e.g. tiffcp -r 64)")
+    return TiffLayout(byte_order, width, height, mode, compression, predictor, orientation, tiled, block_size,
+                      blocks, offsets, byte_counts, offsets_ref, counts_ref, unsupported)
+
+
+def use_tiled_processing(image_path: str, result_path: str, threshold: int = TILED_PIXEL_THRESHOLD) -> bool:
+    """
+    Нужно ли (и можно ли) обрабатывать файл по полосам: большой поддерживаемый TIFF -> TIFF.
+    Если большой TIFF не поддерживается, в лог пишется причина, и файл идёт обычным путём.
+    """
+    if not (image_path.lower().endswith(TIFF_EXTENSIONS) and result_path.lower().endswith(TIFF_EXTENSIONS)):
+        return False
+    layout = read_tiff_layout(image_path)
+    if layout is None or layout.width * layout.height < threshold:
+        return False
+    if layout.unsupported is not None:
+        logging.warning(f"Cannot process {image_path} in strips ({layout.unsupported}), decoding the whole image")
+        return False
+    return True
+
+
+def _transpose_box(box: tuple[int, int, int, int], size: tuple[int, int], method) -> tuple[int, int, int, int]:
+    """Куда попадает прямоугольник box кадра размером size после Image.transpose(method)."""
+    left, top, right, bottom = box
+    width, height = size
+    return {
+        Image.Transpose.FLIP_LEFT_RIGHT: (width - right, top, width - left, bottom),
+        Image.Transpose.FLIP_TOP_BOTTOM: (left, height - bottom, right, height - top),
+        Image.Transpose.ROTATE_180: (width - right, height - bottom, width - left, height - top),
+        Image.Transpose.TRANSPOSE: (top, left, bottom, right),
+        Image.Transpose.ROTATE_90: (top, width - right, bottom, width - left),
+        Image.Transpose.ROTATE_270: (height - bottom, left, height - top, right),
+        Image.Transpose.TRANSVERSE: (height - bottom, width - right, height - top, width - left),
+    }[method]
+
+
+def _mini_tiff(layout: TiffLayout, size: tuple[int, int], data: bytes) -> bytes:
+    """Однополосный TIFF (little-endian) вокруг сжатых данных одного блока - чтобы их декодировал libtiff."""
+    samples = len(layout.mode)
+    entries = [
+        (_TAG_WIDTH, 4, 1, size[0]), (_TAG_HEIGHT, 4, 1, size[1]), (_TAG_BITS, 3, samples, None),
+        (_TAG_COMPRESSION, 3, 1, layout.compression), (_TAG_PHOTOMETRIC, 3, 1, 2), (_TAG_STRIP_OFFSETS, 4, 1, None),
+        (_TAG_SAMPLES, 3, 1, samples), (_TAG_ROWS_PER_STRIP, 4, 1, size[1]), (_TAG_STRIP_COUNTS, 4, 1, len(data)),
+        (_TAG_PLANAR, 3, 1, 1), (_TAG_PREDICTOR, 3, 1, layout.predictor),
+    ]
+    if samples == 4:
+        entries.append((_TAG_EXTRA_SAMPLES, 3, 1, 2))
+    bits_offset = 8 + 2 + len(entries) * 12 + 4
+    data_offset = bits_offset + samples * 2
+    ifd = struct.pack("<H", len(entries))
+    for tag, field_type, count, value in entries:
+        value = {_TAG_BITS: bits_offset, _TAG_STRIP_OFFSETS: data_offset}.get(tag, value)
+        # Одиночный SHORT лежит в начале 4-байтового поля, массив (BitsPerSample) - по смещению
+        value_field = struct.pack("<HH", value, 0) if field_type == 3 and count == 1 else struct.pack("<I", value)
+        ifd += struct.pack("<HHI", tag, field_type, count) + value_field
+    return b"II*\0" + struct.pack("<I", 8) + ifd + struct.pack("<I", 0) + struct.pack(f"<{samples}H", *[8] * samples) + data
+
+
+def _decode_block(layout: TiffLayout, size: tuple[int, int], data: bytes) -> Image.Image:
+    if layout.compression == _COMPRESSION_NONE:
+        return Image.frombytes(layout.mode, size, data)
+    with Image.open(io.BytesIO(_mini_tiff(layout, size, data))) as block:
+        block.load()
+        return block.copy() if block.mode == layout.mode else block.convert(layout.mode)
+
+
+def _encode_block(layout: TiffLayout, block: Image.Image) -> bytes:
+    if layout.compression == _COMPRESSION_NONE:
+        return block.tobytes()
+    buffer = io.BytesIO()
+    block.save(buffer, "TIFF", compression=_COMPRESSION_CODECS[layout.compression],
+               tiffinfo={_TAG_ROWS_PER_STRIP: block.height, _TAG_PREDICTOR: layout.predictor})
+    # Из однополосного файла, который записал libtiff, берём только данные полосы
+    buffer.seek(0)
+    with Image.open(buffer) as encoded:
+        (offset,), (count,) = encoded.tag_v2[_TAG_STRIP_OFFSETS], encoded.tag_v2[_TAG_STRIP_COUNTS]
+    return buffer.getbuffer()[offset:offset + count].tobytes()
+
+
+def watermark_tiff_tiled(image_path: str, result_path: str, params: WatermarkParams, should_cancel=None) -> dict:
+    """
+    Накладывает знак на TIFF по полосам. Возвращает время этапов в секундах
+    (copy - потоковое копирование файла, остальные - как у utils.process_image_file).
+    """
+    layout = read_tiff_layout(image_path)
+    if layout is None or layout.unsupported is not None:
+        reason = layout.unsupported if layout is not None else "not a readable TIFF"
+        raise ValueError(f"Unsupported TIFF layout for tiled processing ({reason}): {image_path}")
+    timings = {"copy": 0.0, "decode": 0.0, "watermark": 0.0, "encode": 0.0}
+    size = (layout.width, layout.height)
+    # Знак строится для кадра, каким его видит зритель, и переносится в порядок пикселей файла
+    transpose = _ORIENTATION_TRANSPOSE.get(layout.orientation)
+    inverse = _INVERSE_TRANSPOSE.get(transpose, transpose)
+    display_size = size if transpose is None else Image.new("1", size).transpose(transpose).size
+    layer = pattern = None
+    if params.position == TILE_POSITION:
+        pattern = render_tile_pattern(display_size, params)
+    else:
+        layer = render_watermark_layer(display_size, params)
+        if layer is not None and transpose is not None:
+            box = (layer.x, layer.y, layer.x + layer.image.width, layer.y + layer.image.height)
+            x, y, _, _ = _transpose_box(box, display_size, inverse)
+            layer = WatermarkLayer(layer.image.transpose(inverse), x, y)
+    block_width = layout.block_size[0]
+    in_place = layout.compression == _COMPRESSION_NONE
+    offsets, byte_counts = list(layout.offsets), list(layout.byte_counts)
+    changed = 0
+
+    with atomic_output(result_path) as tmp_path:
+        started = time.perf_counter()
+        shutil.copyfile(image_path, tmp_path)
+        timings["copy"] = time.perf_counter() - started
+
+        with open(image_path, "rb") as src, open(tmp_path, "r+b") as dst:
+            end_of_file = dst.seek(0, os.SEEK_END)
+            for index, (x, y, block_height) in enumerate(layout.blocks):
+                if layer is None and pattern is None:
+                    break
+                if layer is not None and (layer.x >= x + block_width or layer.x + layer.image.width <= x
+                        or layer.y >= y + block_height or layer.y + layer.image.height <= y):
+                    continue  # Полосу знак не задевает - она остаётся как есть
+                if should_cancel is not None and should_cancel():
+                    raise InterruptedError(f"Processing cancelled: {image_path}")
+
+                started = time.perf_counter()
+                src.seek(layout.offsets[index])
+                block = _decode_block(layout, (block_width, block_height), src.read(layout.byte_counts[index]))
+                timings["decode"] += time.perf_counter() - started
+
+                started = time.perf_counter()
+                if pattern is not None:
+                    box = (x, y, min(x + block_width, layout.width), min(y + block_height, layout.height))
+                    region = fill_tile_pattern(pattern, box if transpose is None else
+                                               _transpose_box(box, size, transpose))
+                    block_layer = WatermarkLayer(region if transpose is None else region.transpose(inverse), 0, 0)
+                else:
+                    block_layer = WatermarkLayer(layer.image, layer.x - x, layer.y - y)
+                composite_watermark_layer(block, block_layer, in_place=True)
+                timings["watermark"] += time.perf_counter() - started
+
+                started = time.perf_counter()
+                data = _encode_block(layout, block)
+                if in_place:
+                    dst.seek(offsets[index])  # Несжатый блок того же размера - пишем поверх старого
+                else:
+                    dst.seek(end_of_file)
+                    if end_of_file % 2:
+                        dst.write(b"\0")  # Данные в TIFF выравниваются по слову
+                    offsets[index], byte_counts[index] = dst.tell(), len(data)
+                dst.write(data)
+                end_of_file = max(end_of_file, dst.tell())
+                timings["encode"] += time.perf_counter() - started
+                changed += 1
+
+            if not in_place:
+                started = time.perf_counter()
+                _patch_values(dst, layout.byte_order, layout.offsets_ref, offsets)
+                _patch_values(dst, layout.byte_order, layout.byte_counts_ref, byte_counts)
+                timings["encode"] += time.perf_counter() - started
+
+    logging.info(f"Watermark added to image: {result_path} (tiled, {changed} of {len(layout.blocks)} blocks re-encoded)")
+    return timings
+
+
+def load_tiff_reduced(image_path: str, max_size: tuple[int, int]) -> Image.Image | None:
+    """
+    Уменьшенная до max_size копия TIFF, собранная по полосам (в памяти одна полоса и сама
+    копия), уже повёрнутая по тегу Orientation. None, если файл не TIFF или его разметка
+    не поддерживается.
+    """
+    layout = read_tiff_layout(image_path)
+    if layout is None or layout.unsupported is not None:
+        return None
+    transpose = _ORIENTATION_TRANSPOSE.get(layout.orientation)
+    if transpose in (Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE,
+                     Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270):
+        max_size = (max_size[1], max_size[0])  # Предел задан для кадра, каким его видит зритель
+    scale = min(1.0, max_size[0] / layout.width, max_size[1] / layout.height)
+    reduced = Image.new(layout.mode, (max(1, round(layout.width * scale)), max(1, round(layout.height * scale))))
+    block_width = layout.block_size[0]
+    with open(image_path, "rb") as f:
+        for index, (x, y, block_height) in enumerate(layout.blocks):
+            # Края блоков округляются одинаково для соседей, поэтому копия собирается без щелей
+            left, top = round(x * scale), round(y * scale)
+            right = round(min(x + block_width, layout.width) * scale)
+            bottom = round(min(y + block_height, layout.height) * scale)
+            if right <= left or bottom <= top:
+                continue
+            f.seek(layout.offsets[index])
+            block = _decode_block(layout, (block_width, block_height), f.read(layout.byte_counts[index]))
+            # Плитки на краю изображения хранятся с полями - их отрезаем
+            block = block.crop((0, 0, min(block_width, layout.width - x), min(block_height, layout.height - y)))
+            reduced.paste(block.resize((right - left, bottom - top), Image.Resampling.BOX), (left, top))
+    return reduced if transpose is None else reduced.transpose(transpose)
+
+
+def _patch_values(f, byte_order: str, ref: _FieldRef, values: list[int]):
+    fmt, size = _FIELD_TYPES[ref.field_type]
+    if max(values) >= 1 << (8 * size):
+        raise ValueError("Result does not fit the TIFF offset table (file too large for classic TIFF)")
+    f.seek(ref.position)
+    f.write(struct.pack(f"{byte_order}{len(values)}{fmt}", *values))
@@ -1,15 +1,20 @@
-import shutil
 import os
+import io
+import time
+import socket
 import logging
+import functools
+import threading
+import contextlib
 from collections import namedtuple
-import platform
 
-# ИСПРАВЛЕНИЕ: Добавляем winreg для доступа к реестру Windows
-if platform.system() == "Windows":
-    import winreg
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from fonts import resolve_font_path, load_font
+from compositing import (COMPOSITING_BACKENDS, NumpyWatermark, NumpyTileWatermark, composite_image_numpy,
+                         composite_stack_numpy)
+from encoding import save_image
+from instrumentation import stage_timer
 
 
 WatermarkParams = namedtuple(
@@ -17,64 +22,118 @@ WatermarkParams = namedtuple(
     [
         "watermark_type", "text", "font_name", "font_size_relative", "position",
         "opacity", "offset_x", "offset_y",
-        "image_path", "image_scale"
-    ]
+        "image_path", "image_scale",
+        "tile_spacing", "tile_angle", "tile_stagger"
+    ],
+    # Поля замощения (см. TILE_POSITION) необязательные: пресеты и код, написанные до них, работают как раньше
+    defaults=[50, 30, True]
 )
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Позиция "замостить": знак повторяется по всему изображению. tile_angle - поворот в градусах
+# (против часовой стрелки), tile_spacing - промежуток между повторами в процентах от размера
+# повёрнутого знака, tile_stagger - сдвигать каждый второй ряд на полпериода
+TILE_POSITION = "Замостить"
 
+# Все допустимые позиции знака (как в интерфейсе); другие значения params_from_dict не принимает
+WATERMARK_POSITIONS = ("Центр", "Верхний левый угол", "Верхний правый угол", "Нижний левый угол",
+                       "Нижний правый угол", TILE_POSITION)
 
-def find_font_file_on_windows(font_name: str) -> str | None:
+# Значения по умолчанию совпадают с начальными настройками интерфейса
+DEFAULT_WATERMARK_PARAMS = WatermarkParams(
+    watermark_type="text", text="Watermark", font_name="Arial", font_size_relative=10, position="Центр",
+    opacity=128, offset_x=0, offset_y=0, image_path="", image_scale=25
+)
+
+
+# Типы полей WatermarkParams для params_from_dict: str, int, "number" (int или float) и bool
+_PARAM_TYPES = {
+    "watermark_type": str, "text": str, "font_name": str, "position": str, "image_path": str,
+    "font_size_relative": "number", "opacity": "number", "offset_x": int, "offset_y": int,
+    "image_scale": "number", "tile_spacing": "number", "tile_angle": "number", "tile_stagger": bool,
+}
+
+
+def _coerce_param(field: str, value):
+    """Приводит значение поля к его типу (числа из строк, целые из 1.0); ValueError - если нельзя."""
+    kind = _PARAM_TYPES[field]
+    if kind is str:
+        if value is None:
+            return ""
+        if isinstance(value, str):
+            return value
+    elif kind is bool:
+        if isinstance(value, bool):
+            return value
+        if value in (0, 1):
+            return bool(value)
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+    elif not isinstance(value, bool):
+        if isinstance(value, str):
+            try:
+                value = float(value.strip())
+            except ValueError:
+                raise ValueError(f"{field} must be a number, got {value!r}") from None
+        if isinstance(value, (int, float)) and value == value and abs(value) != float("inf"):
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if kind is int and isinstance(value, float):
+                raise ValueError(f"{field} must be an integer, got {value!r}")
+            return value
+    type_name = kind if isinstance(kind, str) else kind.__name__
+    raise ValueError(f"{field} must be of type {type_name}, got {value!r}")
+
+
+def params_from_dict(data: dict, base: WatermarkParams = DEFAULT_WATERMARK_PARAMS) -> WatermarkParams:
     """
-    Finds the font file path by querying the Windows Registry.
+    Собирает WatermarkParams из словаря (например, из JSON-пресета).
+    Отсутствующие поля берутся из base, неизвестные ключи считаются ошибкой. Значения
+    приводятся к типам полей и проверяются (ValueError), чтобы ошибка в пресете или запросе
+    была видна сразу, а не как TypeError посреди обработки.
     """
-    if platform.system() != "Windows":
-        return None
+    unknown = set(data) - set(WatermarkParams._fields)
+    if unknown:
+        raise ValueError(f"Unknown watermark parameters: {', '.join(sorted(unknown))}")
+    values = {field: _coerce_param(field, value) for field, value in data.items()}
+    params = base._replace(**values)
+    if params.watermark_type not in ("text", "image"):
+        raise ValueError(f"watermark_type must be 'text' or 'image', got {params.watermark_type!r}")
+    if params.position not in WATERMARK_POSITIONS:
+        raise ValueError(f"position must be one of {', '.join(WATERMARK_POSITIONS)}, got {params.position!r}")
+    if params.font_size_relative <= 0 or params.image_scale <= 0:
+        raise ValueError("font_size_relative and image_scale must be positive")
+    if not 0 <= params.opacity <= 255:
+        raise ValueError(f"opacity must be between 0 and 255, got {params.opacity!r}")
+    return params
 
-    try:
-        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Windows NT\CurrentVersion\Fonts") as key:
-            # Ищем ключ, который соответствует имени шрифта, возможно с добавками (TrueType, Italic и т.д.)
-            for i in range(winreg.QueryInfoKey(key)[1]):
-                value_name, file_name, _ = winreg.EnumValue(key, i)
-                if font_name.lower() in value_name.lower():
-                    # Путь к папке со шрифтами
-                    fonts_folder = os.path.join(os.environ["SystemRoot"], "Fonts")
-                    font_path = os.path.join(fonts_folder, file_name)
-                    if os.path.exists(font_path):
-                        logging.debug(f"Found font '{font_name}' at '{font_path}' via registry.")
-                        return font_path
-    except Exception as e:
-        logging.error(f"Error accessing registry for fonts: {e}")
 
-    return None
+# Финальные фолбэки, если нужный шрифт не найден: Arial на Windows/macOS, DejaVu/Liberation на Linux
+FALLBACK_FONTS = ("Arial", "DejaVu Sans", "Liberation Sans")
 
 
 def _get_font(font_name: str, font_size: int) -> ImageFont.FreeTypeFont:
-    font_path = None
-    # Сначала пытаемся найти шрифт через реестр Windows
-    if platform.system() == "Windows":
-        font_path = find_font_file_on_windows(font_name)
-
-    # Если нашли, используем этот путь
+    # Путь ищем по индексу шрифтов (строится один раз на процесс), сам шрифт берём из кэша
+    font_path = resolve_font_path(font_name)
     if font_path:
         try:
-            return ImageFont.truetype(font_path, font_size)
-        except IOError:
-            logging.warning(f"Found font file {font_path} but failed to load. Falling back.")
+            return load_font(font_path, font_size)
+        except OSError:
+            problem = f"Found font file {font_path} but failed to load it"
+    else:
+        problem = f"Could not find a file for '{font_name}'"
 
-    # Если не нашли в реестре (или не Windows), пробуем по имени
-    try:
-        return ImageFont.truetype(f"{font_name}.ttf", font_size)
-    except IOError:
-        pass
-
-    # Финальный и самый надёжный фолбэк - Arial
-    logging.warning(f"Could not find a file for '{font_name}'. Falling back to Arial.")
-    try:
-        return ImageFont.truetype("arial.ttf", font_size)
-    except IOError:
-        logging.error("CRITICAL: Fallback font 'Arial' also not found. Using tiny default font.")
-        return ImageFont.load_default()
+    # В лог попадает шрифт, который действительно загрузился
+    for fallback_name in FALLBACK_FONTS:
+        fallback_path = resolve_font_path(fallback_name)
+        if fallback_path:
+            try:
+                font = load_font(fallback_path, font_size)
+            except OSError:
+                continue
+            logging.warning(f"{problem}. Falling back to {fallback_name} ({fallback_path}).")
+            return font
+    logging.error(f"CRITICAL: {problem} and fallback fonts were not found. Using tiny default font.")
+    return ImageFont.load_default()
 
 
 def get_watermark_position(img_w, img_h, wm_w, wm_h, position, offset_x, offset_y):
@@ -90,51 +149,504 @@ def get_watermark_position(img_w, img_h, wm_w, wm_h, position, offset_x, offset_
     return int(x + offset_x), int(y + offset_y)
 
 
-def apply_watermark_to_pillow_image(base_image: Image.Image, params: WatermarkParams) -> Image.Image:
-    if base_image.mode != 'RGBA':
-        base_image = base_image.convert('RGBA')
+# Отрисованный водяной знак: RGBA-плитка размером с сам знак и её левый верхний угол на базовом изображении
+WatermarkLayer = namedtuple("WatermarkLayer", ["image", "x", "y"])
+
+# Сколько отрисованных знаков держать в памяти. В пакете обычно всего несколько разных разрешений
+WATERMARK_CACHE_SIZE = 32
+# Слой замощения занимает весь кадр (4 байта на пиксель), поэтому таких слоёв кэшируется меньше
+TILE_LAYER_CACHE_SIZE = 2
+# Наименьшая сторона блока узора для NumPy: мелкий период повторяется в блоке, чтобы
+# смешивание по сетке не распадалось на тысячи крошечных вызовов
+NUMPY_TILE_BLOCK = 512
+
+
+def render_watermark_layer(base_size: tuple[int, int], params: WatermarkParams) -> WatermarkLayer | None:
+    """
+    Возвращает водяной знак для изображения размером base_size или None, если рисовать нечего.
+
+    Результат кэшируется по (размер, параметры, время изменения файла баннера), поэтому
+    шрифт, замер текста и ресайз баннера выполняются один раз на каждое разрешение.
+    Плитка из кэша общая - её нельзя менять на месте. Для TILE_POSITION слой - весь
+    кадр с готовым узором, и он смешивается с изображением за один проход.
+    """
+    key = watermark_cache_key(base_size, params)
+    if key is None:
+        return None
+    if params.position == TILE_POSITION:
+        return _render_tile_layer_cached(*key)
+    return _render_watermark_layer_cached(*key)
+
+
+def watermark_cache_key(base_size: tuple[int, int], params: WatermarkParams) -> tuple | None:
+    """Ключ кэша знака: (размер, параметры, время изменения баннера). None - если баннера нет на диске."""
+    banner_mtime = None
+    if params.watermark_type == "image":
+        if not params.image_path or not os.path.exists(params.image_path):
+            return None
+        banner_mtime = os.path.getmtime(params.image_path)
+    return tuple(base_size), params, banner_mtime
+
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _render_watermark_layer_cached(base_size, params, banner_mtime) -> WatermarkLayer | None:
+    rendered = _render_watermark_tile(base_size, params, banner_mtime)
+    if rendered is None:
+        return None
+    tile, (dx, dy) = rendered
+    x, y = get_watermark_position(*base_size, tile.width, tile.height, params.position, params.offset_x, params.offset_y)
+    return WatermarkLayer(tile, x + dx, y + dy)
+
+
+def _render_watermark_tile(base_size, params, banner_mtime) -> tuple[Image.Image, tuple[int, int]] | None:
+    """Сам знак - RGBA-плитка по его размеру - и сдвиг плитки относительно точки, куда ставится знак."""
+    img_w, img_h = base_size
+    opacity_int = int(params.opacity if isinstance(params.opacity, int) else params.opacity * 255)
 
     if params.watermark_type == "text" and params.text:
-        txt_layer = Image.new("RGBA", base_image.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(txt_layer)
-        font_size_px = int(base_image.height * (params.font_size_relative / 100.0))
-        font = _get_font(params.font_name, font_size_px)
-        text_bbox = draw.textbbox((0, 0), params.text, font=font)
-        text_w, text_h = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
-        x, y = get_watermark_position(base_image.width, base_image.height, text_w, text_h, params.position,
-                                      params.offset_x, params.offset_y)
-        opacity_int = int(params.opacity if isinstance(params.opacity, int) else params.opacity * 255)
-        fill_color = (255, 255, 255, opacity_int)
-        draw.text((x, y), params.text, font=font, fill=fill_color)
-        return Image.alpha_composite(base_image, txt_layer)
-
-    elif params.watermark_type == "image" and params.image_path and os.path.exists(params.image_path):
-        watermark = Image.open(params.image_path).convert("RGBA")
-        scale = params.image_scale / 100.0
-        wm_w = int(base_image.width * scale)
-        wm_h = int(watermark.height * (wm_w / watermark.width)) if watermark.width > 0 else 0
-        watermark = watermark.resize((wm_w, wm_h), Image.Resampling.LANCZOS)
-        opacity_int = int(params.opacity if isinstance(params.opacity, int) else params.opacity * 255)
-        if opacity_int < 255:
-            alpha = watermark.split()[3]
-            alpha = alpha.point(lambda p: p * (opacity_int / 255.0))
-            watermark.putalpha(alpha)
-        x, y = get_watermark_position(base_image.width, base_image.height, wm_w, wm_h, params.position, params.offset_x,
-                                      params.offset_y)
-        img_layer = Image.new("RGBA", base_image.size, (255, 255, 255, 0))
-        img_layer.paste(watermark, (x, y), watermark)
-        return Image.alpha_composite(base_image, img_layer)
+        font_size_px = int(img_h * (params.font_size_relative / 100.0))
+        with stage_timer("font"):
+            font = _get_font(params.font_name, font_size_px)
+        with stage_timer("text"):
+            measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+            left, top, right, bottom = measure.textbbox((0, 0), params.text, font=font)
+            text_w, text_h = right - left, bottom - top
+            if text_w <= 0 or text_h <= 0:
+                return None
+            # Текст, нарисованный в точке (x, y), занимает ровно textbbox, сдвинутый на (x, y)
+            tile = Image.new("RGBA", (text_w, text_h), (255, 255, 255, 0))
+            ImageDraw.Draw(tile).text((-left, -top), params.text, font=font, fill=(255, 255, 255, opacity_int))
+        return tile, (left, top)
+
+    elif params.watermark_type == "image" and banner_mtime is not None:
+        with stage_timer("banner"):
+            with Image.open(params.image_path) as banner:
+                watermark = banner.convert("RGBA")
+            scale = params.image_scale / 100.0
+            wm_w = int(img_w * scale)
+            wm_h = int(watermark.height * (wm_w / watermark.width)) if watermark.width > 0 else 0
+            if wm_w <= 0 or wm_h <= 0:
+                return None
+            watermark = watermark.resize((wm_w, wm_h), Image.Resampling.LANCZOS)
+            if opacity_int < 255:
+                alpha = watermark.split()[3]
+                alpha = alpha.point(lambda p: p * (opacity_int / 255.0))
+                watermark.putalpha(alpha)
+        # Та же операция, что раньше выполнялась на полноразмерном прозрачном слое
+        tile = Image.new("RGBA", watermark.size, (255, 255, 255, 0))
+        tile.paste(watermark, (0, 0), watermark)
+        return tile, (0, 0)
+
+    return None
+
+
+# Период узора замощения: cell повторяется с шагом своего размера, (origin_x, origin_y) - один из его углов на кадре
+TilePattern = namedtuple("TilePattern", ["cell", "origin_x", "origin_y"])
+
+
+def render_tile_pattern(base_size: tuple[int, int], params: WatermarkParams) -> TilePattern | None:
+    """Период узора для TILE_POSITION (кэшируется вместе с обычными знаками). Для обработки по частям, см. tiled.py."""
+    key = watermark_cache_key(base_size, params)
+    return None if key is None else _render_tile_pattern_cached(*key)
+
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _render_tile_repeat_cached(base_size, params, banner_mtime) -> tuple[Image.Image, int, int] | None:
+    """Повёрнутый знак для замощения и шаг повторов (step_x, step_y) - не меньше размера знака."""
+    rendered = _render_watermark_tile(base_size, params, banner_mtime)
+    if rendered is None:
+        return None
+    tile = rendered[0]
+    with stage_timer("tile"):
+        if params.tile_angle % 360:
+            tile = tile.rotate(params.tile_angle, resample=Image.Resampling.BICUBIC, expand=True)
+    spacing = max(params.tile_spacing, 0) / 100.0
+    return tile, int(tile.width * (1 + spacing)) or 1, int(tile.height * (1 + spacing)) or 1
+
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _render_tile_pattern_cached(base_size, params, banner_mtime) -> TilePattern | None:
+    repeat = _render_tile_repeat_cached(base_size, params, banner_mtime)
+    if repeat is None:
+        return None
+    tile, step_x, step_y = repeat
+    with stage_timer("tile"):
+        if params.tile_stagger:
+            # Два ряда на период: второй сдвинут на полшага, его правый край переносится в начало ряда
+            cell = Image.new("RGBA", (step_x, step_y * 2), (255, 255, 255, 0))
+            cell.paste(tile, (0, 0))
+            cell.paste(tile, (step_x // 2, step_y))
+            cell.paste(tile, (step_x // 2 - step_x, step_y))
+        else:
+            cell = Image.new("RGBA", (step_x, step_y), (255, 255, 255, 0))
+            cell.paste(tile, (0, 0))
+    # Один из повторов стоит в центре кадра (со смещениями) - там же, где знак в позиции "Центр"
+    x, y = get_watermark_position(*base_size, tile.width, tile.height, "Центр", params.offset_x, params.offset_y)
+    return TilePattern(cell, x, y)
+
+
+def fill_tile_pattern(pattern: TilePattern, box: tuple[int, int, int, int]) -> Image.Image:
+    """Узор в пределах box (left, top, right, bottom) кадра - без построения всего кадра."""
+    left, top, right, bottom = box
+    region = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+    step_x, step_y = pattern.cell.size
+    # Ближайшие к левому верхнему углу box повторы слева и сверху от него
+    start_x = left - (left - pattern.origin_x) % step_x
+    start_y = top - (top - pattern.origin_y) % step_y
+    with stage_timer("tile"):
+        # Сначала одна полоса высотой в период, потом она копируется вниз - паст получается меньше
+        row = Image.new("RGBA", (right - start_x, step_y), (255, 255, 255, 0))
+        for x in range(0, row.width, step_x):
+            row.paste(pattern.cell, (x, 0))
+        for y in range(start_y, bottom, step_y):
+            region.paste(row, (start_x - left, y - top))
+    return region
+
+
+@functools.lru_cache(maxsize=TILE_LAYER_CACHE_SIZE)
+def _render_tile_layer_cached(base_size, params, banner_mtime) -> WatermarkLayer | None:
+    pattern = _render_tile_pattern_cached(base_size, params, banner_mtime)
+    if pattern is None:
+        return None
+    return WatermarkLayer(fill_tile_pattern(pattern, (0, 0) + tuple(base_size)), 0, 0)
+
+
+def prepare_numpy_watermark(base_size: tuple[int, int],
+                            params: WatermarkParams) -> NumpyWatermark | NumpyTileWatermark | None:
+    """Знак, подготовленный для смешивания в NumPy (кэшируется так же, как render_watermark_layer)."""
+    key = watermark_cache_key(base_size, params)
+    if key is None:
+        return None
+    if params.position == TILE_POSITION:
+        return _prepare_numpy_tile_cached(*key)
+    return _prepare_numpy_watermark_cached(*key)
+
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _prepare_numpy_watermark_cached(base_size, params, banner_mtime) -> NumpyWatermark | None:
+    layer = _render_watermark_layer_cached(base_size, params, banner_mtime)
+    return None if layer is None else NumpyWatermark(layer.image, layer.x, layer.y, base_size)
+
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _prepare_numpy_tile_cached(base_size, params, banner_mtime) -> NumpyTileWatermark | None:
+    # Не слой на весь кадр (32 байта на пиксель в NumPy), а сам знак или небольшой блок узора
+    pattern = _render_tile_pattern_cached(base_size, params, banner_mtime)
+    if pattern is None:
+        return None
+    origin = (pattern.origin_x, pattern.origin_y)
+    step_x, step_y = pattern.cell.size
+    if step_x < NUMPY_TILE_BLOCK and step_y < NUMPY_TILE_BLOCK:
+        # Мелкий узор: блок из целого числа периодов, чтобы по сетке было меньше вызовов
+        width, height = -(-NUMPY_TILE_BLOCK // step_x) * step_x, -(-NUMPY_TILE_BLOCK // step_y) * step_y
+        block = fill_tile_pattern(pattern, origin + (origin[0] + width, origin[1] + height))
+        return NumpyTileWatermark(block, [(0, 0)], (width, height), origin, base_size)
+    # Крупный узор: период почти весь прозрачный, поэтому готовится только сам знак (по его
+    # непрозрачной части), а ставится он в те же места, что в TilePattern.cell
+    tile, step_x, step_y = _render_tile_repeat_cached(base_size, params, banner_mtime)
+    bbox = tile.getchannel("A").getbbox()
+    if bbox is None:
+        return None
+    places = [(0, 0), (step_x // 2, step_y)] if params.tile_stagger else [(0, 0)]
+    places = [(x + bbox[0], y + bbox[1]) for x, y in places]
+    return NumpyTileWatermark(tile.crop(bbox), places, pattern.cell.size, origin, base_size)
+
+
+def watermark_cache_info():
+    """Статистика кэша отрисованных знаков: hits, misses, maxsize, currsize."""
+    return _render_watermark_layer_cached.cache_info()
+
+
+def clear_watermark_cache():
+    _render_watermark_layer_cached.cache_clear()
+    _prepare_numpy_watermark_cached.cache_clear()
+    _render_tile_repeat_cached.cache_clear()
+    _render_tile_pattern_cached.cache_clear()
+    _render_tile_layer_cached.cache_clear()
+    _prepare_numpy_tile_cached.cache_clear()
+
 
+# Чем смешивать знак с изображением: "pillow" (Image.alpha_composite) или "numpy" (compositing.py).
+# Результат одинаковый бит в бит; переключатель нужен для сравнения скорости.
+_compositing_backend = "pillow"
+
+
+def set_compositing_backend(backend: str):
+    global _compositing_backend
+    if backend not in COMPOSITING_BACKENDS:
+        raise ValueError(f"Unknown compositing backend: {backend}")
+    _compositing_backend = backend
+
+
+def get_compositing_backend() -> str:
+    return _compositing_backend
+
+
+def _writable_base(base_image: Image.Image, in_place: bool) -> Image.Image:
+    """Приводит изображение к RGB/RGBA; при in_place=False гарантирует, что оригинал не изменится."""
+    if base_image.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in base_image.getbands() or "transparency" in base_image.info
+        return base_image.convert("RGBA" if has_alpha else "RGB")
+    return base_image if in_place else base_image.copy()
+
+
+def composite_watermark_layer(base_image: Image.Image, layer: WatermarkLayer, in_place: bool = False) -> Image.Image:
+    """
+    Смешивает знак с базовым изображением только в пределах его рамки.
+
+    Рамка обрезается по границам изображения (отрицательные смещения и знак за краем
+    допустимы). RGB и RGBA обрабатываются в родном режиме, остальные режимы
+    (L, P, CMYK...) один раз переводятся в RGB/RGBA. При in_place=True изображение
+    в режиме RGB/RGBA меняется на месте, иначе работаем с копией.
+    """
+    left, top = max(layer.x, 0), max(layer.y, 0)
+    right = min(layer.x + layer.image.width, base_image.width)
+    bottom = min(layer.y + layer.image.height, base_image.height)
+
+    # Если знак целиком за кадром, копия не нужна - изображение менять не будем
+    base_image = _writable_base(base_image, in_place or right <= left or bottom <= top)
+    if right <= left or bottom <= top:
+        return base_image
+
+    box = (left, top, right, bottom)
+    tile_box = (left - layer.x, top - layer.y, right - layer.x, bottom - layer.y)
+    # Знак на весь кадр (замощение) обрезать не нужно - это была бы лишняя копия кадра
+    tile = layer.image if tile_box == (0, 0) + layer.image.size else layer.image.crop(tile_box)
+    if base_image.mode == "RGB":
+        # На непрозрачном фоне вставка с маской-альфой даёт бит в бит то же, что alpha_composite,
+        # но за один проход и без перевода области в RGBA и обратно
+        base_image.paste(tile, box[:2], tile)
+        return base_image
+    region = base_image if box == (0, 0) + base_image.size else base_image.crop(box)
+    base_image.paste(Image.alpha_composite(region, tile), box)
     return base_image
 
 
-def process_image_file(image_path: str, result_path: str, params: WatermarkParams):
+def apply_watermark_to_pillow_image(base_image: Image.Image, params: WatermarkParams,
+                                    in_place: bool = False, backend: str | None = None) -> Image.Image:
+    """
+    Накладывает водяной знак. Возвращает изображение в режиме RGB или RGBA;
+    при in_place=True base_image (если он уже RGB/RGBA) меняется на месте без копирования.
+    backend - "pillow" или "numpy"; по умолчанию - выбранный через set_compositing_backend.
+    """
+    if (backend or _compositing_backend) == "numpy":
+        watermark = prepare_numpy_watermark(base_image.size, params)
+        if watermark is None:
+            return base_image
+        with stage_timer("composite"):
+            return composite_image_numpy(_writable_base(base_image, in_place or watermark.box is None), watermark)
+
+    layer = render_watermark_layer(base_image.size, params)
+    if layer is None:
+        return base_image
+    with stage_timer("composite"):
+        return composite_watermark_layer(base_image, layer, in_place=in_place)
+
+
+def apply_watermark_to_images(images: list[Image.Image], params: WatermarkParams,
+                              in_place: bool = False) -> list[Image.Image]:
+    """
+    Накладывает знак на несколько изображений (например, серию снимков с одной камеры).
+    Изображения одного размера и режима смешиваются в NumPy одной стопкой; порядок сохраняется.
+    """
+    results = [_writable_base(image, in_place) for image in images]
+    groups = {}
+    for i, image in enumerate(results):
+        groups.setdefault((image.size, image.mode), []).append(i)
+    for (size, _), indices in groups.items():
+        watermark = prepare_numpy_watermark(size, params)
+        if watermark is not None:
+            composite_stack_numpy([results[i] for i in indices], watermark)
+    return results
+
+
+# Предел размера для локальных файлов (сканы, склеенные панорамы): стандартный предел Pillow
+# (Image.MAX_IMAGE_PIXELS) предупреждает после ~89 Мп и отказывает после ~179 Мп. Байты из сети
+# (process_image_bytes, server.py) по-прежнему проверяются стандартным пределом
+FILE_MAX_IMAGE_PIXELS = 1_000_000_000
+# Предпросмотр и миниатюры декодируются в процессе интерфейса, по нескольку сразу, - для них
+# полное декодирование ограничено стандартным пределом Pillow (~179 Мп, DecompressionBombError)
+PREVIEW_MAX_DECODE_PIXELS = 2 * Image.MAX_IMAGE_PIXELS
+
+_pixel_limit_lock = threading.Lock()
+
+
+def open_image_lazy(fp, max_pixels: int | None = None) -> Image.Image:
+    """
+    Image.open (пиксели ещё не декодируются); max_pixels - предел размера вместо
+    Image.MAX_IMAGE_PIXELS. Изображение больше предела - Image.DecompressionBombError.
+    """
+    if max_pixels is None:
+        return Image.open(fp)
+    # Предел Pillow - глобальная настройка, поэтому он снимается только на время чтения заголовка
+    with _pixel_limit_lock:
+        default_limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+        try:
+            image = Image.open(fp)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default_limit
+    if image.width * image.height > max_pixels:
+        image.close()
+        raise Image.DecompressionBombError(
+            f"Image size ({image.width * image.height} pixels) exceeds limit of {max_pixels} pixels")
+    return image
+
+
+def load_preview_proxy(image_path: str, max_size: tuple[int, int]) -> tuple[Image.Image, float]:
+    """
+    Открывает изображение сразу уменьшенным до max_size (для предпросмотра и миниатюр).
+    JPEG декодируется через draft в 1/2..1/8 разрешения, без полного декодирования кадра,
+    большой TIFF собирается по полосам (tiled.load_tiff_reduced). Прочие файлы, которые
+    пришлось бы декодировать больше PREVIEW_MAX_DECODE_PIXELS, не открываются -
+    Image.DecompressionBombError (пакетная обработка их при этом примет).
+    Возвращает (уменьшенная копия, масштаб относительно оригинала).
+    """
+    with open_image_lazy(image_path, FILE_MAX_IMAGE_PIXELS) as image:
+        full_width = image.width
+        ratio = min(max_size[0] / image.width, max_size[1] / image.height)
+        # Как в Image.thumbnail: draft с запасом в 2 раза, дальше уменьшение фильтром
+        image.draft(None, (round(image.width * ratio * 2), round(image.height * ratio * 2)))
+        if image.width * image.height > PREVIEW_MAX_DECODE_PIXELS:
+            # tiled импортирует utils, поэтому модуль подключается только здесь
+            from tiled import load_tiff_reduced
+            reduced = load_tiff_reduced(image_path, max_size) if image.format == "TIFF" else None
+            if reduced is None:
+                raise Image.DecompressionBombError(
+                    f"Image is too large to preview ({image.width * image.height} pixels, "
+                    f"limit {PREVIEW_MAX_DECODE_PIXELS}); batch processing still accepts it")
+            return reduced, max(reduced.size) / max(image.size)
+        image.thumbnail(max_size, Image.Resampling.BILINEAR)
+        image.load()
+        # Масштаб одинаков по обеим осям, поэтому поворот по EXIF его не меняет
+        scale = image.width / full_width if full_width else 1.0
+        ImageOps.exif_transpose(image, in_place=True)
+        return image, scale
+
+
+def scale_params_for_preview(params: WatermarkParams, scale: float) -> WatermarkParams:
+    """Смещения заданы в пикселях оригинала - на уменьшенной копии их нужно масштабировать."""
+    return params._replace(offset_x=round(params.offset_x * scale), offset_y=round(params.offset_y * scale))
+
+
+def open_image(fp, max_pixels: int | None = None) -> Image.Image:
+    """
+    Открывает и декодирует изображение, поворачивая его по тегу EXIF Orientation
+    (сам тег после этого удаляется), чтобы знак встал туда, где его увидит зритель.
+    max_pixels - как у open_image_lazy.
+    """
+    image = open_image_lazy(fp, max_pixels)
+    image.load()
+    ImageOps.exif_transpose(image, in_place=True)
+    return image
+
+
+@contextlib.contextmanager
+def atomic_output(result_path: str):
+    """
+    Даёт временный путь рядом с result_path (с тем же расширением, чтобы формат выбирался
+    так же). Если блок завершился без ошибок, файл атомарно переименовывается в result_path,
+    иначе удаляется - недописанных результатов в папке не остаётся. Если процесс убит,
+    временный файл остаётся; его убирает remove_partial_outputs.
+    """
+    directory, name = os.path.split(result_path)
+    stem, ext = os.path.splitext(name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)  # Подпапки результатов (см. cli.make_tasks)
+    # Имя уникально для узла, процесса и потока: в общую папку результатов пишут сразу несколько машин.
+    # Точки в имени узла заменяются, чтобы remove_partial_outputs однозначно выделял имя результата
+    host = socket.gethostname().replace(".", "-")
+    tmp_path = os.path.join(directory, f".{stem}.{host}.{os.getpid()}.{threading.get_ident()}.part{ext}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, result_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def remove_partial_outputs(result_paths) -> int:
+    """
+    Удаляет временные файлы atomic_output (.имя.узел.pid.поток.part.расширение, в старых
+    версиях .имя.pid.part.расширение), оставшиеся рядом с result_paths от убитого процесса.
+    Каждая папка читается один раз. Возвращает число удалённых файлов.
+    """
+    names_by_dir = {}
+    for result_path in result_paths:
+        directory, name = os.path.split(result_path)
+        names_by_dir.setdefault(directory, set()).add(os.path.splitext(name))
+    removed = 0
+    for directory, outputs in names_by_dir.items():
+        try:
+            names = os.listdir(directory or ".")
+        except OSError:
+            continue
+        for name in names:
+            head, part, ext = name.rpartition(".part")
+            if not part or not head.startswith("."):
+                continue
+            parts = head[1:].split(".")
+            stems = []
+            if len(parts) >= 4 and parts[-1].isdigit() and parts[-2].isdigit():
+                stems.append(".".join(parts[:-3]))
+            if len(parts) >= 2 and parts[-1].isdigit():
+                stems.append(".".join(parts[:-1]))
+            if any((stem, ext) in outputs for stem in stems):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+    return removed
+
+
+def _check_cancelled(should_cancel, image_path: str):
+    if should_cancel is not None and should_cancel():
+        raise InterruptedError(f"Processing cancelled: {image_path}")
+
+
+def process_image_file(image_path: str, result_path: str, params: WatermarkParams, should_cancel=None) -> dict:
+    """
+    Накладывает водяной знак на файл и сохраняет результат (настройки кодирования - encoding.py).
+    Возвращает время этапов в секундах: {"decode": ..., "watermark": ..., "encode": ...},
+    а в ключе "encoded" - список [(формат, секунды, байты)] по каждому записанному файлу.
+    should_cancel() проверяется между этапами: если он вернул True, работа прерывается
+    с InterruptedError, а результат не записывается.
+    """
+    timings = {}
     try:
-        base_image = Image.open(image_path)
-        watermarked_image = apply_watermark_to_pillow_image(base_image, params)
-        watermarked_image.convert("RGB").save(result_path,
-                                              "JPEG" if result_path.lower().endswith((".jpg", ".jpeg")) else "PNG")
+        _check_cancelled(should_cancel, image_path)
+        started = time.perf_counter()
+        base_image = open_image(image_path, FILE_MAX_IMAGE_PIXELS)
+        timings["decode"] = time.perf_counter() - started
+
+        _check_cancelled(should_cancel, image_path)
+        started = time.perf_counter()
+        # Изображение принадлежит только нам, поэтому знак накладываем на месте, без лишних копий кадра
+        watermarked_image = apply_watermark_to_pillow_image(base_image, params, in_place=True)
+        timings["watermark"] = time.perf_counter() - started
+
+        _check_cancelled(should_cancel, image_path)
+        started = time.perf_counter()
+        with atomic_output(result_path) as tmp_path:
+            fmt, nbytes = save_image(watermarked_image, tmp_path, result_path)
+        timings["encode"] = time.perf_counter() - started
+        timings["encoded"] = [(fmt, timings["encode"], nbytes)]
         logging.info(f"Watermark added to image: {result_path}")
+        return timings
+    except InterruptedError:
+        raise
     except Exception as e:
         logging.error(f"Error processing image file {image_path}: {e}", exc_info=True)
         raise e
+
+
+def process_image_bytes(data: bytes, params: WatermarkParams, result_name: str) -> tuple[bytes, str]:
+    """
+    Как process_image_file, но целиком в памяти: байты исходника -> байты результата.
+    Формат результата выбирается по расширению result_name (например, "result.webp").
+    Возвращает (байты, формат Pillow).
+    """
+    image = open_image(io.BytesIO(data))
+    image = apply_watermark_to_pillow_image(image, params, in_place=True)
+    buffer = io.BytesIO()
+    fmt, _ = save_image(image, buffer, result_name)
+    return buffer.getvalue(), fmt
@@ -0,0 +1,141 @@
+"""
+Несколько вариантов результата из одного исходника.
+
+Вариант - это пресет водяного знака, шаблон имени выходного файла и, по желанию,
+максимальный размер (например, "web" с логотипом в углу и "preview" с крупным текстом
+по центру). Исходник декодируется один раз, а варианты (уменьшение, знак, кодирование)
+делаются параллельно в потоках. Уменьшение и смешивание Pillow выполняет без GIL,
+а кодеры PNG/JPEG держат GIL, поэтому кодирование вариантов одного файла
+идёт по очереди - параллельность по файлам даёт пул процессов (batch.py).
+
+Варианты описываются JSON-списком:
+    [
+        {"name": "web", "preset": "web.json", "template": "{stem}_web.jpg", "max_size": [1600, 1600]},
+        {"name": "preview", "params": {"text": "PREVIEW", "font_size_relative": 20}}
+    ]
+preset - файл пресета (путь относительно файла вариантов), params - поля WatermarkParams
+поверх пресета, template - имя результата с подстановками {stem}, {ext} и {name}
+(можно с подпапкой), max_size - ширина и высота, в которые вписывается результат.
+"""
+import os
+import time
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from utils import (WatermarkParams, DEFAULT_WATERMARK_PARAMS, params_from_dict, apply_watermark_to_pillow_image,
+                   open_image, atomic_output, FILE_MAX_IMAGE_PIXELS)
+from encoding import save_image
+
+
+DEFAULT_VARIANT_TEMPLATE = "{name}_{stem}{ext}"
+
+OutputVariant = namedtuple("OutputVariant", ["name", "params", "template", "max_size"],
+                           defaults=[DEFAULT_VARIANT_TEMPLATE, None])
+# Один выходной файл задачи: куда писать, с каким знаком и до какого размера уменьшить
+VariantOutput = namedtuple("VariantOutput", ["result_path", "params", "max_size"], defaults=[None])
+# Задача для batch.run_batch: один исходник -> несколько результатов
+VariantTask = namedtuple("VariantTask", ["image_path", "outputs"])
+
+
+def load_variants(path: str, base_params: WatermarkParams = DEFAULT_WATERMARK_PARAMS) -> list[OutputVariant]:
+    """Читает JSON-файл вариантов; параметры каждого строятся поверх base_params."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list) or not data:
+        raise ValueError("Variants file must contain a non-empty JSON list")
+
+    variants, output_names = [], set()
+    for index, entry in enumerate(data):
+        name = entry.get("name") or f"variant{index + 1}"
+        params = base_params
+        if entry.get("preset"):
+            with open(os.path.join(os.path.dirname(path), entry["preset"]), "r", encoding="utf-8") as f:
+                params = params_from_dict(json.load(f), base=params)
+        params = params_from_dict(entry.get("params", {}), base=params)
+        template = entry.get("template", DEFAULT_VARIANT_TEMPLATE)
+        max_size = tuple(entry["max_size"]) if entry.get("max_size") else None
+        if max_size is not None and (len(max_size) != 2 or min(max_size) <= 0):
+            raise ValueError(f"Variant '{name}': max_size must be [width, height]")
+        try:
+            # Имя с подставленным name, но без stem/ext: совпадение значит, что варианты перезапишут друг друга
+            output_name = template.format(stem="{stem}", ext="{ext}", name=name)
+        except (KeyError, IndexError) as e:
+            raise ValueError(f"Variant '{name}': unknown placeholder {e} in template") from None
+        if output_name in output_names:
+            raise ValueError(f"Variant '{name}': output names clash with another variant")
+        output_names.add(output_name)
+        variants.append(OutputVariant(name, params, template, max_size))
+    return variants
+
+
+def variant_result_path(image_path: str, output_dir: str, variant: OutputVariant) -> str:
+    stem, ext = os.path.splitext(os.path.basename(image_path))
+    return os.path.join(output_dir, variant.template.format(stem=stem, ext=ext, name=variant.name))
+
+
+def make_variant_tasks(files, output_dir: str, variants: list[OutputVariant]) -> list[VariantTask]:
+    return [VariantTask(image_file, tuple(VariantOutput(variant_result_path(image_file, output_dir, variant),
+                                                        variant.params, variant.max_size)
+                                          for variant in variants))
+            for image_file in files]
+
+
+def fit_size(size: tuple[int, int], max_size: tuple[int, int] | None) -> tuple[int, int]:
+    """Размер, вписанный в max_size с сохранением пропорций (без увеличения)."""
+    if max_size is None:
+        return size
+    scale = min(max_size[0] / size[0], max_size[1] / size[1], 1.0)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def _render_variant(base_image: Image.Image, output: VariantOutput, should_cancel) -> dict:
+    """Выполняется в потоке: базовое изображение только читается, каждый вариант работает со своей копией."""
+    timings = {}
+    started = time.perf_counter()
+    size = fit_size(base_image.size, output.max_size)
+    image = base_image.resize(size, Image.Resampling.LANCZOS) if size != base_image.size else base_image.copy()
+    timings["resize"] = time.perf_counter() - started
+
+    if should_cancel is not None and should_cancel():
+        raise InterruptedError(f"Processing cancelled: {output.result_path}")
+    started = time.perf_counter()
+    image = apply_watermark_to_pillow_image(image, output.params, in_place=True)
+    timings["watermark"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(output.result_path) or ".", exist_ok=True)
+    with atomic_output(output.result_path) as tmp_path:
+        fmt, nbytes = save_image(image, tmp_path, output.result_path)
+    timings["encode"] = time.perf_counter() - started
+    timings["encoded"] = [(fmt, timings["encode"], nbytes)]
+    return timings
+
+
+def process_image_variants(image_path: str, outputs, should_cancel=None) -> dict:
+    """
+    Декодирует изображение один раз и параллельно делает все варианты outputs (VariantOutput).
+    Возвращает время этапов в секундах: decode один раз, остальные этапы - сумма по вариантам
+    ("encoded" - список [(формат, секунды, байты)] по всем вариантам).
+    Если хотя бы один вариант не удался, исключение пробрасывается (остальные варианты
+    при этом уже записаны).
+    """
+    if should_cancel is not None and should_cancel():
+        raise InterruptedError(f"Processing cancelled: {image_path}")
+    started = time.perf_counter()
+    base_image = open_image(image_path, FILE_MAX_IMAGE_PIXELS)
+    timings = {"decode": time.perf_counter() - started}
+
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        futures = [executor.submit(_render_variant, base_image, output, should_cancel) for output in outputs]
+        for future in futures:
+            for stage, value in future.result().items():
+                if stage == "encoded":
+                    timings.setdefault(stage, []).extend(value)
+                else:
+                    timings[stage] = timings.get(stage, 0.0) + value
+    logging.info(f"Watermark added to image: {image_path} ({len(outputs)} variants)")
+    return timings
@@ -0,0 +1,154 @@
+"""
+Наложение водяного знака на видео.
+
+Кадры читаются и пишутся потоком через ffmpeg (imageio-ffmpeg), поэтому в памяти
+одновременно находится один кадр, какой бы длины ни был ролик. Знак рисуется один
+раз (utils.prepare_numpy_watermark) и смешивается с каждым кадром в NumPy только в
+пределах своей рамки - бит в бит как Image.alpha_composite. Звук копируется без перекодирования,
+если его кодек подходит контейнеру результата (AUDIO_CODECS), иначе перекодируется.
+"""
+import os
+import time
+import logging
+
+import numpy as np
+from PIL import Image
+
+from utils import WatermarkParams, prepare_numpy_watermark, atomic_output
+
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".avi", ".webm", ".m4v")
+
+# Кодеки для контейнеров, куда H.264 не положить
+VIDEO_CODECS = {".webm": "libvpx-vp9"}
+
+# Контейнер -> (аудиокодеки, которые он принимает без перекодирования, кодек для остальных).
+# В контейнеры, которых здесь нет (.mkv), звук копируется всегда
+AUDIO_CODECS = {
+    ".mp4": ({"aac", "mp3", "alac", "ac3", "eac3"}, "aac"),
+    ".m4v": ({"aac", "mp3", "alac", "ac3", "eac3"}, "aac"),
+    ".mov": ({"aac", "mp3", "alac", "ac3", "eac3", "pcm_s16le", "pcm_s16be", "pcm_s24le", "pcm_s24be",
+              "pcm_f32le", "pcm_f32be"}, "aac"),
+    ".webm": ({"opus", "vorbis"}, "libopus"),
+    ".avi": ({"mp3", "ac3", "pcm_s16le", "pcm_u8"}, "libmp3lame"),
+}
+
+
+def is_video_file(path: str) -> bool:
+    return path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def read_video_frame(video_path: str) -> Image.Image:
+    """Первый кадр ролика - для миниатюр и предпросмотра."""
+    import imageio_ffmpeg
+
+    reader = imageio_ffmpeg.read_frames(video_path, pix_fmt="rgb24")
+    try:
+        meta = next(reader)
+        frame = next(reader)
+    finally:
+        reader.close()
+    return Image.frombytes("RGB", meta["size"], frame)
+
+
+def read_video_size(video_path: str) -> tuple[int, int]:
+    """Размер кадра по метаданным ролика, без декодирования кадров."""
+    import imageio_ffmpeg
+
+    reader = imageio_ffmpeg.read_frames(video_path, pix_fmt="rgb24")
+    try:
+        return tuple(next(reader)["size"])
+    finally:
+        reader.close()
+
+
+def choose_audio_codec(source_codec: str | None, extension: str) -> str:
+    """
+    Кодек звука для ffmpeg: "copy", если кодек исходника (как его назвал ffmpeg) подходит
+    контейнеру с расширением extension, иначе кодек для перекодирования.
+    """
+    if extension not in AUDIO_CODECS:
+        return "copy"
+    accepted, fallback = AUDIO_CODECS[extension]
+    return "copy" if source_codec in accepted else fallback
+
+
+def load_video_preview_proxy(video_path: str, max_size: tuple[int, int]) -> tuple[Image.Image, float]:
+    """Аналог utils.load_preview_proxy для видео: первый кадр, уменьшенный до max_size."""
+    frame = read_video_frame(video_path)
+    full_width = frame.width
+    frame.thumbnail(max_size, Image.Resampling.BILINEAR)
+    return frame, frame.width / full_width if full_width else 1.0
+
+
+def watermark_video(video_path: str, result_path: str, params: WatermarkParams,
+                    progress=None, should_cancel=None) -> dict:
+    """
+    Накладывает водяной знак на видео потоково: декодирование -> смешивание -> кодирование.
+
+    progress(готово_кадров, всего_кадров) вызывается после каждого кадра (всего может быть 0,
+    если ffmpeg не знает длительность); should_cancel() позволяет прервать работу,
+    недописанный файл при этом удаляется (ролик пишется во временный файл и переименовывается
+    в result_path только целиком). Возвращает время этапов в секундах
+    (как utils.process_image_file) и число кадров в ключе "frames".
+    """
+    import imageio_ffmpeg
+
+    timings = {"decode": 0.0, "watermark": 0.0, "encode": 0.0}
+    reader = imageio_ffmpeg.read_frames(video_path, pix_fmt="rgb24")
+    meta = next(reader)
+    width, height = meta["size"]
+    fps = meta.get("fps") or 25.0
+    total_frames = int(round(meta.get("duration", 0) * fps))
+    watermark = prepare_numpy_watermark((width, height), params)
+
+    extension = os.path.splitext(result_path)[1].lower()
+    has_audio = "audio_codec" in meta
+    audio_codec = None
+    if has_audio:
+        source_audio = meta["audio_codec"].rstrip(",")
+        audio_codec = choose_audio_codec(source_audio, extension)
+        if audio_codec != "copy":
+            logging.info(f"Audio codec {source_audio} does not fit {extension}, re-encoding to {audio_codec}")
+    frames = 0
+    started = time.perf_counter()
+    try:
+        with atomic_output(result_path) as tmp_path:
+            writer = imageio_ffmpeg.write_frames(
+                tmp_path, (width, height), fps=fps, macro_block_size=1, quality=8,
+                codec=VIDEO_CODECS.get(extension),
+                audio_path=video_path if has_audio else None, audio_codec=audio_codec,
+            )
+            writer.send(None)
+            try:
+                while True:
+                    stage_started = time.perf_counter()
+                    raw_frame = next(reader, None)
+                    timings["decode"] += time.perf_counter() - stage_started
+                    if raw_frame is None:
+                        break
+
+                    stage_started = time.perf_counter()
+                    frame = np.frombuffer(raw_frame, dtype=np.uint8).reshape(height, width, 3).copy()
+                    if watermark is not None:
+                        watermark.apply(frame)
+                    timings["watermark"] += time.perf_counter() - stage_started
+
+                    stage_started = time.perf_counter()
+                    writer.send(frame)
+                    timings["encode"] += time.perf_counter() - stage_started
+
+                    frames += 1
+                    if progress is not None:
+                        progress(frames, total_frames)
+                    if should_cancel is not None and should_cancel():
+                        raise InterruptedError(f"Video processing cancelled: {video_path}")
+            finally:
+                writer.close()
+    finally:
+        reader.close()
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Watermark added to video: {result_path} ({frames} frames, {frames / elapsed if elapsed else 0:.1f} fps)")
+    timings["frames"] = frames
+    return timings
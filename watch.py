@@ -0,0 +1,512 @@
+"""
+Служба наблюдения за папками: новые файлы обрабатываются сами, без интерфейса.
+
+Запуск:
+    python -m watch incoming/ -o out/ --preset web.json --metrics /var/lib/node_exporter/watermarks.prom
+
+На Linux изменения приходят через inotify (ctypes, без сторонних пакетов), в остальных
+случаях папки опрашиваются раз в --poll-interval секунд. Файл берётся в работу, только
+когда его размер и время изменения не менялись --settle секунд: копирование по сети
+идёт долго, и недописанный файл обрабатывать нельзя. Готовые файлы сразу уходят
+в постоянный пул рабочих процессов (batch.create_worker_pool), так что задержка от
+появления файла до результата - это --settle плюс сама обработка.
+
+В простое служба спит в select() без таймаута (с inotify) или просыпается только на опрос.
+Уже обработанные файлы пропускаются по манифесту папки результатов (manifest.py), поэтому
+после перезапуска накопившиеся файлы доделываются, а готовые не трогаются. Пропускная
+способность, очередь и задержки пишутся в --metrics (JSON или текстовый формат Prometheus
+для .prom) и раз в --report-interval в лог.
+"""
+import os
+import sys
+import json
+import time
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import logging
+import argparse
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+
+from batch import create_worker_pool, submit_task, default_worker_count
+from manifest import BatchManifest
+from encoding import EXTENSION_BY_FORMAT
+from instrumentation import configure_logging
+from cli import (MEDIA_EXTENSIONS, add_encoding_arguments, add_watermark_arguments, check_params,
+                 encoding_options, make_tasks, resolve_params)
+
+
+# Маски событий inotify (linux/inotify.h)
+_IN_MODIFY, _IN_CLOSE_WRITE, _IN_MOVED_TO, _IN_CREATE = 0x2, 0x8, 0x80, 0x100
+_IN_DELETE_SELF, _IN_Q_OVERFLOW, _IN_IGNORED, _IN_ISDIR = 0x400, 0x4000, 0x8000, 0x40000000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# Сколько последних файлов учитывать в задержках и за какое окно считать пропускную способность
+LATENCY_WINDOW = 1000
+THROUGHPUT_WINDOW = 60.0
+
+
+def _is_candidate(path: str) -> bool:
+    # Временные файлы (.имя.part.jpg от atomic_output, скрытые файлы копировщиков) пропускаем
+    name = os.path.basename(path)
+    return not name.startswith(".") and name.lower().endswith(MEDIA_EXTENSIONS)
+
+
+def _scan(directories, recursive: bool, excluded: str):
+    """Все подходящие файлы в папках (папку результатов не обходим)."""
+    for directory in directories:
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")
+                       and os.path.abspath(os.path.join(root, d)) != excluded] if recursive else []
+            for name in names:
+                path = os.path.join(root, name)
+                if _is_candidate(path):
+                    yield path
+
+
+class InotifyWatcher:
+    """Изменения в папках через inotify. changes() отдаёт пути изменившихся файлов; None - нужен полный обход."""
+
+    def __init__(self, directories, recursive: bool, excluded: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.recursive, self.excluded = recursive, excluded
+        self._paths = {}  # wd -> папка
+        for directory in directories:
+            self._watch_tree(directory)
+
+    @staticmethod
+    def available() -> bool:
+        return sys.platform.startswith("linux")
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def _watch(self, directory: str):
+        wd = self._add_watch(self.fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            logging.warning(f"Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+            return
+        self._paths[wd] = directory
+
+    def _watch_tree(self, directory: str):
+        self._watch(directory)
+        if not self.recursive:
+            return
+        for root, dirs, _ in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")
+                       and os.path.abspath(os.path.join(root, d)) != self.excluded]
+            for d in dirs:
+                self._watch(os.path.join(root, d))
+
+    def changes(self):
+        paths = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return paths
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += _EVENT_HEADER.size + length
+                if mask & _IN_Q_OVERFLOW:
+                    logging.warning("inotify queue overflowed, rescanning watched folders")
+                    return None
+                if mask & _IN_IGNORED:
+                    self._paths.pop(wd, None)
+                    continue
+                directory = self._paths.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & _IN_ISDIR:
+                    if (self.recursive and mask & (_IN_CREATE | _IN_MOVED_TO) and not name.startswith(b".")
+                            and os.path.abspath(path) != self.excluded):
+                        # Файлы могли появиться до того, как папку взяли под наблюдение
+                        self._watch_tree(path)
+                        paths.update(_scan([path], True, self.excluded))
+                elif _is_candidate(path):
+                    paths.add(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Опрос папок: сравнивает размер и время изменения файлов с прошлым обходом."""
+
+    def __init__(self, directories, recursive: bool, excluded: str, interval: float):
+        self.directories, self.recursive, self.excluded, self.interval = directories, recursive, excluded, interval
+        self._known = {}
+        self.next_scan = time.monotonic()
+
+    def fileno(self):
+        return None
+
+    def changes(self):
+        now = time.monotonic()
+        if now < self.next_scan:
+            return set()
+        self.next_scan = now + self.interval
+        paths, known = set(), {}
+        for path in _scan(self.directories, self.recursive, self.excluded):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            known[path] = (st.st_size, st.st_mtime_ns)
+            if self._known.get(path) != known[path]:
+                paths.add(path)
+        self._known = known
+        return paths
+
+    def close(self):
+        pass
+
+
+class WatchMetrics:
+    """Счётчики службы: сколько файлов пришло, обработано, в очереди, задержки и пропускная способность."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.detected = self.processed = self.failed = self.skipped = 0
+        self.pool_restarts = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # От первого события по файлу до готового результата
+        self.processing = deque(maxlen=LATENCY_WINDOW)
+        self._completed_at = deque()
+
+    def completed(self, ok: bool, latency: float, processing: float):
+        now = time.monotonic()
+        if ok:
+            self.processed += 1
+            self.latencies.append(latency)
+            self.processing.append(processing)
+        else:
+            self.failed += 1
+        self._completed_at.append(now)
+
+    def snapshot(self, settling: int, queued: int, in_flight: int) -> dict:
+        now = time.monotonic()
+        while self._completed_at and now - self._completed_at[0] > THROUGHPUT_WINDOW:
+            self._completed_at.popleft()
+
+        def percentile(values, fraction):
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "files_detected": self.detected, "files_processed": self.processed,
+            "files_failed": self.failed, "files_skipped": self.skipped, "pool_restarts": self.pool_restarts,
+            "settling": settling, "queued": queued, "in_flight": in_flight,
+            "backlog": settling + queued + in_flight,
+            "throughput_per_minute": len(self._completed_at) * 60.0 / THROUGHPUT_WINDOW,
+            "latency_p50_seconds": round(percentile(self.latencies, 0.5), 3),
+            "latency_p95_seconds": round(percentile(self.latencies, 0.95), 3),
+            "processing_p50_seconds": round(percentile(self.processing, 0.5), 3),
+        }
+
+    @staticmethod
+    def write(path: str, snapshot: dict):
+        """Атомарно записывает метрики: .prom - для textfile-коллектора Prometheus, иначе JSON."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                for key, value in snapshot.items():
+                    f.write(f"watermarks_{key} {value}\n")
+            else:
+                json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+class WatchService:
+    """
+    Наблюдение за папками и обработка новых файлов в пуле процессов.
+    run() работает до stop() (его можно вызывать из обработчика сигнала).
+    """
+
+    def __init__(self, directories, output_dir: str, params, prefix: str = "watermarked_",
+                 extension: str | None = None, max_workers: int | None = None, recursive: bool = False,
+                 settle: float = 1.0, poll_interval: float = 2.0, polling: bool = False, encoding=None,
+                 backend: str | None = None, log_level: int | None = None, metrics_path: str | None = None,
+                 report_interval: float = 60.0, content_hash: bool = False):
+        self.directories = [os.path.abspath(d) for d in directories]
+        # Подпапки относительно общей папки наблюдаемых повторяются в папке результатов (см. cli.make_tasks)
+        try:
+            self.root = os.path.commonpath(self.directories)
+        except ValueError:
+            self.root = None  # Папки на разных дисках (Windows)
+        self.output_dir = os.path.abspath(output_dir)
+        self.params, self.prefix, self.extension = params, prefix, extension
+        self.max_workers = max(1, max_workers or default_worker_count())
+        self.recursive, self.settle = recursive, settle
+        self.poll_interval, self.polling = poll_interval, polling
+        self.encoding, self.backend, self.log_level = encoding, backend, log_level
+        self.metrics_path, self.report_interval = metrics_path, report_interval
+        self.manifest = BatchManifest(self.output_dir, content_hash=content_hash, encoding=encoding)
+        self.metrics = WatchMetrics()
+        self._settling = {}  # путь -> (когда проверить, (размер, время изменения) при последнем событии)
+        self._first_seen = {}  # путь -> время первого события (для задержки до результата)
+        self._queued = deque()
+        self.executor = None
+        self._in_flight = {}  # future -> (задача, когда отдана пулу, пул)
+        self._changed_in_flight = set()  # Файлы, изменившиеся во время обработки, - их нужно сделать заново
+        self._done = deque()  # Завершённые future (их кладёт колбэк из потока пула)
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._running = False
+
+    def stop(self):
+        self._running = False
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # Канал и так не пуст - цикл уже проснётся
+
+    def _on_done(self, future):
+        self._done.append(future)
+        self._wake()
+
+    def _create_watcher(self):
+        if not self.polling and InotifyWatcher.available():
+            try:
+                return InotifyWatcher(self.directories, self.recursive, self.output_dir)
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify is unavailable ({e}), falling back to polling")
+        return PollingWatcher(self.directories, self.recursive, self.output_dir, self.poll_interval)
+
+    def _touch(self, path: str, now: float):
+        """Событие по файлу: откладываем проверку на settle секунд с момента последнего изменения."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._settling.pop(path, None)
+            return
+        if any(task.image_path == path for task, _, _ in self._in_flight.values()):
+            self._changed_in_flight.add(path)
+            return
+        if path not in self._settling and path not in self._first_seen:
+            self.metrics.detected += 1
+        self._first_seen.setdefault(path, now)
+        self._settling[path] = (now + self.settle, (st.st_size, st.st_mtime_ns))
+
+    def _check_settled(self, now: float):
+        for path, (deadline, signature) in list(self._settling.items()):
+            if deadline > now:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._settling[path]
+                self._first_seen.pop(path, None)
+                continue
+            if (st.st_size, st.st_mtime_ns) != signature or st.st_size == 0:
+                # Файл ещё пишется - ждём дальше
+                self._settling[path] = (now + self.settle, (st.st_size, st.st_mtime_ns))
+                continue
+            del self._settling[path]
+            task = make_tasks([path], self.output_dir, self.params, self.prefix, self.extension, self.root)[0]
+            if self.manifest.is_up_to_date(task):
+                self.metrics.skipped += 1
+                self._first_seen.pop(path, None)
+            else:
+                self._queued.append(task)
+
+    def _create_pool(self):
+        return create_worker_pool(self.max_workers, self.log_level, self.backend, encoding=self.encoding)
+
+    def _restart_pool(self, broken):
+        """
+        Пул, в котором умер процесс (например, его убил OOM killer), больше не принимает задачи:
+        заменяем его новым (один раз на поломку). Задачи старого пула завершатся с BrokenProcessPool
+        и попадут в _collect как ошибки.
+        """
+        if self.executor is not broken:
+            return  # Пул уже заменён из-за другой задачи, упавшей на той же поломке
+        logging.error("A worker process died, restarting the worker pool")
+        self.executor = self._create_pool()
+        self.metrics.pool_restarts += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self):
+        # Не больше двух задач на процесс: остальное ждёт в очереди и видно в метриках как backlog
+        while self._queued and len(self._in_flight) < 2 * self.max_workers:
+            task = self._queued.popleft()
+            executor = self.executor
+            try:
+                future = submit_task(executor, task)
+            except BrokenProcessPool:
+                # Пул сломался раньше, чем пришли результаты его задач: файл отдадим новому пулу
+                self._queued.appendleft(task)
+                self._restart_pool(executor)
+                continue
+            self._in_flight[future] = (task, time.monotonic(), executor)
+            future.add_done_callback(self._on_done)
+
+    def _collect(self, now: float):
+        while self._done:
+            future = self._done.popleft()
+            task, submitted, executor = self._in_flight.pop(future)
+            path = task.image_path
+            if future.cancelled():
+                self._first_seen.pop(path, None)  # Остановка службы: файл возьмём при следующем запуске
+                continue
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                # Все задачи упавшего пула считаются ошибками; повторно файл возьмём, если он изменится
+                self._restart_pool(executor)
+            self.metrics.completed(error is None, now - self._first_seen.pop(path, submitted), now - submitted)
+            if error is None:
+                self.manifest.record(task)
+                logging.info(f"Processed {path} -> {task.result_path}")
+            else:
+                self.manifest.forget(task)
+                logging.error(f"Error processing {path}: {error}")
+            if path in self._changed_in_flight:
+                self._changed_in_flight.discard(path)
+                self.manifest.forget(task)
+                self._touch(path, now)
+
+    def _timeout(self, watcher, now: float, next_report: float) -> float | None:
+        deadlines = [deadline for deadline, _ in self._settling.values()]
+        if isinstance(watcher, PollingWatcher):
+            deadlines.append(watcher.next_scan)
+        if self.report_interval:
+            deadlines.append(next_report)
+        return max(0.0, min(deadlines) - now) if deadlines else None
+
+    def _report(self):
+        snapshot = self.metrics.snapshot(len(self._settling), len(self._queued), len(self._in_flight))
+        if self.metrics_path:
+            try:
+                WatchMetrics.write(self.metrics_path, snapshot)
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.metrics_path}: {e}")
+        return snapshot
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        watcher = self._create_watcher()
+        logging.info(f"Watching {', '.join(self.directories)} ({type(watcher).__name__}), "
+                        f"results -> {self.output_dir}")
+        self.executor = self._create_pool()
+        self._running = True
+        now = time.monotonic()
+        # Файлы, накопившиеся, пока служба не работала (готовые отсеет манифест)
+        for path in _scan(self.directories, self.recursive, self.output_dir):
+            self._touch(path, now - self.settle)
+        if isinstance(watcher, PollingWatcher):
+            watcher.changes()  # Запоминаем текущее состояние папок, чтобы не получить их снова как новые
+        next_report = now + self.report_interval
+        try:
+            while self._running:
+                now = time.monotonic()
+                self._check_settled(now)
+                self._submit()
+                if now >= next_report and self.report_interval:
+                    snapshot = self._report()
+                    logging.info(f"Watch: {snapshot['files_processed']} processed, {snapshot['backlog']} in backlog, "
+                                    f"{snapshot['throughput_per_minute']:.0f} files/min, "
+                                    f"latency p50 {snapshot['latency_p50_seconds']} s")
+                    next_report = now + self.report_interval
+                readers = [self._wake_r] + ([watcher.fileno()] if watcher.fileno() is not None else [])
+                ready, _, _ = select.select(readers, [], [], self._timeout(watcher, now, next_report))
+                if self._wake_r in ready:
+                    while True:
+                        try:
+                            if not os.read(self._wake_r, 4096):
+                                break
+                        except BlockingIOError:
+                            break
+                now = time.monotonic()
+                self._collect(now)
+                changes = watcher.changes()
+                if changes is None:
+                    changes = set(_scan(self.directories, self.recursive, self.output_dir))
+                for path in changes:
+                    self._touch(path, now)
+        finally:
+            watcher.close()
+            # Начатые файлы доделываем, новые не берём
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self._collect(time.monotonic())
+            self.manifest.save()
+            self._report()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m watch",
+                                     description="Наблюдение за папками: водяной знак на каждый новый файл.")
+    parser.add_argument("directories", nargs="+", help="папки, за которыми следить")
+    parser.add_argument("-o", "--output-dir", required=True, help="папка для результатов")
+    parser.add_argument("-r", "--recursive", action="store_true", help="следить и за вложенными папками")
+    parser.add_argument("-w", "--workers", type=int, default=default_worker_count(),
+                        help="число рабочих процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--prefix", default="watermarked_", help="префикс имён выходных файлов")
+    parser.add_argument("--preset", help="JSON-файл с параметрами водяного знака (поля WatermarkParams)")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="сколько секунд файл не должен меняться, чтобы считаться дописанным")
+    parser.add_argument("--poll", action="store_true", help="опрашивать папки вместо inotify (сетевые папки)")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="период опроса папок, с")
+    parser.add_argument("--metrics", help="файл метрик (.json или .prom для Prometheus)")
+    parser.add_argument("--report-interval", type=float, default=60.0,
+                        help="как часто обновлять метрики и писать сводку в лог, с (0 - только при выходе)")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="сравнивать исходники с манифестом по хэшу содержимого")
+    parser.add_argument("--backend", choices=["pillow", "numpy"], default="pillow", help="чем смешивать знак")
+    parser.add_argument("-q", "--quiet", action="store_true", help="писать в лог только предупреждения и ошибки")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог рабочих процессов")
+    add_encoding_arguments(parser)
+    add_watermark_arguments(parser)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    configure_logging(logging.WARNING if args.quiet else logging.INFO)
+    try:
+        params = resolve_params(args)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка в параметрах: {e}", file=sys.stderr)
+        return 2
+    error = check_params(params)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    missing = [d for d in args.directories if not os.path.isdir(d)]
+    if missing:
+        print(f"Нет таких папок: {', '.join(missing)}", file=sys.stderr)
+        return 2
+    if os.path.abspath(args.output_dir) in map(os.path.abspath, args.directories):
+        # Иначе служба снова брала бы в работу собственные результаты
+        print("Папка результатов не должна совпадать с папкой, за которой следим.", file=sys.stderr)
+        return 2
+
+    service = WatchService(
+        args.directories, args.output_dir, params, prefix=args.prefix,
+        extension=EXTENSION_BY_FORMAT.get(args.format), max_workers=args.workers, recursive=args.recursive,
+        settle=args.settle, poll_interval=args.poll_interval, polling=args.poll, encoding=encoding_options(args),
+        backend=args.backend, log_level=logging.DEBUG if args.verbose else logging.WARNING, metrics_path=args.metrics,
+        report_interval=args.report_interval, content_hash=args.content_hash)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: service.stop())
+    service.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())